@@ -0,0 +1,238 @@
+""" A QMemory that keeps the Q-values in a NumPy array instead of one dict per state.
+
+    States (by State.key()) and actions get dense indexes in the order they are first seen, and
+    values[stateIndex, actionIndex] is the expected reward. Use it with Policy(qMemoryClass=ArrayQMemory)
+    or Trainer(envProvider, qMemoryClass=ArrayQMemory)
+    """
+from typing import Dict, List
+import numpy as np
+
+from rl import Action, State, QMemory
+
+# Entries never set. They read as 0 like in QMemory, but don't count for the best action
+UNSET = -np.inf
+# Row of the next states not in the table in batchUpdateIndexes, their expected rewards read as 0
+UNKNOWN = -1
+
+
+class ArrayQMemory(QMemory):
+    values: np.ndarray
+    # max and argmax of every row, kept up to date on each update
+    rowMax: np.ndarray
+    rowBest: np.ndarray
+    # rows changed since the last checkpoint.Checkpoint snapshot
+    dirty: np.ndarray
+    stateIndexes: Dict[object, int]
+    actionIndexes: Dict[Action, int]
+    actions: List[Action]
+
+    def __init__(self, learningRate = 0.9, discountRate = 0.5, stateCapacity = 1024, actionCapacity = 8):
+        self.learningRate = learningRate
+        self.discountRate = discountRate
+        self.stateIndexes = {}
+        self.actionIndexes = {}
+        self.actions = []
+        self.values = np.full((stateCapacity, actionCapacity), UNSET, dtype=np.float32)
+        self.rowMax = np.full(stateCapacity, UNSET, dtype=np.float32)
+        self.rowBest = np.full(stateCapacity, -1, dtype=np.int32)
+        self.dirty = np.zeros(stateCapacity, dtype=bool)
+
+    @classmethod
+    def fromArrays(cls, keys:List[object], actions:List[Action], values:np.ndarray, learningRate = 0.9, discountRate = 0.5,
+                   rowMax:np.ndarray = None, rowBest:np.ndarray = None) -> "ArrayQMemory":
+        """ A Q-table with the state 'keys' and 'actions' of the rows and columns of 'values' (UNSET for the entries
+            never set), using the array as it is: it is only copied when the table grows.
+            'keys' can also be an index of the keys (key -> row, with the get() and len() of a dict), used as it is.
+            rowMax and rowBest are computed from the values when not given
+            """
+        qMemory = cls.__new__(cls)
+        qMemory.learningRate = learningRate
+        qMemory.discountRate = discountRate
+        qMemory.stateIndexes = dict(zip(keys, range(len(keys)))) if isinstance(keys, list) else keys
+        qMemory.actions = list(actions)
+        qMemory.actionIndexes = {action: column for (column, action) in enumerate(qMemory.actions)}
+        qMemory.values = values
+        if rowMax is None:
+            best = values.argmax(axis=1) if values.size else np.zeros(len(values), dtype=np.int64)
+            rowMax = values[np.arange(len(values)), best] if values.size else np.full(len(values), UNSET, dtype=np.float32)
+            rowBest = np.where(rowMax == UNSET, -1, best).astype(np.int32)
+        qMemory.rowMax = rowMax
+        qMemory.rowBest = rowBest
+        qMemory.dirty = np.zeros(len(values), dtype=bool)
+        return qMemory
+
+    def stateIndex(self, state:State) -> int:
+        """ Index of 'state', adding a row for it when it is new """
+        return self.keyIndex(state.key())
+
+    def keyIndex(self, key) -> int:
+        index = self.stateIndexes.get(key)
+        if index is None:
+            index = len(self.stateIndexes)
+            if index == len(self.values):
+                self.grow(max(2 * len(self.values), 1), self.values.shape[1])
+            self.stateIndexes[key] = index
+        return index
+
+    def actionIndex(self, action:Action) -> int:
+        """ Index of 'action', adding a column for it when it is new """
+        index = self.actionIndexes.get(action)
+        if index is None:
+            index = len(self.actions)
+            if index == self.values.shape[1]:
+                self.grow(len(self.values), max(2 * self.values.shape[1], 1))
+            self.actionIndexes[action] = index
+            self.actions.append(action)
+        return index
+
+    def grow(self, numRows:int, numColumns:int):
+        (rows, columns) = self.values.shape
+        values = np.full((numRows, numColumns), UNSET, dtype=np.float32)
+        values[:rows, :columns] = self.values
+        self.values = values
+        if numRows > rows:
+            self.rowMax = np.concatenate([self.rowMax, np.full(numRows - rows, UNSET, dtype=np.float32)])
+            self.rowBest = np.concatenate([self.rowBest, np.full(numRows - rows, -1, dtype=np.int32)])
+            self.dirty = np.concatenate([self.dirty, np.zeros(numRows - rows, dtype=bool)])
+
+    def numStates(self) -> int:
+        return len(self.stateIndexes)
+
+    def getBestAction(self, state:State) -> Action:
+        """ Doesn't add unknown states, unlike QMemory """
+        index = self.stateIndexes.get(state.key())
+        if index is None:
+            return None
+        best = self.rowBest[index]
+        return None if best < 0 else self.actions[best]
+
+    def getMaxReward(self, state:State):
+        index = self.stateIndexes.get(state.key())
+        return 0 if index is None else self.maxReward(index)
+
+    def maxReward(self, index:int) -> float:
+        value = self.rowMax[index]
+        return 0 if value == UNSET else float(value)
+
+    def getExpectedReward(self, state:State, action:Action):
+        index = self.stateIndexes.get(state.key())
+        column = self.actionIndexes.get(action)
+        if index is None or column is None:
+            return 0
+        value = self.values[index, column]
+        return 0 if value == UNSET else float(value)
+
+    def peekExpectedReward(self, key, action:Action):
+        index = self.stateIndexes.get(key)
+        if index is None:
+            return None
+        column = self.actionIndexes.get(action)
+        value = UNSET if column is None else self.values[index, column]
+        return 0 if value == UNSET else float(value)
+
+    def setExpectedReward(self, index:int, column:int, reward):
+        row = self.values[index]
+        row[column] = reward
+        self.dirty[index] = True
+        reward = row[column]
+        if reward > self.rowMax[index]:
+            self.rowMax[index] = reward
+            self.rowBest[index] = column
+        elif column == self.rowBest[index] and reward < self.rowMax[index]:
+            # the best value went down, another action may be the best now
+            best = int(row.argmax())
+            self.rowBest[index] = best
+            self.rowMax[index] = row[best]
+
+    def update(self, oldState:State, action:Action, newState:State, reward, done = False):
+        index = self.stateIndex(oldState)
+        column = self.actionIndex(action)
+        currentValue = self.values[index, column]
+        currentValue = 0 if currentValue == UNSET else float(currentValue)
+        # the new state is only read, it gets a row when it is updated itself
+        newIndex = self.stateIndexes.get(newState.key())
+        maxExpectedNew = 0 if done or newIndex is None else self.maxReward(newIndex)
+        newExpectedReward = currentValue + self.learningRate * (reward + self.discountRate * maxExpectedNew - currentValue)
+        self.setExpectedReward(index, column, newExpectedReward)
+
+    def batchUpdate(self, states:List[State], actions:List[Action], nextStates:List[State], rewards, dones):
+        rows = np.fromiter((self.stateIndex(state) for state in states), dtype=np.int64, count=len(states))
+        columns = np.fromiter((self.actionIndex(action) for action in actions), dtype=np.int64, count=len(actions))
+        stateIndexes = self.stateIndexes
+        nextRows = np.fromiter((stateIndexes.get(state.key(), UNKNOWN) for state in nextStates), dtype=np.int64, count=len(nextStates))
+        self.batchUpdateIndexes(rows, columns, nextRows, rewards, dones)
+
+    def batchUpdateIndexes(self, rows:np.ndarray, columns:np.ndarray, nextRows:np.ndarray, rewards, dones) -> np.ndarray:
+        """ Q-learning updates of the transitions rows[i] --columns[i]--> nextRows[i] (UNKNOWN for a state not in the table),
+            as vectorized operations.
+            Transitions of the same (state, action) are applied one after the other in the given order, the others
+            at the same time, each one with the expected rewards from before its round.
+            Returns the TD error (target - expected reward before the update) of each transition
+            """
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = np.asarray(columns, dtype=np.int64)
+        nextRows = np.asarray(nextRows, dtype=np.int64)
+        rewards = np.asarray(rewards, dtype=np.float64)
+        dones = np.asarray(dones, dtype=bool)
+        errors = np.zeros(len(rows), dtype=np.float64)
+        if not len(rows):
+            return errors
+
+        # rank of each transition among the ones with the same (state, action)
+        pairs = rows * self.values.shape[1] + columns
+        order = np.argsort(pairs, kind="stable")
+        sortedPairs = pairs[order]
+        firsts = np.concatenate([[True], sortedPairs[1:] != sortedPairs[:-1]])
+        groupStarts = np.maximum.accumulate(np.where(firsts, np.arange(len(rows)), 0))
+        ranks = np.empty(len(rows), dtype=np.int64)
+        ranks[order] = np.arange(len(rows)) - groupStarts
+
+        for rank in range(ranks.max() + 1):
+            selected = ranks == rank
+            (roundRows, roundColumns) = (rows[selected], columns[selected])
+            roundNextRows = nextRows[selected]
+            maxExpectedNew = self.rowMax[roundNextRows].astype(np.float64)
+            maxExpectedNew[(maxExpectedNew == UNSET) | dones[selected] | (roundNextRows == UNKNOWN)] = 0
+            currentValues = self.values[roundRows, roundColumns].astype(np.float64)
+            currentValues[currentValues == UNSET] = 0
+            errors[selected] = rewards[selected] + self.discountRate * maxExpectedNew - currentValues
+            self.values[roundRows, roundColumns] = currentValues + self.learningRate * errors[selected]
+            self.updateRowMax(np.unique(roundRows))
+        return errors
+
+    def addDeltas(self, keys:List[object], actions:List[Action], deltas):
+        rows = np.fromiter((self.keyIndex(key) for key in keys), dtype=np.int64, count=len(keys))
+        columns = np.fromiter((self.actionIndex(action) for action in actions), dtype=np.int64, count=len(actions))
+        if not len(rows):
+            return
+        # deltas of the same (state, action) add up
+        numColumns = self.values.shape[1]
+        (pairs, inverse) = np.unique(rows * numColumns + columns, return_inverse=True)
+        deltas = np.bincount(inverse, weights=np.asarray(deltas, dtype=np.float64))
+        (rows, columns) = (pairs // numColumns, pairs % numColumns)
+        values = self.values[rows, columns].astype(np.float64)
+        values[values == UNSET] = 0
+        self.values[rows, columns] = values + deltas
+        self.updateRowMax(np.unique(rows))
+
+    def setExpectedRewards(self, keys:List[object], actions:List[Action], rewards):
+        rows = np.fromiter((self.keyIndex(key) for key in keys), dtype=np.int64, count=len(keys))
+        columns = np.fromiter((self.actionIndex(action) for action in actions), dtype=np.int64, count=len(actions))
+        if not len(rows):
+            return
+        self.values[rows, columns] = rewards
+        self.updateRowMax(np.unique(rows))
+
+    def updateRowMax(self, rows:np.ndarray):
+        self.dirty[rows] = True
+        values = self.values[rows]
+        best = values.argmax(axis=1)
+        self.rowMax[rows] = values[np.arange(len(rows)), best]
+        self.rowBest[rows] = np.where(self.rowMax[rows] == UNSET, -1, best)
+
+    def stats(self) -> Dict[str, float]:
+        return {"entries": self.numStates(), "bytes": self.nbytes()}
+
+    def nbytes(self) -> int:
+        """ Bytes used by the arrays (the index dicts not included) """
+        return self.values.nbytes + self.rowMax.nbytes + self.rowBest.nbytes + self.dirty.nbytes
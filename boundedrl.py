@@ -0,0 +1,99 @@
+""" A QMemory that keeps at most a given number of states, evicting some when it is full.
+
+    Which states go is chosen by an eviction function, by name in EVICTIONS or any function
+    (memory, count) -> keys. Use it with functools.partial, e.g.
+        Trainer(envProvider, qMemoryClass=partial(BoundedQMemory, capacity=100000, eviction="visits"))
+    """
+from typing import Dict, List
+from collections import OrderedDict
+from itertools import islice
+import heapq
+
+from rl import Action, State, QMemory
+
+
+def leastRecentlyUsed(memory:"BoundedQMemory", count:int) -> List[object]:
+    return list(islice(memory.sar, count))
+
+
+def leastVisited(memory:"BoundedQMemory", count:int) -> List[object]:
+    """ The states updated the fewest times """
+    return heapq.nsmallest(count, memory.sar, key=memory.visits.__getitem__)
+
+
+def lowestValue(memory:"BoundedQMemory", count:int) -> List[object]:
+    """ The states whose expected rewards are all the closest to 0: forgetting them changes the least """
+    def largest(key):
+        return max(map(abs, memory.sar[key].actions.values()), default=0)
+    return heapq.nsmallest(count, memory.sar, key=largest)
+
+
+EVICTIONS = {"lru": leastRecentlyUsed, "visits": leastVisited, "value": lowestValue}
+
+
+class BoundedQMemory(QMemory):
+    """ Up to 'capacity' states. When a new state doesn't fit, 'evictionBatch' of the capacity is evicted at once,
+        so the cost of choosing the victims (a pass over the states for "visits" and "value") is shared by many inserts
+        """
+    sar: OrderedDict
+    # number of updates of each state
+    visits: Dict[object, int]
+
+    def __init__(self, learningRate = 0.9, discountRate = 0.5, capacity = 100000, eviction = "lru", evictionBatch = 0.01):
+        super().__init__(learningRate, discountRate)
+        self.sar = OrderedDict()
+        self.visits = {}
+        self.capacity = capacity
+        self.victims = EVICTIONS[eviction] if isinstance(eviction, str) else eviction
+        self.batchSize = max(1, int(capacity * evictionBatch))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def entry(self, key) -> QMemory.ActionRewards:
+        ars = self.sar.get(key)
+        if ars is not None:
+            self.hits = self.hits + 1
+            self.sar.move_to_end(key)
+            return ars
+
+        self.misses = self.misses + 1
+        if len(self.sar) >= self.capacity:
+            self.evict(len(self.sar) - self.capacity + self.batchSize)
+        ars = self.sar[key] = self.ActionRewards()
+        self.visits[key] = 0
+        return ars
+
+    def lookup(self, state:State) -> QMemory.ActionRewards:
+        key = state.key()
+        ars = self.sar.get(key)
+        if ars is None:
+            self.misses = self.misses + 1
+        else:
+            self.hits = self.hits + 1
+            self.sar.move_to_end(key)
+        return ars
+
+    def evict(self, count:int):
+        victims = self.victims(self, count)
+        for key in victims:
+            del self.sar[key]
+            del self.visits[key]
+        self.evictions = self.evictions + len(victims)
+
+    def update(self, oldState:State, action:Action, newState:State, reward, done = False):
+        super().update(oldState, action, newState, reward, done)
+        key = oldState.key()
+        self.visits[key] = self.visits[key] + 1
+
+    def addDeltas(self, keys:List[object], actions:List[Action], deltas):
+        super().addDeltas(keys, actions, deltas)
+        for key in keys:
+            # a later delta may have evicted the state of an earlier one
+            if key in self.visits:
+                self.visits[key] = self.visits[key] + 1
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {"entries": len(self.sar), "capacity": self.capacity, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hitRate": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,323 @@
+""" Q-table checkpoints: save a trained QMemory, load it back in a memory-mapped file, and resume training.
+
+    A checkpoint file is a magic string followed by records. The first one is a full copy of the Q-table,
+    the next ones are appended during training with only what changed since the record before:
+        header       HEADER: tag (FULL or DIFF), key encoding, rates, sizes of the sections below
+        actions      the actions seen since the last record, pickled
+        key offsets  int64, where each new state key starts in the key blob (one more for the end), none
+                     for FIXED_KEYS
+        keys         the new state keys, as they are (bytes keys, like chess positions) or pickled one by one
+        rows         int64, the Q-table row of each saved row of values (DIFF records), or of each key of a
+                     FULL record with FIXED_KEYS, whose keys are sorted
+        values       float32 rows x columns, -inf for the entries never set
+        row max      float32 max and int32 best column of each row (FULL records only)
+        row best
+        meta         pickled dict of the caller (e.g. the Trainer progress)
+    Sections are aligned to 8 bytes. Loading maps the file and uses the FULL record in place, copied on write.
+    With FIXED_KEYS (bytes keys of the same size) the keys stay in the file too and are found by binary search
+    (MappedKeyIndex), so loading doesn't depend on the size of the table. Other keys are decoded into a dict
+    up front, which takes about a second per million states. A record cut short by a crash is ignored, and
+    overwritten by the next snapshot of a Checkpoint that loaded the file
+    """
+from typing import Dict, List, Tuple
+from itertools import islice
+import mmap
+import os
+import pickle
+import struct
+import numpy as np
+
+from rl import QMemory
+from arrayrl import ArrayQMemory, UNSET
+
+MAGIC = b"RLQCKPT2"
+FULL = b"FULL"
+DIFF = b"DIFF"
+# how the state keys are stored
+BYTES_KEYS = 0
+PICKLED_KEYS = 1
+# bytes keys all of the same size: no offsets
+FIXED_KEYS = 2
+HEADER = struct.Struct("<4sB3xddqqqqqq")
+ALIGNMENT = 8
+
+
+def padding(size:int) -> int:
+    return -size % ALIGNMENT
+
+
+def encodeKeys(keys:List[object]) -> Tuple[int, np.ndarray, bytes]:
+    """ (key encoding, offsets, blob) """
+    if keys and all(type(key) is bytes for key in keys):
+        width = len(keys[0])
+        kind = FIXED_KEYS if width > 0 and all(len(key) == width for key in keys) else BYTES_KEYS
+    else:
+        kind = PICKLED_KEYS
+    if kind == FIXED_KEYS:
+        return (kind, np.zeros(0, dtype=np.int64), b"".join(keys))
+    encoded = keys if kind == BYTES_KEYS else [pickle.dumps(key, pickle.HIGHEST_PROTOCOL) for key in keys]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(key) for key in encoded], out=offsets[1:])
+    return (kind, offsets, b"".join(encoded))
+
+
+def decodeKeys(kind:int, offsets:np.ndarray, blob, numKeys:int) -> List[object]:
+    if kind == FIXED_KEYS:
+        return np.frombuffer(blob, dtype=f"V{len(blob) // numKeys}").tolist() if numKeys else []
+    offsets = offsets.tolist()
+    keys = [bytes(blob[start:end]) for (start, end) in zip(offsets, offsets[1:])]
+    return keys if kind == BYTES_KEYS else [pickle.loads(key) for key in keys]
+
+
+def sortKeys(blob:bytes, numKeys:int) -> Tuple[bytes, np.ndarray]:
+    """ (sorted blob, row of each sorted key) of FIXED_KEYS in row order """
+    keys = np.frombuffer(blob, dtype=f"S{len(blob) // numKeys}")
+    rows = np.argsort(keys, kind="stable")
+    return (keys[rows].tobytes(), rows)
+
+
+class MappedKeyIndex:
+    """ The state indexes of an ArrayQMemory loaded from a FULL record with FIXED_KEYS, in place of its dict.
+        The sorted keys stay in the mapped file and are found with np.searchsorted. Keys searched, and the
+        ones added after loading, are kept in a dict so each one is searched once
+        """
+    def __init__(self, blob, numKeys:int, rows:np.ndarray):
+        self.blob = blob
+        self.width = len(blob) // numKeys
+        # S dtype: compares like the bytes, trailing zero bytes aside, which is the same for keys of one size
+        self.sortedKeys = np.frombuffer(blob, dtype=f"S{self.width}")
+        self.rows = rows
+        self.numMapped = numKeys
+        # key -> row, or -1 for a key searched and not found
+        self.known = {}
+        # keys added after loading, in order
+        self.added = {}
+
+    def get(self, key, default = None):
+        row = self.known.get(key)
+        if row is None:
+            row = self.search(key)
+            self.known[key] = row
+        return default if row < 0 else row
+
+    def search(self, key) -> int:
+        if type(key) is not bytes or len(key) != self.width:
+            return -1
+        position = int(np.searchsorted(self.sortedKeys, key))
+        start = position * self.width
+        if position == self.numMapped or self.blob[start:start + self.width] != key:
+            return -1
+        return int(self.rows[position])
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __setitem__(self, key, row:int):
+        self.known[key] = row
+        self.added[key] = row
+
+    def __len__(self) -> int:
+        return self.numMapped + len(self.added)
+
+    def mappedKeys(self) -> List[bytes]:
+        """ The keys of the file in row order """
+        positions = np.empty(self.numMapped, dtype=np.int64)
+        positions[self.rows] = np.arange(self.numMapped)
+        return np.frombuffer(self.blob, dtype=f"V{self.width}")[positions].tolist()
+
+    def __iter__(self):
+        yield from self.mappedKeys()
+        yield from self.added
+
+    def __reversed__(self):
+        yield from reversed(self.added)
+        yield from reversed(self.mappedKeys())
+
+    def __reduce__(self):
+        # the mapped file can't be pickled (e.g. for the workers of Trainer.parallelTrain), a dict of the keys is
+        return (dict, (dict(zip(self, range(len(self)))),))
+
+
+def tableOf(qMemory:QMemory) -> Tuple[List[object], list, np.ndarray]:
+    """ (state keys, actions, values) of any QMemory, values[row, column] being the expected reward """
+    if isinstance(qMemory, ArrayQMemory):
+        return (list(qMemory.stateIndexes), list(qMemory.actions), qMemory.values[:qMemory.numStates(), :len(qMemory.actions)])
+    keys = list(qMemory.sar)
+    actions = list({action: None for ars in qMemory.sar.values() for action in ars.actions})
+    columns = {action: column for (column, action) in enumerate(actions)}
+    values = np.full((len(keys), len(actions)), UNSET, dtype=np.float32)
+    for (row, key) in enumerate(keys):
+        for (action, reward) in qMemory.sar[key].actions.items():
+            values[row, columns[action]] = reward
+    return (keys, actions, values)
+
+
+def writeRecord(f, tag:bytes, qMemory:QMemory, actions:list, keys:List[object], rows:np.ndarray, values:np.ndarray, meta:Dict):
+    """ A FULL record has a row of 'values' per key, in order: 'rows' are only for DIFF records """
+    actionsBlob = pickle.dumps(actions, pickle.HIGHEST_PROTOCOL)
+    (kind, offsets, keysBlob) = encodeKeys(keys)
+    metaBlob = pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)
+    values = np.ascontiguousarray(values, dtype=np.float32)
+    best = b""
+    if tag == FULL:
+        if kind == FIXED_KEYS:
+            (keysBlob, rows) = sortKeys(keysBlob, len(keys))
+        columns = values.argmax(axis=1) if values.size else np.zeros(len(values), dtype=np.int64)
+        rowMax = values[np.arange(len(values)), columns] if values.size else np.full(len(values), UNSET, dtype=np.float32)
+        rowBest = np.where(rowMax == UNSET, -1, columns).astype(np.int32)
+        best = rowMax.astype(np.float32).tobytes() + rowBest.tobytes()
+    f.write(HEADER.pack(tag, kind, qMemory.learningRate, qMemory.discountRate, values.shape[1] if values.ndim == 2 else 0,
+                        len(actionsBlob), len(keys), len(keysBlob), len(rows), len(metaBlob)))
+    f.write(bytes(padding(HEADER.size)))
+    for section in (actionsBlob, offsets.tobytes(), keysBlob, np.asarray(rows, dtype=np.int64).tobytes(), values.tobytes(),
+                    best[:4 * len(values)], best[4 * len(values):], metaBlob):
+        f.write(section)
+        f.write(bytes(padding(len(section))))
+
+
+def save(path:str, qMemory:QMemory, meta:Dict = None):
+    """ Write a checkpoint with a single FULL record. The file is replaced only once completely written """
+    (keys, actions, values) = tableOf(qMemory)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(MAGIC)
+        writeRecord(f, FULL, qMemory, actions, keys, np.zeros(0, dtype=np.int64), values, meta or {})
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def readRecords(data):
+    """ (header fields, sections, end offset) of every complete record in the mapped file """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a Q-table checkpoint")
+    offset = len(MAGIC)
+    while offset + HEADER.size <= len(data):
+        fields = HEADER.unpack_from(data, offset)
+        (tag, kind, learningRate, discountRate, numColumns, actionsLength, numKeys, keysLength, numRows, metaLength) = fields
+        if tag not in (FULL, DIFF):
+            return
+        # a FULL record has a row of values for each key, in order, and their max and best column
+        valueRows = numKeys if tag == FULL else numRows
+        bestRows = valueRows if tag == FULL else 0
+        offsetsLength = 0 if kind == FIXED_KEYS else 8 * (numKeys + 1)
+        sizes = (actionsLength, offsetsLength, keysLength, 8 * numRows, 4 * valueRows * numColumns, 4 * bestRows, 4 * bestRows,
+                 metaLength)
+        offset = offset + HEADER.size + padding(HEADER.size)
+        if offset + sum(size + padding(size) for size in sizes) > len(data):
+            # cut short while it was appended
+            return
+        sections = []
+        for size in sizes:
+            sections.append(data[offset:offset + size])
+            offset = offset + size + padding(size)
+        yield (fields, sections, offset)
+
+
+def load(path:str, qMemoryClass = ArrayQMemory) -> Tuple[QMemory, Dict]:
+    """ (Q-table, meta of the last record) of a checkpoint. An ArrayQMemory uses the values of the file
+        in place until it grows, a QMemory gets its dicts filled
+        """
+    (qMemory, meta, _) = loadRecords(path)
+    return (convert(qMemory, qMemoryClass), meta)
+
+
+def loadRecords(path:str) -> Tuple[ArrayQMemory, Dict, int]:
+    """ (Q-table, meta of the last record, end offset of the last complete record) of a checkpoint """
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    qMemory = None
+    meta = {}
+    end = len(MAGIC)
+    for ((tag, kind, learningRate, discountRate, numColumns, _, numKeys, _, _, _), sections, end) in readRecords(memoryview(data)):
+        (actionsBlob, offsets, keysBlob, rows, values, rowMax, rowBest, metaBlob) = sections
+        actions = pickle.loads(actionsBlob)
+        rows = np.frombuffer(rows, dtype=np.int64)
+        values = np.frombuffer(values, dtype=np.float32).reshape(-1, numColumns)
+        if (qMemory is None) != (tag == FULL):
+            raise ValueError(f"{path} must start with a full Q-table, and only with it")
+        if qMemory is None:
+            if kind == FIXED_KEYS and numKeys:
+                keys = MappedKeyIndex(keysBlob, numKeys, rows)
+            else:
+                keys = decodeKeys(kind, np.frombuffer(offsets, dtype=np.int64), keysBlob, numKeys)
+            qMemory = ArrayQMemory.fromArrays(keys, actions, values, learningRate, discountRate,
+                                              np.frombuffer(rowMax, dtype=np.float32), np.frombuffer(rowBest, dtype=np.int32))
+        else:
+            for action in actions:
+                qMemory.actionIndex(action)
+            for key in decodeKeys(kind, np.frombuffer(offsets, dtype=np.int64), keysBlob, numKeys):
+                qMemory.keyIndex(key)
+            qMemory.values[rows, :numColumns] = values
+            qMemory.updateRowMax(rows)
+        meta = pickle.loads(metaBlob)
+    if qMemory is None:
+        raise ValueError(f"{path} is empty")
+    qMemory.dirty[:] = False
+    return (qMemory, meta, end)
+
+
+def convert(qMemory:ArrayQMemory, qMemoryClass) -> QMemory:
+    """ The loaded Q-table as it is for an ArrayQMemory, copied into a new 'qMemoryClass' otherwise """
+    if qMemoryClass is ArrayQMemory:
+        return qMemory
+    (keys, actions, values) = tableOf(qMemory)
+    (rows, columns) = np.nonzero(values != UNSET)
+    result = qMemoryClass(qMemory.learningRate, qMemory.discountRate)
+    result.setExpectedRewards([keys[row] for row in rows.tolist()], [actions[column] for column in columns.tolist()],
+                              values[rows, columns].tolist())
+    return result
+
+
+class Checkpoint:
+    """ A checkpoint file written during training. The first snapshot() writes the whole Q-table, the next
+        ones append the states and actions added and the rows updated since the snapshot before, so their
+        cost follows what changed and not the size of the table. A QMemory (not an ArrayQMemory) doesn't
+        track what changed, every snapshot rewrites it
+        """
+    def __init__(self, path:str):
+        self.path = path
+        self.qMemory = None
+        self.numKeys = 0
+        self.numActions = 0
+        # where the next record goes when the file ends with a record cut short, None otherwise
+        self.end = None
+
+    def snapshot(self, qMemory:QMemory, meta:Dict = None):
+        if qMemory is not self.qMemory or not isinstance(qMemory, ArrayQMemory) or not os.path.exists(self.path):
+            save(self.path, qMemory, meta)
+        else:
+            rows = np.flatnonzero(qMemory.dirty[:qMemory.numStates()])
+            # the keys are in the order they were added, the new ones are the last
+            newKeys = list(islice(reversed(qMemory.stateIndexes), qMemory.numStates() - self.numKeys))[::-1]
+            if self.end is not None:
+                # drop what is left of the record cut short, the new one would be read from its header
+                os.truncate(self.path, self.end)
+            with open(self.path, "ab") as f:
+                writeRecord(f, DIFF, qMemory, qMemory.actions[self.numActions:], newKeys, rows,
+                            qMemory.values[rows, :len(qMemory.actions)], meta or {})
+                f.flush()
+                os.fsync(f.fileno())
+        self.track(qMemory)
+        self.end = None
+        if isinstance(qMemory, ArrayQMemory):
+            qMemory.dirty[:] = False
+
+    def track(self, qMemory:QMemory):
+        """ The file holds 'qMemory' as it is now """
+        self.qMemory = qMemory
+        self.numKeys = qMemory.numStates()
+        self.numActions = len(qMemory.actions) if isinstance(qMemory, ArrayQMemory) else 0
+
+    def load(self, qMemoryClass = ArrayQMemory) -> Tuple[QMemory, Dict]:
+        """ load() the file, the next snapshots of the Q-table returned are appended to it """
+        (qMemory, meta, end) = loadRecords(self.path)
+        self.end = end if end < os.path.getsize(self.path) else None
+        qMemory = convert(qMemory, qMemoryClass)
+        self.track(qMemory)
+        return (qMemory, meta)
+
+    def compact(self):
+        """ Rewrite the file as a single FULL record """
+        (qMemory, meta) = load(self.path)
+        save(self.path, qMemory, meta)
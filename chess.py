@@ -1,6 +1,8 @@
-from typing import List, Dict
+from typing import List, Dict, Tuple
 from enum import Enum
 from dataclasses import dataclass
+from functools import lru_cache
+import random
 
 EMPTY  = None
 
@@ -19,7 +21,10 @@ class Piece(Enum):
     Queen  = 5
     King   = 6
 
-@dataclass
+# Position, BoardPiece and Move are immutable value objects. Board hands out the instances interned in
+# its MoveTables, so they are shared and can be compared by identity before falling back to their values
+
+@dataclass(frozen=True, slots=True, eq=False)
 class Position:
     row: int
     col: int
@@ -38,7 +43,10 @@ class Position:
     def __hash__(self):
         return hash((self.row, self.col))
 
-@dataclass
+    def __eq__(self, other):
+        return self is other or (isinstance(other, Position) and self.row == other.row and self.col == other.col)
+
+@dataclass(frozen=True, slots=True, eq=False)
 class BoardPiece:
     piece: Piece
     color: Color
@@ -56,90 +64,300 @@ class BoardPiece:
         return hash((self.piece, self.color, self.pos))
     
     def __eq__(self, other):
-        return (self.piece, self.color, self.pos) == (other.piece, other.color, other.pos)
+        return self is other or (isinstance(other, BoardPiece) and
+                                 (self.piece, self.color, self.pos) == (other.piece, other.color, other.pos))
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Move:
     orig:Position
     dest:Position
     def __hash__(self):
-        return hash((hash(self.orig), hash(self.dest)))
+        return hash((self.orig.row, self.orig.col, self.dest.row, self.dest.col))
 
-class Board:
-    pieces: List[BoardPiece] = []
-    pMoves: Dict[BoardPiece, List[Move]] = {}
+    def __eq__(self, other):
+        return self is other or (isinstance(other, Move) and self.orig == other.orig and self.dest == other.dest)
+
+# Square contents are stored as a single byte: piece.value + color.value, which is
+# also the index used by Board.__str__. 0 is an empty square.
+CODE_PIECE = (Piece.Empty, Piece.Pawn, Piece.Bishop, Piece.Knight, Piece.Rook, Piece.Queen, Piece.King,
+              Piece.Empty, Piece.Pawn, Piece.Bishop, Piece.Knight, Piece.Rook, Piece.Queen, Piece.King)
+CODE_COLOR = (None,) + (Color.White,) * 6 + (None,) + (Color.Black,) * 6
+
+ROOK_DIRECTIONS = ((0, -1), (0, 1), (-1, 0), (1, 0))
+BISHOP_DIRECTIONS = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+KING_DIRECTIONS = ROOK_DIRECTIONS + BISHOP_DIRECTIONS
+KNIGHT_JUMPS = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
+# Indexes in MoveTables.rays of the directions each sliding piece moves in
+RAY_DIRECTIONS = {
+    Piece.Rook: (0, 1, 2, 3),
+    Piece.Bishop: (4, 5, 6, 7),
+    Piece.Queen: (0, 1, 2, 3, 4, 5, 6, 7),
+}
+
+def pieceCode(piece:Piece, color:Color) -> int:
+    return piece.value + color.value
+
+# Code of the king of the other color of each square code, 0 for empty squares
+OTHER_KING = tuple(0 if CODE_COLOR[code] is None else pieceCode(Piece.King, CODE_COLOR[code].other()) for code in range(len(CODE_COLOR)))
+
+def codeOrder(code:int) -> int:
+    """ Sorting key of a square code: by piece type first, then color """
+    return CODE_PIECE[code].value * 2 + (code > Color.Black.value)
+
+class MoveTables:
+    """ Squares reachable from every square of a board, by kind of movement. Built once per board size """
+    # rays[square][direction]: squares from 'square' to the edge of the board, closest first
+    rays: List[Tuple[Tuple[int, ...], ...]]
+    knightJumps: List[Tuple[int, ...]]
+    kingNeighbours: List[Tuple[int, ...]]
+    kingMasks: List[int]
+    # pawnAdvance[color][square] is -1 for pawns in the last row
+    pawnAdvance: Dict[Color, List[int]]
+    pawnAttacks: Dict[Color, List[Tuple[int, ...]]]
+    # Interned value objects: positions[square], moves[orig * size * size + dest], boardPieces[code][square]
+    positions: Tuple[Position, ...]
+    moves: Tuple[Move, ...]
+    boardPieces: Tuple[Tuple[BoardPiece, ...], ...]
 
+    def __init__(self, size:int):
+        self.size = size
+        squares = range(size * size)
+        self.positions = tuple(Position(sq // size, sq % size) for sq in squares)
+        self.moves = tuple(Move(orig, dest) for orig in self.positions for dest in self.positions)
+        self.boardPieces = tuple(tuple(BoardPiece(CODE_PIECE[code], CODE_COLOR[code], pos) for pos in self.positions)
+                                 if CODE_COLOR[code] else () for code in range(len(CODE_PIECE)))
+        self.rays = [tuple(self.ray(sq, direction) for direction in KING_DIRECTIONS) for sq in squares]
+        self.knightJumps = [self.jumps(sq, KNIGHT_JUMPS) for sq in squares]
+        self.kingNeighbours = [self.jumps(sq, KING_DIRECTIONS) for sq in squares]
+        self.kingMasks = [sum(1 << n for n in neighbours) for neighbours in self.kingNeighbours]
+        self.pawnAdvance = {}
+        self.pawnAttacks = {}
+        for (color, dr) in ((Color.White, -1), (Color.Black, 1)):
+            self.pawnAdvance[color] = [(self.jumps(sq, ((dr, 0),)) or (-1,))[0] for sq in squares]
+            self.pawnAttacks[color] = [self.jumps(sq, ((dr, -1), (dr, 1))) for sq in squares]
+
+    def jumps(self, square:int, offsets) -> Tuple[int, ...]:
+        row, col = divmod(square, self.size)
+        return tuple(r * self.size + c for (r, c) in ((row + dr, col + dc) for (dr, dc) in offsets)
+                     if 0 <= r < self.size and 0 <= c < self.size)
+
+    def ray(self, square:int, direction:Tuple[int, int]) -> Tuple[int, ...]:
+        (dr, dc) = direction
+        row, col = divmod(square, self.size)
+        ray = []
+        r, c = row + dr, col + dc
+        while 0 <= r < self.size and 0 <= c < self.size:
+            ray.append(r * self.size + c)
+            r, c = r + dr, c + dc
+        return tuple(ray)
+
+@lru_cache(maxsize=None)
+def moveTables(size:int) -> MoveTables:
+    return MoveTables(size)
+
+@lru_cache(maxsize=None)
+def zobristKeys(size:int) -> Tuple[Tuple[int, ...], ...]:
+    """ Random 64 bit keys for every square code and square of a board of size 'size'.
+        Empty squares have key 0. Seeded with the size, so keys are the same in every process
+        """
+    rng = random.Random(size)
+    numSquares = size * size
+    return tuple(tuple(rng.getrandbits(64) if CODE_COLOR[code] else 0 for _ in range(numSquares))
+                 for code in range(len(CODE_PIECE)))
+
+
+class Board:
+    squares: bytearray
+    # Cached destination squares per origin square, the bitmask of squares attacked from it (not for kings)
+    # and the bitmask of squares each entry was built from
+    pMoves: Dict[int, List[int]]
+    pAttacks: Dict[int, int]
+    moveDeps: Dict[int, int]
+    # Bitmask of the squares attacked by each color, built from pAttacks when needed
+    attackMaps: Dict[Color, int]
+    undoStack: List[Tuple[int, int, int, List[Tuple[int, List[int], int, int]], Dict[Color, int], int]]
+    # Squares whose moves were cached while moves were pending to be unmade, in order
+    cachedSquares: List[int]
+    # Zobrist hash of the pieces in the board, updated on every change
+    zobrist: int
+    # Number of times the moves of a piece have been generated
+    moveGenerations: int
 
     def __init__(self, size:int):
         self.size = size
+        self.moveGenerations = 0
+        self.zobristKeys = zobristKeys(size)
+        self.tables = moveTables(size)
         self.clear() # initialize board and pieces
-        self.updateOnChange = True
 
     def remakePossibleMoves(self):
         self.pMoves = {}
-        for p in self.pieces:
-            self.possibleMoves(p)
+        self.pAttacks = {}
+        self.moveDeps = {}
+        self.attackMaps = {}
+        for sq in range(len(self.squares)):
+            if self.squares[sq]:
+                self.destinations(sq)
 
     def clear(self):
-        self.board = [[EMPTY] * self.size for _ in range(self.size)]
-        self.pieces = []
+        self.squares = bytearray(self.size * self.size)
         self.pMoves = {}
+        self.pAttacks = {}
+        self.moveDeps = {}
+        self.attackMaps = {}
+        self.undoStack = []
+        self.cachedSquares = []
+        self.zobrist = 0
+
+    def square(self, pos:Position) -> int:
+        return pos.row * self.size + pos.col
+
+    def position(self, square:int) -> Position:
+        return self.tables.positions[square]
+
+    def moveFor(self, orig:int, dest:int) -> Move:
+        return self.tables.moves[orig * len(self.squares) + dest]
+
+    def pieceAt(self, square:int):
+        code = self.squares[square]
+        return self.tables.boardPieces[code][square] if code else EMPTY
 
     def get(self, pos:Position):
-        return self.board[pos.row][pos.col]
+        return self.pieceAt(self.square(pos))
+
+    @property
+    def pieces(self) -> List[BoardPiece]:
+        """ All pieces in the board, sorted by piece, color and position """
+        squares = self.squares
+        occupied = [sq for sq in range(len(squares)) if squares[sq]]
+        occupied.sort(key=lambda sq: codeOrder(squares[sq]) * len(squares) + sq)
+        return [self.pieceAt(sq) for sq in occupied]
 
     def add(self, piece:Piece, color:Color, pos:Position):
         bp = BoardPiece(piece, color, pos)
         self.addPiece(bp)
 
     def addPiece(self, piece:BoardPiece):
-        if piece in self.pieces:
-            raise Exception(f"Piece {piece} already in board")
-        self.pieces.append(piece)
-        self.board[piece.pos.row][piece.pos.col] = piece
-        # keep pieces always sorted
-        self.pieces.sort(key=lambda p:p.piece.value * 1000 + p.color.value * 100 + p.pos.row * 10 + p.pos.col)
-        self.onBoardChanged()
-
-    def onBoardChanged(self):
-        if self.updateOnChange:
-            self.remakePossibleMoves()
+        sq = self.square(piece.pos)
+        if self.squares[sq]:
+            raise Exception(f"Piece {piece} already in board" if self.pieceAt(sq) == piece else f"Position {piece.pos} is not empty")
+        code = pieceCode(piece.piece, piece.color)
+        self.squares[sq] = code
+        self.zobrist ^= self.zobristKeys[code][sq]
+        self.onBoardChanged(1 << sq, (code,))
+
+    def onBoardChanged(self, changed:int, codes):
+        """ Drop the cached moves that were built from any of the squares in the 'changed' bitmask.
+            Kings also depend on every square threatened by the other color, so they are dropped
+            as well whenever a piece of the other color (one of the square 'codes') was added, removed or moved.
+            Returns the dropped entries as (square, destinations, attacks, dependencies)
+            """
+        moveDeps = self.moveDeps
+        stale = [sq for (sq, deps) in moveDeps.items() if deps & changed]
+        for king in self.threatenedKings(codes):
+            if king in moveDeps and king not in stale:
+                stale.append(king)
+        self.attackMaps = {}
+        return [(sq, self.pMoves.pop(sq), self.pAttacks.pop(sq, None), moveDeps.pop(sq)) for sq in stale]
+
+    def threatenedKings(self, codes) -> List[int]:
+        """ Squares of the kings of the other color of each of the square 'codes' """
+        kings = []
+        for code in codes:
+            king = self.squares.find(OTHER_KING[code]) if code else -1
+            if king >= 0:
+                kings.append(king)
+        return kings
 
     def isEmpty(self, pos:Position):
-        return not self.get(pos)
+        return not self.squares[self.square(pos)]
 
     def remove(self, pos:Position):
-        piece = self.get(pos)
-        if piece:
-            self.removePiece(piece)
+        sq = self.square(pos)
+        code = self.squares[sq]
+        if code:
+            self.squares[sq] = 0
+            self.zobrist ^= self.zobristKeys[code][sq]
+            self.onBoardChanged(1 << sq, (code,))
 
     def removePiece(self, piece:BoardPiece):
-        self.pieces.remove(piece)
-        self.board[piece.pos.row][piece.pos.col] = EMPTY
-        if piece in self.pMoves:
-            del self.pMoves[piece]
-        self.onBoardChanged()
+        if self.get(piece.pos) != piece:
+            raise ValueError(f"Piece {piece} not in board")
+        self.remove(piece.pos)
 
     def move(self, move:Move):
         """ Will remove any piece at the destination, WITHOUT checking if the move or eat is valid """
-        bPiece = self.get(move.orig)
-        if not bPiece:
+        orig = self.square(move.orig)
+        dest = self.square(move.dest)
+        code = self.squares[orig]
+        if not code:
             return
 
-        self.updateOnChange = False
-        self.remove(move.orig)
-        self.remove(move.dest)
-        self.add(bPiece.piece, bPiece.color, move.dest)
-        self.updateOnChange = True
-        self.onBoardChanged()
+        captured = self.squares[dest]
+        self.squares[orig] = 0
+        self.squares[dest] = code
+        self.zobrist ^= self.moveKey(code, orig, dest, captured)
+        self.onBoardChanged((1 << orig) | (1 << dest), (code, captured))
+
+
+    def makeMove(self, move:Move):
+        """ Play 'move' in place, WITHOUT checking if it is valid. It can be taken back with unmakeMove.
+            The cached moves dropped by the move are kept aside and restored when the move is unmade.
+            Boards with moves pending to be unmade should not be modified with add/remove/move
+            """
+        orig = self.square(move.orig)
+        dest = self.square(move.dest)
+        squares = self.squares
+        code = squares[orig]
+        captured = squares[dest]
+        squares[dest] = code
+        squares[orig] = 0
+        self.zobrist ^= self.moveKey(code, orig, dest, captured)
+        attackMaps = self.attackMaps
+        dropped = self.onBoardChanged((1 << orig) | (1 << dest), (code, captured))
+        self.undoStack.append((orig, dest, captured, dropped, attackMaps, len(self.cachedSquares)))
+
+
+    def unmakeMove(self):
+        """ Take back the last move played with makeMove """
+        (orig, dest, captured, dropped, attackMaps, numCached) = self.undoStack.pop()
+        squares = self.squares
+        code = squares[dest]
+        squares[orig] = code
+        squares[dest] = captured
+        self.zobrist ^= self.moveKey(code, orig, dest, captured)
+        # The moves cached before makeMove and kept by it are still valid, only the ones cached
+        # since then are checked. Those that don't depend on the move are kept too
+        cachedSquares = self.cachedSquares
+        if len(cachedSquares) > numCached:
+            changed = (1 << orig) | (1 << dest)
+            kings = self.threatenedKings((code, captured))
+            moveDeps = self.moveDeps
+            for sq in cachedSquares[numCached:]:
+                deps = moveDeps.get(sq)
+                if deps is not None and (deps & changed or sq in kings):
+                    del self.pMoves[sq]
+                    self.pAttacks.pop(sq, None)
+                    del moveDeps[sq]
+            del cachedSquares[numCached:]
+        for (sq, dests, attacks, deps) in dropped:
+            self.pMoves[sq] = dests
+            self.moveDeps[sq] = deps
+            if attacks is not None:
+                self.pAttacks[sq] = attacks
+        self.attackMaps = attackMaps
+
+
+    def moveKey(self, code:int, orig:int, dest:int, captured:int) -> int:
+        """ What changes in the zobrist hash when the piece 'code' moves from 'orig' to 'dest', eating 'captured' """
+        keys = self.zobristKeys
+        return keys[code][orig] ^ keys[code][dest] ^ keys[captured][dest]
 
 
     def getKing(self, color:Color):
         """ returns None if there is no king of that color """
-        for bp in self.pieces:
-            if bp.piece is Piece.King and bp.color is color:
-                return bp
-        return None
+        sq = self.squares.find(pieceCode(Piece.King, color))
+        return None if sq < 0 else self.pieceAt(sq)
 
 
     def validPos(self, pos:Position):
@@ -148,15 +366,13 @@ class Board:
 
     def __str__(self):
         PIECES = "·♙♗♘♖♕♔·♟♝♞♜♛♚"
-        str = "+----+\n"
-        for row in self.board:
-            str = str + "|"
-            for piece in row:
-                index = 0 if not piece else piece.piece.value + piece.color.value
-                str = str + PIECES[index]
-            str = str + "|\n"
-        str = str + "+----+"
-        return str
+        border = "+" + "-" * self.size + "+"
+        rows = [border]
+        for row in range(self.size):
+            codes = self.squares[row * self.size:(row + 1) * self.size]
+            rows.append("|" + "".join(PIECES[code] for code in codes) + "|")
+        rows.append(border)
+        return "\n".join(rows)
 
 
     def validDest(self, pos:Position):
@@ -175,104 +391,151 @@ class Board:
     
 
     def validSurroundings(self, pos:Position):
-        ab = pos.above()
-        be = pos.below()
-        potential = [ab.left(), ab, ab.right(),
-                    pos.left(),    pos.right(),
-                     be.left(), be, be.right()]
+        return [self.position(sq) for sq in self.surroundings(self.square(pos))]
+
+
+    def surroundings(self, square:int):
+        """ Valid squares around 'square' """
+        return self.tables.kingNeighbours[square]
 
-        return list(filter(self.validPos, potential))
-  
 
     def isThreatened(self, pos:Position, color:Color):
         """ Is this position threatened by a piece of color 'color'? """
+        return self.isSquareThreatened(self.square(pos), color)
+
+
+    def isSquareThreatened(self, square:int, color:Color):
+        return bool(self.attackMap(color) >> square & 1)
+
+
+    def attackMap(self, color:Color) -> int:
+        """ Bitmask of the squares attacked by the pieces of color 'color' """
+        attacks = self.attackMaps.get(color)
+        if attacks is None:
+            (attacks, _) = self.threats(color)
+            self.attackMaps[color] = attacks
+        return attacks
+
+
+    def threats(self, color:Color, lifted:int = -1) -> Tuple[int, int]:
+        """ Bitmask of the squares attacked by the pieces of color 'color', and bitmask of the squares that were looked at.
+            'lifted' is a square that has been temporarily emptied, cached attacks built from it are not used
+            """
+        squares = self.squares
+        liftedMask = 1 << lifted if lifted >= 0 else 0
+        attacks = 0
+        deps = 0
+        for sq in range(len(squares)):
+            code = squares[sq]
+            if CODE_COLOR[code] is not color:
+                continue
+            if CODE_PIECE[code] is Piece.King:
+                # Kings attack their surroundings, no need to generate their (recursive) moves
+                attacks |= self.tables.kingMasks[sq]
+                deps |= 1 << sq
+                continue
+
+            if sq in self.pMoves and not self.moveDeps[sq] & liftedMask:
+                (pieceAttacks, pieceDeps) = (self.pAttacks[sq], self.moveDeps[sq])
+            else:
+                (dests, pieceAttacks, pieceDeps) = self.movesFrom(sq)
+                if not pieceDeps & liftedMask:
+                    self.pMoves[sq] = dests
+                    self.pAttacks[sq] = pieceAttacks
+                    self.moveDeps[sq] = pieceDeps
+                    if self.undoStack:
+                        self.cachedSquares.append(sq)
+            attacks |= pieceAttacks
+            deps |= pieceDeps
+
+        return (attacks, deps)
+
 
-        for (piece, moves) in self.pMoves.items():
-            if piece.color is color:
-                for m in moves:
-                    if m.dest == pos:
-                        return True
-
-        return False
-
-
-        # Check pawns
-        pawnPreviousRow = pos.below() if color == Color.White else pos.above()
-        for pp in [pawnPreviousRow.left(), pawnPreviousRow.right()]:
-            if self.validPos(pp):
-                bp = self.get(pp)
-                if bp and bp.piece is Piece.Pawn and bp.color is color:
-                    return True
-
-        # Check Rooks
-        for moveFunction in [lambda x:x.left(), lambda x:x.right(), lambda x:x.above(), lambda x:x.below()]:
-            current = moveFunction(pos)
-            while self.validPos(current) and self.isEmpty(current):
-                current = moveFunction(current)
-
-            if self.validPos(current):
-                bp = self.get(current)
-                if bp and bp.piece is Piece.Rook and bp.color is color:
-                    return True
-
-        # Check King
-        for c in self.validSurroundings(pos):
-            bp = self.get(c)
-            if bp and bp.piece is Piece.King and bp.color is color:
-                return True
-
-        return False
-        
-   
     def possibleMoves(self, piece:BoardPiece):
         """ Where could the piece at 'pos' move to?
             In the case of a king, it will only return squares
             that are not threatened by the other color
             """
-        if piece in self.pMoves:
-            return self.pMoves[piece]
-
-        prevUpdateOnChange = self.updateOnChange
-        self.updateOnChange = False
-        moves = []
-        match piece.piece:
+        orig = self.square(piece.pos)
+        moves = self.tables.moves
+        first = orig * len(self.squares)
+        return [moves[first + dest] for dest in self.destinations(orig)]
+
+
+    def destinations(self, orig:int) -> List[int]:
+        """ Destination squares for the piece in the square 'orig', generated only when they are not cached """
+        if orig not in self.pMoves:
+            (dests, attacks, deps) = self.movesFrom(orig)
+            self.pMoves[orig] = dests
+            self.moveDeps[orig] = deps
+            if attacks is not None:
+                self.pAttacks[orig] = attacks
+            if self.undoStack:
+                self.cachedSquares.append(orig)
+        return self.pMoves[orig]
+
+
+    def movesFrom(self, orig:int) -> Tuple[List[int], int, int]:
+        """ Destination squares for the piece in the square 'orig', the bitmask of squares it attacks
+            and the bitmask of the squares they depend on. Kings don't report their attacks (None),
+            they are always their surroundings
+            """
+        self.moveGenerations += 1
+        squares = self.squares
+        tables = self.tables
+        code = squares[orig]
+        color = CODE_COLOR[code]
+        piece = CODE_PIECE[code]
+        dests = []
+        attacks = 0
+        deps = 1 << orig
+        match piece:
             case Piece.Pawn: # Pawn
-                advance = piece.pawnAdvance()
-                if (self.validDest(advance)):
-                    moves.append(advance)
-
-                for eat_move in piece.pawnEatMoves():
-                    if self.validEat(eat_move, piece):
-                        moves.append(eat_move)
-
-            case Piece.Rook: # Rook
-                for moveFunction in piece.rookMoveFunctions():
-                    current = moveFunction(piece.pos)
-                    # move
-                    while self.validDest(current):
-                        moves.append(current)
-                        current = moveFunction(current)
-
-                    # eat
-                    if self.validEat(current, piece):
-                        moves.append(current)
+                advance = tables.pawnAdvance[color][orig]
+                if advance >= 0:
+                    deps |= 1 << advance
+                    if not squares[advance]:
+                        dests.append(advance)
+                # pawns attack their diagonals even if they can't move there
+                for eat in tables.pawnAttacks[color][orig]:
+                    attacks |= 1 << eat
+                    if squares[eat] and CODE_COLOR[squares[eat]] is not color:
+                        dests.append(eat)
+                deps |= attacks
+
+            case Piece.Knight: # Knight
+                for dest in tables.knightJumps[orig]:
+                    attacks |= 1 << dest
+                    if CODE_COLOR[squares[dest]] is not color:
+                        dests.append(dest)
+                deps |= attacks
+
+            case Piece.Bishop | Piece.Rook | Piece.Queen:
+                rays = tables.rays[orig]
+                for direction in RAY_DIRECTIONS[piece]:
+                    for dest in rays[direction]:
+                        attacks |= 1 << dest
+                        if squares[dest]:
+                            # eat
+                            if CODE_COLOR[squares[dest]] is not color:
+                                dests.append(dest)
+                            break
+                        dests.append(dest)
+                deps |= attacks
 
             case Piece.King: # King
+                attacks = None
                 # Temporarily remove the king from its current position so that it doesn't block potential threats
-                self.remove(piece.pos)
-
-                potential = self.validSurroundings(piece.pos)
-                for c in potential:
-                    if not self.isThreatened(c, piece.color.other()) and (self.validEat(c, piece) or self.validDest(c)):
-                        moves.append(c)
-
+                squares[orig] = 0
+                (threatened, threatDeps) = self.threats(color.other(), orig)
+                deps |= threatDeps | tables.kingMasks[orig]
+                for dest in tables.kingNeighbours[orig]:
+                    if CODE_COLOR[squares[dest]] is not color and not threatened >> dest & 1:
+                        dests.append(dest)
                 # Restore the king to is position
-                self.addPiece(piece)
+                squares[orig] = code
 
-        # Create proper Move from the resulting posinates
-        self.pMoves[piece] = list(map(lambda m: Move(piece.pos, m), moves))
-        self.updateOnChange = prevUpdateOnChange
-        return self.pMoves[piece]
+        return (dests, attacks, deps)
 
 
     def allPiecesFrom(self, color:Color) -> List[BoardPiece]:
@@ -300,25 +563,44 @@ class Board:
         # Return only moves where the king is not checked
         validMoves = []
         for move in moves:
-            b = self.cloneMove(move)
-            if not b.isChecked(color):
+            self.makeMove(move)
+            if not self.isChecked(color):
                 validMoves.append(move)
+            self.unmakeMove()
 
         return validMoves
 
 
     def clone(self):
-        """ Return a clone of the board """
-        newBoard = Board(self.size)
+        """ Return a clone of the board. The cached moves are shared, they are never modified in place """
+        newBoard = Board.__new__(Board)
+        newBoard.size = self.size
+        newBoard.zobristKeys = self.zobristKeys
+        newBoard.tables = self.tables
+        newBoard.zobrist = self.zobrist
+        newBoard.squares = self.squares[:]
+        newBoard.pMoves = dict(self.pMoves)
+        newBoard.pAttacks = dict(self.pAttacks)
+        newBoard.moveDeps = dict(self.moveDeps)
+        newBoard.attackMaps = dict(self.attackMaps)
+        newBoard.undoStack = []
+        newBoard.cachedSquares = []
+        newBoard.moveGenerations = 0
+        return newBoard
 
-        newBoard.updateOnChange = False
-        for piece in self.pieces:
-            np = BoardPiece(piece.piece, piece.color, piece.pos)
-            newBoard.addPiece(np)
 
-        newBoard.updateOnChange = True
-        newBoard.onBoardChanged()
-        return newBoard
+    def __getstate__(self):
+        """ The tables shared by all boards of the same size are not pickled, they are looked up again when unpickling """
+        state = self.__dict__.copy()
+        del state["tables"]
+        del state["zobristKeys"]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tables = moveTables(self.size)
+        self.zobristKeys = zobristKeys(self.size)
 
 
     def cloneMove(self, move:Move):
@@ -0,0 +1,99 @@
+import unittest
+from itertools import permutations
+
+from chess import Color, Piece, Board, Position, Move
+from chessrl import BoardState
+
+
+def destinations(board:Board, pos:Position):
+    return {move.dest for move in board.possibleMoves(board.get(pos))}
+
+
+class AttackMapTest(unittest.TestCase):
+    def testPawnsAttackEmptyDiagonals(self):
+        board = Board(5)
+        board.add(Piece.Pawn, Color.White, Position(3, 2))
+        self.assertTrue(board.isThreatened(Position(2, 1), Color.White))
+        self.assertTrue(board.isThreatened(Position(2, 3), Color.White))
+        # the square in front is a move, not an attack
+        self.assertFalse(board.isThreatened(Position(2, 2), Color.White))
+        self.assertNotIn(Position(2, 1), destinations(board, Position(3, 2)))
+
+    def testKingAvoidsEmptySquaresAttackedByPawns(self):
+        board = Board(5)
+        board.add(Piece.King, Color.Black, Position(1, 1))
+        board.add(Piece.Pawn, Color.White, Position(3, 2))
+        dests = destinations(board, Position(1, 1))
+        self.assertNotIn(Position(2, 1), dests)
+        self.assertNotIn(Position(2, 3), dests)
+        self.assertIn(Position(2, 2), dests)
+
+    def testKingCantTakeDefendedPiece(self):
+        board = Board(5)
+        board.add(Piece.King, Color.Black, Position(0, 0))
+        board.add(Piece.Knight, Color.White, Position(1, 1))
+        board.add(Piece.Pawn, Color.White, Position(2, 2))
+        self.assertNotIn(Position(1, 1), destinations(board, Position(0, 0)))
+
+    def testKingTakesUndefendedPiece(self):
+        board = Board(5)
+        board.add(Piece.King, Color.Black, Position(0, 0))
+        board.add(Piece.Knight, Color.White, Position(1, 1))
+        self.assertIn(Position(1, 1), destinations(board, Position(0, 0)))
+
+    def testAttackMapFollowsMoves(self):
+        board = Board(5)
+        board.add(Piece.King, Color.Black, Position(0, 0))
+        board.add(Piece.Pawn, Color.White, Position(3, 2))
+        self.assertFalse(board.isThreatened(Position(1, 1), Color.White))
+        board.move(Move(Position(3, 2), Position(2, 2)))
+        self.assertTrue(board.isThreatened(Position(1, 1), Color.White))
+        self.assertNotIn(Position(1, 1), destinations(board, Position(0, 0)))
+
+
+class ZobristTest(unittest.TestCase):
+    MATERIAL = [(Piece.Pawn, Color.White), (Piece.Rook, Color.White), (Piece.Pawn, Color.Black), (Piece.King, Color.Black)]
+
+    def testNoKeyCollisions(self):
+        """ Every placement of the training material on a 4x4 board gets its own key """
+        size = 4
+        keys = {}
+        for squares in permutations(range(size * size), len(self.MATERIAL)):
+            board = Board(size)
+            for ((piece, color), sq) in zip(self.MATERIAL, squares):
+                board.add(piece, color, Position(sq // size, sq % size))
+            other = keys.setdefault(board.zobrist, bytes(board.squares))
+            self.assertEqual(other, bytes(board.squares))
+        self.assertEqual(len(keys), 43680)
+
+    def testIncrementalKeyMatchesRebuilt(self):
+        board = self.board()
+        board.move(Move(Position(3, 1), Position(1, 1)))
+        board.makeMove(Move(Position(0, 3), Position(0, 2)))
+        rebuilt = Board(4)
+        for piece in board.pieces:
+            rebuilt.addPiece(piece)
+        self.assertEqual(board.zobrist, rebuilt.zobrist)
+        board.unmakeMove()
+        self.assertNotEqual(board.zobrist, rebuilt.zobrist)
+
+    def testTranspositionsAreTheSameState(self):
+        (rookMove, kingMove) = (Move(Position(3, 1), Position(2, 1)), Move(Position(0, 3), Position(0, 2)))
+        first = BoardState(self.board()).after(rookMove).after(kingMove)
+        second = BoardState(self.board()).after(kingMove).after(rookMove)
+        self.assertIsNot(first.board, second.board)
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertEqual(first.key(), second.key())
+        self.assertEqual({first: 1}.get(second), 1)
+        self.assertNotEqual(first, BoardState(self.board()))
+
+    def board(self) -> Board:
+        board = Board(4)
+        for ((piece, color), pos) in zip(self.MATERIAL, (Position(3, 3), Position(3, 1), Position(1, 3), Position(0, 3))):
+            board.add(piece, color, pos)
+        return board
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,226 @@
+""" Many chess boards of the same size, stored as one NumPy array and processed together.
+
+    Uses the same square codes (piece.value + color.value) and the same MoveTables as chess.Board,
+    so the piece rules are the ones in Board.movesFrom, only applied to all boards at once
+    """
+from typing import List, Tuple
+from math import isqrt
+import numpy as np
+
+from chess import Color, Piece, Board, MoveTables, moveTables, pieceCode, RAY_DIRECTIONS
+
+
+def encodeBoards(boards:List[Board]) -> np.ndarray:
+    """ The packed encoding (chessrl.encodeBoard) of every board, as a (boards x squares) uint8 array """
+    return np.array([np.frombuffer(board.squares, dtype=np.uint8) for board in boards]).reshape(len(boards), -1)
+
+def decodeBoards(encoded:np.ndarray) -> List[Board]:
+    size = isqrt(encoded.shape[1])
+    return [BoardBatch(size, encoded).board(i) for i in range(len(encoded))]
+
+def encodeMoves(origs:np.ndarray, dests:np.ndarray, size:int) -> np.ndarray:
+    """ The packed encoding (chessrl.encodeMove) of the moves origs[i] -> dests[i], given as square indexes """
+    origs = np.asarray(origs, dtype=np.uint32)
+    dests = np.asarray(dests, dtype=np.uint32)
+    return (origs // size) | ((origs % size) << 8) | ((dests // size) << 16) | ((dests % size) << 24)
+
+def decodeMoves(codes:np.ndarray, size:int) -> Tuple[np.ndarray, np.ndarray]:
+    """ (origs, dests) square indexes of packed moves """
+    codes = np.asarray(codes, dtype=np.uint32)
+    origs = (codes & 0xFF) * size + ((codes >> 8) & 0xFF)
+    dests = ((codes >> 16) & 0xFF) * size + (codes >> 24)
+    return (origs.astype(np.int64), dests.astype(np.int64))
+
+
+class BatchTables:
+    """ MoveTables of a board size as NumPy arrays """
+    # rays[direction, square, step]: square reached after step+1 steps, -1 past the edge of the board
+    rays: np.ndarray
+    # knight[orig, dest], king[orig, dest] and pawnAttacks[color][orig, dest] are True for reachable squares
+    knight: np.ndarray
+    king: np.ndarray
+    pawnAttacks: dict
+    # pawnAdvance[color][square] is -1 for pawns in the last row
+    pawnAdvance: dict
+
+    def __init__(self, tables:MoveTables):
+        size = tables.size
+        numSquares = size * size
+        self.rays = np.full((8, numSquares, max(1, size - 1)), -1, dtype=np.int64)
+        for sq in range(numSquares):
+            for (direction, ray) in enumerate(tables.rays[sq]):
+                self.rays[direction, sq, :len(ray)] = ray
+        self.knight = self.reachable(tables.knightJumps, numSquares)
+        self.king = self.reachable(tables.kingNeighbours, numSquares)
+        self.pawnAttacks = {color: self.reachable(tables.pawnAttacks[color], numSquares) for color in Color}
+        self.pawnAdvance = {color: np.array(tables.pawnAdvance[color], dtype=np.int64) for color in Color}
+
+    @staticmethod
+    def reachable(targets, numSquares:int) -> np.ndarray:
+        matrix = np.zeros((numSquares, numSquares), dtype=bool)
+        for (sq, dests) in enumerate(targets):
+            matrix[sq, list(dests)] = True
+        return matrix
+
+
+class BoardBatch:
+    """ N boards of the same size. squares[i] holds the square codes of board i, like Board.squares """
+    squares: np.ndarray
+
+    def __init__(self, size:int, squares:np.ndarray):
+        self.size = size
+        self.numSquares = size * size
+        self.squares = np.asarray(squares, dtype=np.uint8).reshape(-1, self.numSquares)
+        self.tables = BatchTables(moveTables(size))
+
+    @classmethod
+    def fromBoards(cls, boards:List[Board]) -> "BoardBatch":
+        return cls(boards[0].size, encodeBoards(boards))
+
+    def __len__(self):
+        return len(self.squares)
+
+    def board(self, index:int) -> Board:
+        """ A Board with the position of board 'index' """
+        board = Board(self.size)
+        for (sq, code) in enumerate(self.squares[index]):
+            if code:
+                board.addPiece(board.tables.boardPieces[code][sq])
+        return board
+
+    @staticmethod
+    def colorMask(squares:np.ndarray, color:Color) -> np.ndarray:
+        """ Which squares hold a piece of color 'color' """
+        first = pieceCode(Piece.Pawn, color)
+        return (squares >= first) & (squares <= pieceCode(Piece.King, color))
+
+    def walkRay(self, sliders:np.ndarray, occupied:np.ndarray, direction:int):
+        """ Follow the ray 'direction' from every square flagged in 'sliders' (boards x squares) until it is blocked.
+            Yields (origins, targets, reached) per step: reached[b, i] is True when the ray from origins[i]
+            in board b gets to targets[i]
+            """
+        rays = self.tables.rays[direction]
+        open = sliders.copy()
+        for step in range(rays.shape[1]):
+            targets = rays[:, step]
+            valid = targets >= 0
+            if not valid.any():
+                break
+            origins = np.nonzero(valid)[0]
+            targets = targets[valid]
+            reached = open[:, origins]
+            yield (origins, targets, reached)
+            open[:, ~valid] = False
+            open[:, origins] = reached & ~occupied[:, targets]
+
+    def sliders(self, squares:np.ndarray, color:Color, direction:int) -> np.ndarray:
+        """ Squares with a piece of color 'color' that moves along the ray 'direction' """
+        slides = np.zeros(squares.shape, dtype=bool)
+        for (piece, directions) in RAY_DIRECTIONS.items():
+            if direction in directions:
+                slides |= squares == pieceCode(piece, color)
+        return slides
+
+    def attacks(self, color:Color, squares:np.ndarray = None) -> np.ndarray:
+        """ attacks[b, sq] is True when square sq of board b is attacked by a piece of color 'color' """
+        squares = self.squares if squares is None else squares
+        tables = self.tables
+        occupied = squares != 0
+        attacked = np.zeros(squares.shape, dtype=bool)
+        for (piece, matrix) in ((Piece.Pawn, tables.pawnAttacks[color]), (Piece.Knight, tables.knight), (Piece.King, tables.king)):
+            present = squares == pieceCode(piece, color)
+            if present.any():
+                attacked |= (present.astype(np.uint8) @ matrix.astype(np.uint8)) > 0
+
+        for direction in range(8):
+            sliders = self.sliders(squares, color, direction)
+            if sliders.any():
+                for (_, targets, reached) in self.walkRay(sliders, occupied, direction):
+                    attacked[:, targets] |= reached
+        return attacked
+
+    def pseudoLegalMoves(self, color:Color, squares:np.ndarray = None) -> np.ndarray:
+        """ moves[b, orig, dest] is True when the piece at orig can move to dest in board b, ignoring king safety """
+        squares = self.squares if squares is None else squares
+        tables = self.tables
+        occupied = squares != 0
+        own = self.colorMask(squares, color)
+        enemy = self.colorMask(squares, color.other())
+        moves = np.zeros((len(squares), self.numSquares, self.numSquares), dtype=bool)
+
+        pawns = squares == pieceCode(Piece.Pawn, color)
+        advance = tables.pawnAdvance[color]
+        origins = np.nonzero(advance >= 0)[0]
+        moves[:, origins, advance[origins]] = pawns[:, origins] & ~occupied[:, advance[origins]]
+        moves |= pawns[:, :, None] & tables.pawnAttacks[color][None] & enemy[:, None, :]
+
+        for (piece, matrix) in ((Piece.Knight, tables.knight), (Piece.King, tables.king)):
+            present = squares == pieceCode(piece, color)
+            moves |= present[:, :, None] & matrix[None] & ~own[:, None, :]
+
+        for direction in range(8):
+            sliders = self.sliders(squares, color, direction)
+            if sliders.any():
+                for (origins, targets, reached) in self.walkRay(sliders, occupied, direction):
+                    moves[:, origins, targets] |= reached & ~own[:, targets]
+        return moves
+
+    def kingSquares(self, color:Color, squares:np.ndarray = None) -> np.ndarray:
+        """ Square of the king of color 'color' in each board, -1 when there is none """
+        squares = self.squares if squares is None else squares
+        kings = squares == pieceCode(Piece.King, color)
+        return np.where(kings.any(axis=1), kings.argmax(axis=1), -1)
+
+    def checked(self, color:Color, squares:np.ndarray = None) -> np.ndarray:
+        """ Is the king of color 'color' attacked, for each board """
+        squares = self.squares if squares is None else squares
+        kings = self.kingSquares(color, squares)
+        attacked = self.attacks(color.other(), squares)
+        return (kings >= 0) & attacked[np.arange(len(squares)), np.maximum(kings, 0)]
+
+    def legalMoves(self, color:Color) -> np.ndarray:
+        """ moves[b, orig, dest] is True for the moves Board.getAllMovesFor(color) returns in board b """
+        moves = self.pseudoLegalMoves(color)
+        (boards, origs, dests) = np.nonzero(moves)
+        if len(boards):
+            played = self.squares[boards].copy()
+            candidates = np.arange(len(boards))
+            played[candidates, dests] = played[candidates, origs]
+            played[candidates, origs] = 0
+            moves[boards, origs, dests] = ~self.checked(color, played)
+        return moves
+
+    def status(self, color:Color) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ (legal moves, checked, checkmated, no moves) for 'color' in every board.
+            Checkmated follows Board.isCheckMated: the king is attacked and has no moves
+            """
+        moves = self.legalMoves(color)
+        checked = self.checked(color)
+        kings = self.kingSquares(color)
+        kingMoves = moves[np.arange(len(self)), np.maximum(kings, 0)].any(axis=1)
+        noMoves = ~moves.any(axis=(1, 2))
+        return (moves, checked, checked & ~kingMoves, noMoves)
+
+    def endStates(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ (win, lose) for White in every board, like BoardState.isWin and BoardState.isLose """
+        win = self.status(Color.Black)[2]
+        lose = self.status(Color.White)[3]
+        return (win, lose)
+
+    def randomMoves(self, moves:np.ndarray, rng:np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+        """ A random move (orig, dest) per board among the ones flagged in 'moves', (-1, -1) when there is none """
+        flat = moves.reshape(len(moves), -1)
+        scores = np.where(flat, rng.random(flat.shape), -1.0)
+        choice = scores.argmax(axis=1)
+        hasMove = flat.any(axis=1)
+        origs = np.where(hasMove, choice // self.numSquares, -1)
+        dests = np.where(hasMove, choice % self.numSquares, -1)
+        return (origs, dests)
+
+    def play(self, origs:np.ndarray, dests:np.ndarray):
+        """ Play the move origs[b] -> dests[b] in every board b, in place. Boards with orig -1 are left as they are """
+        boards = np.nonzero(origs >= 0)[0]
+        origs = origs[boards]
+        dests = dests[boards]
+        self.squares[boards, dests] = self.squares[boards, origs]
+        self.squares[boards, origs] = 0
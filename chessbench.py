@@ -0,0 +1,590 @@
+""" Perft and benchmarks for chess.Board.
+
+    python chessbench.py                          # every suite, human readable
+    python chessbench.py --suite perft --depth 5  # perft only, checked against the stored node counts
+    python chessbench.py --json results.json      # also write the results as JSON ('-' for stdout)
+    python chessbench.py --board mymodule.MyBoard # benchmark another Board implementation
+
+    Exits with status 1 when a perft count doesn't match the stored one
+    """
+import argparse
+import contextlib
+import importlib
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from itertools import permutations
+
+from chess import Color, Piece, Board, Position
+from chessrl import BoardState, ChessEnvironment, PositionCache
+from rl import QMemory
+
+# The Board implementation being benchmarked, see --board
+BoardClass = Board
+
+
+def trainBoard() -> Board:
+    """ The 4x4 setup used by train.py """
+    board = BoardClass(4)
+    board.add(Piece.Pawn, Color.White, Position(3,3))
+    board.add(Piece.Rook, Color.White, Position(3,1))
+    board.add(Piece.Pawn, Color.Black, Position(1,3))
+    board.add(Piece.King, Color.Black, Position(0,3))
+    return board
+
+
+def middleBoard() -> Board:
+    """ A 6x6 board with both kings, rooks and pawns """
+    board = BoardClass(6)
+    board.add(Piece.King, Color.White, Position(5,3))
+    board.add(Piece.Rook, Color.White, Position(5,0))
+    board.add(Piece.Rook, Color.White, Position(4,5))
+    for col in (1, 2, 4):
+        board.add(Piece.Pawn, Color.White, Position(4,col))
+        board.add(Piece.Pawn, Color.Black, Position(1,col))
+    board.add(Piece.King, Color.Black, Position(0,2))
+    board.add(Piece.Rook, Color.Black, Position(0,5))
+    return board
+
+
+def kqkBoard() -> Board:
+    board = BoardClass(5)
+    board.add(Piece.King, Color.White, Position(4,2))
+    board.add(Piece.Queen, Color.White, Position(3,0))
+    board.add(Piece.King, Color.Black, Position(0,2))
+    return board
+
+
+def kbnkBoard() -> Board:
+    board = BoardClass(6)
+    board.add(Piece.King, Color.White, Position(5,3))
+    board.add(Piece.Bishop, Color.White, Position(5,2))
+    board.add(Piece.Knight, Color.White, Position(5,1))
+    board.add(Piece.King, Color.Black, Position(0,2))
+    return board
+
+
+BOARDS = {
+    "train4x4": trainBoard,
+    "middle6x6": middleBoard,
+    "kqk5x5": kqkBoard,
+    "kbnk6x6": kbnkBoard,
+}
+
+# Leaf nodes at depth 1, 2, ... with White to move, checked against an independent brute force generator
+PERFT_COUNTS = {
+    "train4x4": (6, 11, 68, 203, 1078, 3409),
+    "middle6x6": (18, 191, 3151, 35068),
+    "kqk5x5": (17, 44, 677, 2240, 34359),
+    "kbnk6x6": (12, 52, 694, 3996, 55935),
+}
+
+
+def perft(board:Board, color:Color, depth:int) -> int:
+    """ Number of leaf nodes of the legal move tree of 'board', 'depth' moves deep, with 'color' to move """
+    if depth == 0:
+        return 1
+    moves = board.getAllMovesFor(color)
+    if depth == 1:
+        return len(moves)
+
+    nodes = 0
+    for move in moves:
+        board.makeMove(move)
+        nodes = nodes + perft(board, color.other(), depth - 1)
+        board.unmakeMove()
+    return nodes
+
+
+def benchPerft(names, maxDepth:int):
+    print("Perft (White to move)")
+    results = []
+    for name in names:
+        expected = PERFT_COUNTS.get(name, ())
+        for depth in range(1, maxDepth + 1):
+            board = BOARDS[name]()
+            start = time.perf_counter()
+            nodes = perft(board, Color.White, depth)
+            seconds = time.perf_counter() - start
+            expectedNodes = expected[depth - 1] if depth <= len(expected) else None
+            ok = expectedNodes is None or nodes == expectedNodes
+            results.append({"position": name, "depth": depth, "nodes": nodes, "expected": expectedNodes, "ok": ok,
+                            "seconds": seconds, "nodesPerSecond": nodes / seconds if seconds else None})
+            status = "ok" if expectedNodes is not None and ok else ("unchecked" if ok else f"EXPECTED {expectedNodes}")
+            print(f"  {name:10} depth {depth}: {nodes:9} nodes {nodes / max(seconds, 1e-9):12.0f} nodes/s  {status}")
+    return results
+
+
+def coldCopy(board:Board) -> Board:
+    """ Same position as 'board', with nothing cached """
+    copy = type(board)(board.size)
+    for piece in board.pieces:
+        copy.addPiece(piece)
+    return copy
+
+
+def treePositions(board:Board, color:Color, depth:int):
+    """ Every (board, color to move) in the legal move tree of 'board', up to 'depth' moves deep """
+    positions = [(board.clone(), color)]
+    if depth > 0:
+        for move in board.getAllMovesFor(color):
+            board.makeMove(move)
+            positions.extend(treePositions(board, color.other(), depth - 1))
+            board.unmakeMove()
+    return positions
+
+
+def firstMoveClone(board:Board, color:Color):
+    moves = board.getAllMovesFor(color)
+    return board.cloneMove(moves[0]) if moves else None
+
+
+OPERATIONS = {
+    "getAllMovesFor": lambda board, color: board.getAllMovesFor(color),
+    "clone": lambda board, color: board.clone(),
+    "cloneMove": firstMoveClone,
+    "isCheckMated": lambda board, color: board.isCheckMated(color),
+    "isThreatened": lambda board, color: board.isThreatened(Position(0, 0), color.other()),
+}
+
+
+def benchOperations(names, depth:int, cold = True):
+    """ Calls per second of each Board operation over the positions of a perft tree.
+        With 'cold', every call is made on a copy of the position with nothing cached
+        """
+    print(f"Board operations over the perft tree positions, depth {depth} ({'cold' if cold else 'warm'} caches)")
+    results = []
+    for name in names:
+        positions = treePositions(BOARDS[name](), Color.White, depth)
+        for (operation, function) in OPERATIONS.items():
+            boards = [(coldCopy(board) if cold else board, color) for (board, color) in positions]
+            start = time.perf_counter()
+            for (board, color) in boards:
+                function(board, color)
+            seconds = time.perf_counter() - start
+            results.append({"position": name, "operation": operation, "calls": len(boards), "seconds": seconds,
+                            "callsPerSecond": len(boards) / seconds if seconds else None})
+            print(f"  {name:10} {operation:14}: {len(boards) / max(seconds, 1e-9):12.0f} calls/s over {len(boards)} positions")
+    return results
+
+
+def legalMovesByClone(board:Board, color:Color):
+    """ The legality check as it was done before makeMove/unmakeMove: one cloned board per move """
+    moves = []
+    for piece in board.allPiecesFrom(color):
+        moves = moves + board.possibleMoves(piece)
+    return [move for move in moves if not board.cloneMove(move).isChecked(color)]
+
+
+def legalMovesInPlace(board:Board, color:Color):
+    return board.getAllMovesFor(color)
+
+
+def countClones(function, board:Board, *args):
+    """ Number of boards cloned while running function(board, *args) """
+    boardClass = type(board)
+    originalClone = boardClass.clone
+    count = 0
+    def countingClone(board):
+        nonlocal count
+        count = count + 1
+        return originalClone(board)
+
+    boardClass.clone = countingClone
+    try:
+        function(board, *args)
+    finally:
+        boardClass.clone = originalClone
+    return count
+
+
+def peakMemory(function, *args):
+    """ Peak of bytes allocated while running function(*args) """
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def timeIt(function, *args, repeat = 200):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(*args)
+    return (time.perf_counter() - start) / repeat
+
+
+def benchLegalMoves(names):
+    print("Legal move generation: clone per move vs. makeMove/unmakeMove")
+    results = []
+    for name in names:
+        builder = BOARDS[name]
+        for color in Color:
+            board = builder()
+            numMoves = max(1, len(board.getAllMovesFor(color)))
+            for (label, function) in (("clone", legalMovesByClone), ("makeMove", legalMovesInPlace)):
+                board = builder()
+                seconds = timeIt(function, board, color)
+                clones = countClones(function, board, color) / numMoves
+                peak = peakMemory(function, builder(), color) / numMoves
+                results.append({"position": name, "color": color.name, "method": label, "secondsPerCall": seconds,
+                                "clonesPerMove": clones, "peakBytesPerMove": peak})
+                print(f"  {name:10} {color.name:5} {label:8}: {seconds * 1e6:9.1f} us/call"
+                      f" {clones:5.2f} clones/move {peak:8.0f} peak bytes/move")
+    return results
+
+
+def playGame(board:Board, numMoves:int, onMove, seed = 0):
+    """ Play random legal moves with Board.move, calling onMove(board, color) after each one """
+    rng = random.Random(seed)
+    color = Color.White
+    for _ in range(numMoves):
+        moves = board.getAllMovesFor(color)
+        if not moves:
+            break
+        board.move(rng.choice(moves))
+        color = color.other()
+        onMove(board, color)
+
+
+def benchMoveGenerations(names, numMoves = 40):
+    """ How many piece moves are generated for each Board.move, until the side to move knows its legal moves.
+        'eager' regenerates every piece after each change, as Board.onBoardChanged used to do
+        """
+    print("Piece move generations per Board.move: eager vs. incremental")
+    def eager(board, color):
+        board.remakePossibleMoves()
+        board.getAllMovesFor(color)
+    def incremental(board, color):
+        board.getAllMovesFor(color)
+
+    results = []
+    for name in names:
+        for (label, onMove) in (("eager", eager), ("incremental", incremental)):
+            board = BOARDS[name]()
+            board.getAllMovesFor(Color.White)
+            counts = []
+            def countingOnMove(board, color):
+                before = board.moveGenerations
+                onMove(board, color)
+                counts.append(board.moveGenerations - before)
+            playGame(board, numMoves, countingOnMove)
+            perMove = sum(counts) / max(1, len(counts))
+            results.append({"position": name, "method": label, "moves": len(counts), "generationsPerMove": perMove})
+            print(f"  {name:10} {label:11}: {perMove:6.1f} generations/move over {len(counts)} moves")
+    return results
+
+
+def placements(size:int, material):
+    """ Every board of size 'size' with the pieces in 'material' (a list of (Piece, Color)) placed in different squares """
+    for squares in permutations(range(size * size), len(material)):
+        board = BoardClass(size)
+        for ((piece, color), sq) in zip(material, squares):
+            board.add(piece, color, Position(sq // size, sq % size))
+        yield board
+
+
+TRAIN_MATERIAL = [(Piece.Pawn, Color.White), (Piece.Rook, Color.White), (Piece.Pawn, Color.Black), (Piece.King, Color.Black)]
+
+
+def benchZobristCollisions(size = 4, material = TRAIN_MATERIAL):
+    """ Different positions with the same zobrist key, and with the same python hash of that key """
+    positions = set()
+    keys = set()
+    hashes = set()
+    for board in placements(size, material):
+        positions.add(bytes(board.squares))
+        keys.add(board.zobrist)
+        hashes.add(hash(board.zobrist))
+    result = {"positions": len(positions), "keyCollisions": len(positions) - len(keys),
+              "hashCollisions": len(positions) - len(hashes)}
+    print(f"Zobrist collisions over {len(positions)} positions: {result['keyCollisions']} keys,"
+          f" {result['hashCollisions']} hashes")
+    return result
+
+
+class ConstantHashState(BoardState):
+    """ BoardState as it was hashed before zobrist keys """
+    def __hash__(self):
+        return 0
+
+
+def benchStateLookups(numStates = 2000, numLookups = 20000):
+    """ QMemory-style dict lookups of BoardStates """
+    print(f"BoardState dict lookups ({numStates} states)")
+    boards = []
+    for board in placements(4, TRAIN_MATERIAL):
+        boards.append(board)
+        if len(boards) == numStates:
+            break
+    rng = random.Random(0)
+    results = []
+    for stateClass in (ConstantHashState, BoardState):
+        table = {stateClass(board): i for (i, board) in enumerate(boards)}
+        queries = [stateClass(rng.choice(boards)) for _ in range(numLookups)]
+        start = time.perf_counter()
+        for query in queries:
+            table[query]
+        seconds = time.perf_counter() - start
+        results.append({"state": stateClass.__name__, "states": numStates, "lookupsPerSecond": numLookups / seconds})
+        print(f"  {stateClass.__name__:17}: {numLookups / seconds:12.0f} lookups/s")
+    return results
+
+
+def playEpisodes(builder, numEpisodes:int, maxSteps:int, seed = 0):
+    """ Random episodes like Episode.step: end state checks and random actions for White, random replies for Black """
+    rng = random.Random(seed)
+    for _ in range(numEpisodes):
+        env = ChessEnvironment(BoardState(builder()))
+        for _ in range(maxSteps):
+            if env.isEndState():
+                break
+            actions = env.getAllPossibleActions()
+            env.execute(rng.choice(actions))
+            if env.isEndState():
+                break
+            actions = env.getState().getAllPossibleActionsFor(Color.Black)
+            if not actions:
+                break
+            env.execute(rng.choice(actions))
+
+
+def benchPositionCache(names, numEpisodes = 200, maxSteps = 20):
+    """ Random episodes with the position cache disabled and enabled """
+    print(f"{numEpisodes} random episodes of up to {maxSteps} steps: no position cache vs. PositionCache")
+    results = []
+    default = BoardState.cache
+    try:
+        for name in names:
+            timings = {}
+            for capacity in (0, default.capacity):
+                BoardState.cache = PositionCache(capacity)
+                start = time.perf_counter()
+                playEpisodes(BOARDS[name], numEpisodes, maxSteps)
+                timings[capacity] = time.perf_counter() - start
+            stats = BoardState.cache.stats()
+            results.append({"position": name, "episodes": numEpisodes, "uncachedSeconds": timings[0],
+                            "cachedSeconds": timings[default.capacity], **stats})
+            print(f"  {name:10}: {timings[0]:.3f}s uncached {timings[default.capacity]:.3f}s cached, "
+                  f"{stats['hits']} hits {stats['misses']} misses ({stats['hitRate']:.0%})")
+    finally:
+        BoardState.cache = default
+    return results
+
+
+def eagerStep(state:BoardState, move) -> BoardState:
+    """ An environment step as it used to be: clone with the move played, then clone and encode again in BoardState """
+    newState = BoardState(state.board.cloneMove(move))
+    newState.encoding
+    return newState
+
+
+def lazyStep(state:BoardState, move) -> BoardState:
+    return state.after(move)
+
+
+def stepGame(builder, numSteps:int, step, seed = 0):
+    """ Play random moves for both colors through 'step', a function (state, move) -> new state """
+    rng = random.Random(seed)
+    state = BoardState(builder())
+    color = Color.White
+    for _ in range(numSteps):
+        moves = state.board.getAllMovesFor(color)
+        if not moves:
+            state = BoardState(builder())
+            color = Color.White
+            continue
+        state = step(state, rng.choice(moves))
+        color = color.other()
+
+
+def benchStateAllocations(names, numSteps = 400):
+    """ Boards cloned and bytes allocated per environment step: eager clone and encode vs. copy on write """
+    print(f"BoardState per step ({numSteps} steps): eager clone and encode vs. BoardState.after")
+    results = []
+    for name in names:
+        for step in (eagerStep, lazyStep):
+            clones = countClones(lambda board: stepGame(BOARDS[name], numSteps, step), BOARDS[name]())
+            peak = peakMemory(stepGame, BOARDS[name], numSteps, step)
+            start = time.perf_counter()
+            stepGame(BOARDS[name], numSteps, step)
+            seconds = time.perf_counter() - start
+            results.append({"position": name, "step": step.__name__, "clonesPerStep": clones / numSteps,
+                            "peakBytes": peak, "stepsPerSecond": numSteps / seconds})
+            print(f"  {name:10} {step.__name__:9}: {clones / numSteps:5.2f} clones/step {peak:9d} peak bytes "
+                  f"{numSteps / seconds:8.0f} steps/s")
+    return results
+
+
+def benchQMemoryEntries(numStates = 2000):
+    """ Memory used by each state stored in a QMemory, with every legal action updated once """
+    boards = []
+    for board in placements(4, TRAIN_MATERIAL):
+        boards.append(board)
+        if len(boards) == numStates:
+            break
+
+    qMemory = QMemory()
+    # only the memory kept by the QMemory, not by the position cache
+    default = BoardState.cache
+    BoardState.cache = PositionCache(0)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        numActions = 0
+        for board in boards:
+            state = BoardState(board)
+            for action in state.getAllPossibleActions():
+                qMemory.update(state, action, state, -1)
+                numActions = numActions + 1
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+        BoardState.cache = default
+    result = {"states": len(qMemory.sar), "bytesPerState": used / len(qMemory.sar),
+              "actionsPerState": numActions / len(qMemory.sar)}
+    print(f"QMemory: {result['bytesPerState']:.0f} bytes/state ({result['actionsPerState']:.1f} actions/state)")
+    return result
+
+
+def randomPositions(builder, numBoards:int, maxMoves = 10, seed = 0):
+    """ 'numBoards' boards reached with random legal moves from the position built by 'builder' """
+    rng = random.Random(seed)
+    boards = []
+    for _ in range(numBoards):
+        board = builder()
+        color = Color.White
+        for _ in range(rng.randrange(maxMoves)):
+            moves = board.getAllMovesFor(color)
+            if not moves:
+                break
+            board.move(rng.choice(moves))
+            color = color.other()
+        boards.append(coldCopy(board))
+    return boards
+
+
+def benchBatch(names, numBoards = 500):
+    """ Legal moves, check and checkmate for many boards: one Board at a time vs. one BoardBatch (needs numpy) """
+    from chessbatch import BoardBatch
+
+    print(f"Legal moves, check and checkmate of {numBoards} boards (White): Board loop vs. BoardBatch")
+    results = []
+    for name in names:
+        boards = randomPositions(BOARDS[name], numBoards)
+        start = time.perf_counter()
+        for board in boards:
+            board.getAllMovesFor(Color.White)
+            board.isChecked(Color.White)
+            board.isCheckMated(Color.White)
+        loopSeconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        BoardBatch.fromBoards(boards).status(Color.White)
+        batchSeconds = time.perf_counter() - start
+        results.append({"position": name, "boards": numBoards, "loopBoardsPerSecond": numBoards / loopSeconds,
+                        "batchBoardsPerSecond": numBoards / batchSeconds})
+        print(f"  {name:10}: {numBoards / loopSeconds:10.0f} boards/s loop {numBoards / batchSeconds:10.0f} boards/s batch")
+    return results
+
+
+def benchTablebase(size = 4, material = TRAIN_MATERIAL, numProbes = 20000):
+    """ Solve the train.py material by retrograde analysis, then probe the memory-mapped file (needs numpy) """
+    import os
+    import tempfile
+    from tablebase import generate, save, Tablebase
+
+    start = time.perf_counter()
+    values = generate(size, material)
+    generateSeconds = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.tb")
+        save(path, size, material, values)
+        fileBytes = os.path.getsize(path)
+        tablebase = Tablebase(path)
+        boards = list(placements(size, material))
+        random.Random(0).shuffle(boards)
+        boards = (boards * (numProbes // len(boards) + 1))[:numProbes]
+        start = time.perf_counter()
+        for board in boards:
+            tablebase.probe(board, Color.White)
+        probeSeconds = time.perf_counter() - start
+        tablebase.close()
+
+    print(f"Tablebase {size}x{size} {len(material)} pieces: {len(values)} positions solved in {generateSeconds:.2f}s, "
+          f"{fileBytes} bytes, {numProbes / probeSeconds:.0f} probes/s")
+    return {"positions": len(values), "generateSeconds": generateSeconds, "fileBytes": fileBytes,
+            "probesPerSecond": numProbes / probeSeconds}
+
+
+SUITES = ("perft", "operations", "legal", "generations", "zobrist", "lookups", "qmemory", "batch", "tablebase", "positioncache", "stateallocs")
+
+
+def loadBoardClass(name:str):
+    """ 'module.Class' to the class """
+    (moduleName, className) = name.rsplit(".", 1)
+    return getattr(importlib.import_module(moduleName), className)
+
+
+def main(args = None) -> int:
+    global BoardClass
+    parser = argparse.ArgumentParser(description="Perft and benchmarks for chess.Board")
+    parser.add_argument("--suite", choices=SUITES, action="append", help="suite to run, can be repeated (default: all)")
+    parser.add_argument("--positions", default=",".join(BOARDS), help="comma separated positions: " + ", ".join(BOARDS))
+    parser.add_argument("--depth", type=int, default=4, help="perft depth (default: 4)")
+    parser.add_argument("--ops-depth", type=int, default=2, help="depth of the tree used by the operations suite (default: 2)")
+    parser.add_argument("--board", default="chess.Board", help="Board implementation, as module.Class (default: chess.Board)")
+    parser.add_argument("--json", help="write the results as JSON to this file, '-' for stdout")
+    options = parser.parse_args(args)
+
+    BoardClass = loadBoardClass(options.board)
+    names = options.positions.split(",")
+    suites = options.suite or SUITES
+    results = {
+        "board": options.board,
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    # Keep stdout for the JSON results when they are written there
+    with contextlib.redirect_stdout(sys.stderr if options.json == "-" else sys.stdout):
+        if "perft" in suites:
+            results["perft"] = benchPerft(names, options.depth)
+        if "operations" in suites:
+            results["operations"] = benchOperations(names, options.ops_depth)
+        if "legal" in suites:
+            results["legal"] = benchLegalMoves(names)
+        if "generations" in suites:
+            results["generations"] = benchMoveGenerations(names)
+        if "zobrist" in suites:
+            results["zobrist"] = benchZobristCollisions()
+        if "lookups" in suites:
+            results["lookups"] = benchStateLookups()
+        if "qmemory" in suites:
+            results["qmemory"] = benchQMemoryEntries()
+        if "batch" in suites:
+            results["batch"] = benchBatch(names)
+        if "tablebase" in suites:
+            results["tablebase"] = benchTablebase()
+        if "positioncache" in suites:
+            results["positioncache"] = benchPositionCache(names)
+        if "stateallocs" in suites:
+            results["stateallocs"] = benchStateAllocations(names)
+
+    if options.json == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    elif options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    perftOk = all(result["ok"] for result in results.get("perft", []))
+    zobristOk = not results.get("zobrist", {}).get("keyCollisions")
+    return 0 if perftOk and zobristOk else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
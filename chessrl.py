@@ -1,18 +1,32 @@
 from dataclasses import dataclass
+from collections import OrderedDict
+from functools import lru_cache
+from math import isqrt
 from chess import *
 from rl import *
 
-def encodeMove(move:Move):
-    return move.orig.row  + (move.orig.col << 4) + (move.dest.row << 8) + (move.dest.col << 16)
+# Packed encodings, also used on disk and in batches (see chessbatch.encodeBoards / encodeMoves):
+#   move:  32 bits, one byte per coordinate: orig.row | orig.col << 8 | dest.row << 16 | dest.col << 24
+#   board: size * size bytes, row by row, one square code (piece.value + color.value, 0 = empty) per byte
+
+def encodeMove(move:Move) -> int:
+    return move.orig.row + (move.orig.col << 8) + (move.dest.row << 16) + (move.dest.col << 24)
+
+def decodeMove(code:int) -> Move:
+    return Move(Position(code & 0xFF, (code >> 8) & 0xFF), Position((code >> 16) & 0xFF, code >> 24))
 
 def encodePiece(piece:BoardPiece):
     return piece.piece.value + (piece.color.value << 8) + (piece.pos.row << 16) + (piece.pos.col << 24)
 
-def encodeBoard(board:Board):
-    data = []
-    for piece in board.pieces:
-        data.append(encodePiece(piece))
-    return data
+def encodeBoard(board:Board) -> bytes:
+    return bytes(board.squares)
+
+def decodeBoard(data:bytes) -> Board:
+    board = Board(isqrt(len(data)))
+    for (sq, code) in enumerate(data):
+        if code:
+            board.addPiece(board.tables.boardPieces[code][sq])
+    return board
 
 
 @dataclass
@@ -23,28 +37,130 @@ class BoardAction:
         self.encoding = encodeMove(self.move)
 
     def __hash__(self):
-        return hash((self.move.orig, self.move.dest))
+        return self.encoding
+
+
+@lru_cache(maxsize=None)
+def boardAction(move:Move) -> BoardAction:
+    """ The BoardAction of 'move', shared by every state where it can be played """
+    return BoardAction(move)
+
+
+class PositionInfo:
+    """ What has been computed about a position: legal actions, check and checkmate, per color """
+    __slots__ = ("actions", "checked", "checkMated")
+
+    def __init__(self):
+        self.actions = {}
+        self.checked = {}
+        self.checkMated = {}
+
+
+class PositionCache:
+    """ PositionInfo of the most recently used positions, up to 'capacity' of them (0 disables the cache).
+        Positions are keyed by their squares, so transpositions share an entry
+        """
+    entries: OrderedDict
+
+    def __init__(self, capacity = 100000):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, board:Board) -> PositionInfo:
+        key = bytes(board.squares)
+        info = self.entries.get(key)
+        if info is not None:
+            self.hits = self.hits + 1
+            self.entries.move_to_end(key)
+            return info
+
+        self.misses = self.misses + 1
+        info = PositionInfo()
+        if self.capacity > 0:
+            self.entries[key] = info
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions = self.evictions + 1
+        return info
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "capacity": self.capacity, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hitRate": self.hits / lookups if lookups else 0.0}
 
 
 @dataclass
 class BoardState(State):
+    """ A position, immutable once created. States share their board with nobody that modifies it:
+        a new position gets its own board in 'after'
+        """
     board:Board
-    encoding:List[int]
     boardHash:int
-
-    def __init__(self, board:Board):
-        self.board = board.clone()
-        self.encoding = encodeBoard(self.board)
-        self.boardHash = 0
+    # Shared by every BoardState, replace it to change the capacity
+    cache = PositionCache()
+
+    def __init__(self, board:Board, copy = True):
+        """ With copy=False the state takes ownership of 'board', which must not be modified afterwards """
+        self.board = board.clone() if copy else board
+        self.boardHash = self.board.zobrist
+        self.info = None
+        self.cachedEncoding = None
+
+    @property
+    def encoding(self) -> bytes:
+        if self.cachedEncoding is None:
+            self.cachedEncoding = encodeBoard(self.board)
+        return self.cachedEncoding
+
+    def after(self, move:Move) -> "BoardState":
+        """ The state reached by playing 'move', the only board allocated is the one of the new state """
+        board = self.board.clone()
+        board.move(move)
+        return BoardState(board, copy=False)
+
+    def key(self) -> bytes:
+        return self.encoding
+
+    def __getstate__(self):
+        """ Only the packed board is pickled, the board is decoded again when it is first used """
+        return (self.encoding, self.boardHash)
+
+    def __setstate__(self, state):
+        (self.cachedEncoding, self.boardHash) = state
+        self.info = None
+
+    def __getattr__(self, name:str):
+        # only called for missing attributes: the board of an unpickled state
+        if name == "board" and "cachedEncoding" in self.__dict__:
+            self.board = decodeBoard(self.cachedEncoding)
+            return self.board
+        raise AttributeError(name)
 
     def __hash__(self):
         return self.boardHash
 
+    def __eq__(self, other):
+        return isinstance(other, BoardState) and self.boardHash == other.boardHash and self.encoding == other.encoding
+
     def isEnd(self):
         return self.isWin() or self.isLose()
 
+    def positionInfo(self) -> PositionInfo:
+        if self.info is None:
+            self.info = self.cache.lookup(self.board)
+        return self.info
+
     def isWin(self):
-        return self.board.isCheckMated(Color.Black)
+        return self.isCheckMated(Color.Black)
 
     def isLose(self):
         return not self.getAllPossibleActions()
@@ -53,18 +169,57 @@ class BoardState(State):
         ## TODO: implement stalemate
         return False
 
+    def isChecked(self, color:Color) -> bool:
+        checked = self.positionInfo().checked
+        if color not in checked:
+            checked[color] = self.board.isChecked(color)
+        return checked[color]
+
+    def isCheckMated(self, color:Color) -> bool:
+        checkMated = self.positionInfo().checkMated
+        if color not in checkMated:
+            checkMated[color] = self.isChecked(color) and self.board.isCheckMated(color)
+        return checkMated[color]
+
     def getAllPossibleActionsFor(self, color:Color = Color.White) -> List[Action]:
-        allMoves = self.board.getAllMovesFor(color)
-        # map each move to an action
-        return list(map(lambda m:BoardAction(move=m), allMoves))
+        """ The list is shared with every state of the same position, don't modify it """
+        actions = self.positionInfo().actions
+        if color not in actions:
+            # map each move to an action
+            actions[color] = list(map(boardAction, self.board.getAllMovesFor(color)))
+        return actions[color]
 
     def getAllPossibleActions(self) -> List[Action]:
         return self.getAllPossibleActionsFor(Color.White)
 
+    def probe(self, tablebase, color:Color = Color.White) -> int:
+        """ Tablebase value of this state with 'color' to move (see tablebase.py), None when it is not covered """
+        return tablebase.probe(self.board, color)
+
 
 class ChessEnvironment(Environment):
     state:BoardState
 
-    def doExecute(self, action:BoardAction):
-        newBoard = self.state.board.cloneMove(action.move)
-        self.state = BoardState(newBoard)
+    def __init__(self, state:BoardState, tablebase = None):
+        super().__init__(state)
+        self.tablebase = tablebase
+
+    def bestAction(self, color:Color = Color.Black) -> BoardAction:
+        """ The move of a perfect player for 'color', from the tablebase """
+        move = self.tablebase.bestMove(self.state.board, color)
+        return None if move is None else boardAction(move)
+
+    def isWinState(self) -> bool:
+        return self.state.isWin()
+
+    def isLoseState(self) -> bool:
+        return self.state.isLose()
+
+    def isTieState(self) -> bool:
+        return self.state.isTie()
+
+    def getAllPossibleActions(self) -> List[Action]:
+        return self.state.getAllPossibleActions()
+
+    def getNewState(self, action:BoardAction) -> BoardState:
+        return self.state.after(action.move)
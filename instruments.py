@@ -0,0 +1,88 @@
+""" Where the training time goes: time per phase and counters of Episode.step and Trainer.batchTrain, per batch.
+
+    Off by default, switch it at runtime:
+        INSTRUMENTS.enable()
+        trainer.batchTrain(...)
+        INSTRUMENTS.writeCSV("batches.csv")
+    Off, Episode.step runs its plain loop and only one flag is checked per episode. Episodes played in
+    worker processes (maxProcesses or testProcesses > 1) are counted in the workers, not here.
+    INSTRUMENTS.profile(batch, path) also runs cProfile during one batch and saves its stats to 'path'
+    (read them with pstats)
+    """
+from typing import Dict, List
+from collections import defaultdict
+from contextlib import contextmanager
+import cProfile
+import csv
+import json
+
+
+class Instruments:
+    """ Seconds spent in each phase and counters of the batch being trained, and one row per finished batch """
+    # seconds by phase, since the last endBatch
+    phases: Dict[str, float]
+    counters: Dict[str, int]
+    batches: List[Dict[str, float]]
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.batches = []
+        self.profileBatch = None
+        self.profilePath = None
+
+    def enable(self, enabled = True):
+        self.enabled = enabled
+
+    def reset(self):
+        self.phases.clear()
+        self.counters.clear()
+        self.batches = []
+
+    def profile(self, batch:int, path:str):
+        """ Run cProfile during batch number 'batch' of the next batchTrain, saving the stats to 'path' """
+        self.profileBatch = batch
+        self.profilePath = path
+
+    @contextmanager
+    def profiling(self, batch:int):
+        if batch != self.profileBatch:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(self.profilePath)
+
+    def endBatch(self, batch:int, seconds:float, newStates:int) -> Dict[str, float]:
+        """ Close the batch 'batch', which took 'seconds' and added 'newStates' states to the Q-table """
+        row = {"batch": batch, "seconds": seconds}
+        row.update((f"{phase}Seconds", value) for (phase, value) in sorted(self.phases.items()))
+        row.update(sorted(self.counters.items()))
+        row["newStates"] = newStates
+        for name in ("steps", "episodes", "newStates"):
+            row[f"{name}PerSecond"] = row.get(name, 0) / seconds if seconds else 0.0
+        self.batches.append(row)
+        self.phases.clear()
+        self.counters.clear()
+        return row
+
+    def writeJSON(self, path:str):
+        with open(path, "w") as f:
+            json.dump(self.batches, f, indent=2)
+
+    def writeCSV(self, path:str):
+        # phases and counters that didn't happen in a batch are left empty
+        columns = list({column: None for row in self.batches for column in row})
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, columns)
+            writer.writeheader()
+            writer.writerows(self.batches)
+
+
+# Used by trainer.Episode and trainer.Trainer
+INSTRUMENTS = Instruments()
@@ -0,0 +1,230 @@
+""" Planning with a model of the environment instead of learning it only from episodes.
+
+    For mazes the model is known: GridModel reads it from the Grid transition table, and valueIteration or
+    prioritizedSweeping solve it exactly. solve() writes the result into the Q-table of a Policy, to use it
+    as a baseline or to warm-start Q-learning on large mazes.
+    For any environment, DynaQ learns the model from the episodes played and adds simulated updates to
+    each real one. Use it with Trainer.dynaTrain, or Trainer.batchTrain(dyna=DynaQ(...))
+    """
+from typing import List, Tuple
+import heapq
+import random
+import numpy as np
+
+from rl import Action, State, Policy, QMemory, RecordingPolicy
+from simplerl import DIRECTIONS, GRID_ACTIONS, Grid, GridState, Position
+from vecenv import WIN_REWARD, STEP_REWARD, transitionTable
+
+
+class GridModel:
+    """ Next cell and reward of every (cell, action) of a maze, with the rewards of GridEnvironment.
+        Only the cells from which the end can be reached are planned: with a discount rate of 1 the values
+        of the others would go down forever
+        """
+    table: np.ndarray
+    valid: np.ndarray
+    rewards: np.ndarray
+    terminal: np.ndarray
+    # cells by distance to the end: layers[0] are the cells next to it
+    layers: List[np.ndarray]
+    # cells that can reach the end, without the end itself
+    active: np.ndarray
+
+    def __init__(self, grid:Grid, end:Position = None):
+        self.grid = grid
+        self.table = transitionTable(grid)
+        self.endCell = grid.cell(end or grid.findFirst(Grid.END))
+        self.valid = self.table >= 0
+        # blocked actions point to cell 0, they are masked out of every backup
+        self.nextCells = np.where(self.valid, self.table, 0)
+        self.terminal = self.table == self.endCell
+        self.rewards = np.where(self.terminal, WIN_REWARD, STEP_REWARD).astype(np.float64)
+        self.predecessors = self.reverseEdges()
+        self.layers = self.distanceLayers()
+        self.active = np.concatenate(self.layers) if self.layers else np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.table)
+
+    def reverseEdges(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ (starts, cells): the cells with an action leading to cell c are cells[starts[c]:starts[c + 1]] """
+        (cells, actions) = np.nonzero(self.valid)
+        targets = self.table[cells, actions]
+        order = np.argsort(targets, kind="stable")
+        starts = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(targets, minlength=len(self)), out=starts[1:])
+        return (starts, cells[order])
+
+    def cellsLeadingTo(self, cells:np.ndarray) -> np.ndarray:
+        (starts, sources) = self.predecessors
+        (first, last) = (starts[cells], starts[cells + 1])
+        counts = last - first
+        if not counts.sum():
+            return np.zeros(0, dtype=np.int64)
+        # first[i], first[i] + 1, ... last[i] - 1 for every cell, in one array
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return sources[np.repeat(first, counts) + offsets]
+
+    def distanceLayers(self) -> List[np.ndarray]:
+        """ Breadth first search backwards from the end """
+        seen = np.zeros(len(self), dtype=bool)
+        seen[self.endCell] = True
+        (layers, frontier) = ([], np.array([self.endCell]))
+        while True:
+            frontier = np.unique(self.cellsLeadingTo(frontier))
+            frontier = frontier[~seen[frontier]]
+            if not len(frontier):
+                return layers
+            seen[frontier] = True
+            layers.append(frontier)
+
+    def qValues(self, values:np.ndarray, discountRate, cells:np.ndarray = None) -> np.ndarray:
+        """ Expected reward of every action in 'cells' (default: all) given the cell 'values', -inf when blocked """
+        cells = np.arange(len(self)) if cells is None else cells
+        nextValues = np.where(self.terminal[cells], 0, values[self.nextCells[cells]])
+        return np.where(self.valid[cells], self.rewards[cells] + discountRate * nextValues, -np.inf)
+
+    def backup(self, values:np.ndarray, discountRate, cells:np.ndarray) -> np.ndarray:
+        return self.qValues(values, discountRate, cells).max(axis=1)
+
+
+def initialValues(model:GridModel) -> np.ndarray:
+    """ -inf for the cells to plan: below every value they can have, so no path goes through a cell not planned yet """
+    values = np.zeros(len(model), dtype=np.float64)
+    values[model.active] = -np.inf
+    return values
+
+
+def valueIteration(model:GridModel, discountRate = 1, tolerance = 1e-6, maxSweeps = 1000, ordered = True) -> Tuple[np.ndarray, int]:
+    """ Value of every cell (0 for the end and the cells that can't reach it) and the number of sweeps done.
+        Ordered sweeps update the cells layer by layer from the end, each layer with the new values of the
+        layers before it: one sweep solves the maze and a second one checks it. Otherwise every cell is updated
+        at the same time from the values of the previous sweep, which takes as many sweeps as the longest path
+        """
+    values = initialValues(model)
+    groups = model.layers if ordered else [model.active]
+    for sweep in range(1, maxSweeps + 1):
+        change = 0.0
+        for cells in groups:
+            newValues = model.backup(values, discountRate, cells)
+            with np.errstate(invalid="ignore"):
+                changes = np.abs(newValues - values[cells])
+            # cells still at -inf haven't changed
+            changes[np.isnan(changes)] = 0
+            change = max(change, float(changes.max(initial=0)))
+            values[cells] = newValues
+        if change < tolerance:
+            break
+    return (values, sweep)
+
+
+def prioritizedSweeping(model:GridModel, discountRate = 1, tolerance = 1e-6, maxUpdates:int = None) -> Tuple[np.ndarray, int]:
+    """ Value of every cell and the number of cell updates done. Starting from the cells next to the end, the
+        queued cell with the highest new value is updated first, then the cells leading to it are queued when
+        their value would go up. With the maze rewards (a cost per step and a reward at the end) that is the
+        order of the distance to the end, and each cell is updated once
+        """
+    values = initialValues(model)
+    maxUpdates = maxUpdates or 100 * len(model.active)
+    # the inner loop works on single cells, plain Python lists are faster there than NumPy
+    (nextCells, valid, terminal, rewards) = (model.nextCells.tolist(), model.valid.tolist(), model.terminal.tolist(), model.rewards.tolist())
+    (starts, sources) = (model.predecessors[0].tolist(), model.predecessors[1].tolist())
+    cellValues = values.tolist()
+
+    def backup(cell):
+        return max(rewards[cell][a] + (0 if terminal[cell][a] else discountRate * cellValues[nextCells[cell][a]])
+                   for a in range(len(DIRECTIONS)) if valid[cell][a])
+
+    queue = [(-backup(cell), cell) for cell in (model.layers[0].tolist() if model.layers else [])]
+    heapq.heapify(queue)
+    updates = 0
+    while queue and updates < maxUpdates:
+        (_, cell) = heapq.heappop(queue)
+        newValue = backup(cell)
+        if newValue <= cellValues[cell] + tolerance:
+            # already updated since it was queued
+            continue
+        cellValues[cell] = newValue
+        updates = updates + 1
+        for previous in sources[starts[cell]:starts[cell + 1]]:
+            if previous == model.endCell:
+                continue
+            candidate = backup(previous)
+            if candidate > cellValues[previous] + tolerance:
+                heapq.heappush(queue, (-candidate, previous))
+    values[:] = cellValues
+    return (values, updates)
+
+
+def writeValues(model:GridModel, values:np.ndarray, qMemory:QMemory):
+    """ Set the expected rewards of every action in the planned cells, with the same keys as GridEnvironment """
+    cells = model.active
+    qValues = model.qValues(values, qMemory.discountRate, cells)
+    (rows, actions) = np.nonzero(model.valid[cells])
+    keys = [GridState(model.grid.position(cell)) for cell in cells.tolist()]
+    qMemory.setExpectedRewards([keys[row] for row in rows.tolist()], [GRID_ACTIONS[action] for action in actions.tolist()],
+                               qValues[rows, actions].tolist())
+
+
+def solve(policy:Policy, grid:Grid, end:Position = None, method = "value") -> np.ndarray:
+    """ Plan the maze with 'method' ("value" or "sweeping") and the discount rate of the policy, and write the
+        result into its Q-table. Returns the value of every cell
+        """
+    model = GridModel(grid, end)
+    discountRate = policy.qMemory.discountRate
+    if method == "value":
+        (values, _) = valueIteration(model, discountRate)
+    elif method == "sweeping":
+        (values, _) = prioritizedSweeping(model, discountRate)
+    else:
+        raise ValueError(f"Unknown planning method {method}")
+    writeValues(model, values, policy.qMemory)
+    return values
+
+
+class DynaQ:
+    """ Dyna-Q: the last transition seen from each (state, action) is the model of the environment,
+        and after each real update 'numPlanningSteps' transitions drawn from it are replayed as a batch
+        """
+    def __init__(self, numPlanningSteps = 10, seed = None):
+        self.numPlanningSteps = numPlanningSteps
+        self.rng = random.Random(seed)
+        self.indexes = {}
+        self.transitions = []
+
+    def __len__(self):
+        return len(self.transitions)
+
+    def observe(self, state:State, action:Action, nextState:State, reward, done:bool):
+        pair = (state.key(), action)
+        index = self.indexes.get(pair)
+        if index is None:
+            self.indexes[pair] = len(self.transitions)
+            self.transitions.append((state, action, nextState, reward, done))
+        else:
+            self.transitions[index] = (state, action, nextState, reward, done)
+
+    def plan(self, policy:Policy, numSteps:int = None) -> int:
+        """ Simulated updates of 'numSteps' modelled transitions, returns how many were done """
+        numSteps = self.numPlanningSteps if numSteps is None else numSteps
+        if not self.transitions or not numSteps:
+            return 0
+        sampled = self.rng.choices(self.transitions, k=numSteps)
+        policy.batchUpdate(*zip(*sampled))
+        return numSteps
+
+    def recording(self, policy:Policy) -> "DynaRecorder":
+        return DynaRecorder(policy, self)
+
+
+class DynaRecorder(RecordingPolicy):
+    """ Plays and learns with 'policy', adding every real transition to the DynaQ model and planning after it """
+    def __init__(self, policy:Policy, dyna:DynaQ):
+        super().__init__(policy)
+        self.dyna = dyna
+        self.planned = 0
+
+    def observe(self, states:List[State], actions:List[Action], nextStates:List[State], rewards, dones):
+        for transition in zip(states, actions, nextStates, rewards, dones):
+            self.dyna.observe(*transition)
+        self.planned = self.planned + self.dyna.plan(self.policy, self.dyna.numPlanningSteps * len(states))
@@ -0,0 +1,116 @@
+""" Experience replay for ArrayQMemory: transitions stored by their Q-table indexes in a ring of NumPy arrays.
+
+    Use it with Trainer.replayTrain, or Trainer.batchTrain(replay=ReplayBuffer(...))
+    """
+from typing import List, Tuple
+import numpy as np
+
+from rl import Action, State, Policy, RecordingPolicy
+from arrayrl import ArrayQMemory
+
+# Added to the TD errors so that every transition keeps some chance of being sampled
+MIN_PRIORITY = 1e-3
+
+
+class ReplayBuffer:
+    """ The last 'capacity' transitions (state, action, reward, next state, done).
+        Sampled uniformly, or by priority: proportional to |TD error| ** alpha of the last time a transition
+        was replayed, new transitions getting the highest priority seen so far
+        """
+    states: np.ndarray
+    actions: np.ndarray
+    rewards: np.ndarray
+    nextStates: np.ndarray
+    dones: np.ndarray
+    priorities: np.ndarray
+
+    def __init__(self, capacity:int, batchSize = 256, numReplays = 16, prioritized = False, alpha = 0.6, seed = None):
+        """ batchSize and numReplays: size and number of the mini-batches replayed after each round of episodes """
+        self.capacity = capacity
+        self.batchSize = batchSize
+        self.numReplays = numReplays
+        self.prioritized = prioritized
+        self.alpha = alpha
+        self.rng = np.random.default_rng(seed)
+        self.states = np.zeros(capacity, dtype=np.int64)
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.nextStates = np.zeros(capacity, dtype=np.int64)
+        self.dones = np.zeros(capacity, dtype=bool)
+        self.priorities = np.zeros(capacity, dtype=np.float64)
+        self.maxPriority = 1.0
+        # where the next transition goes, and how many are stored
+        self.next = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, state:int, action:int, reward, nextState:int, done:bool):
+        i = self.next
+        (self.states[i], self.actions[i], self.rewards[i], self.nextStates[i], self.dones[i]) = (state, action, reward, nextState, done)
+        self.priorities[i] = self.maxPriority
+        self.next = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def addBatch(self, states, actions, rewards, nextStates, dones):
+        """ add() for arrays of transitions. Only the last 'capacity' of them are kept """
+        count = len(states)
+        slots = (self.next + np.arange(count)) % self.capacity
+        # when wrapping around more than once, the later transitions win
+        keep = slice(max(0, count - self.capacity), count)
+        (slots, first) = (slots[keep], keep.start)
+        self.states[slots] = np.asarray(states)[first:]
+        self.actions[slots] = np.asarray(actions)[first:]
+        self.rewards[slots] = np.asarray(rewards)[first:]
+        self.nextStates[slots] = np.asarray(nextStates)[first:]
+        self.dones[slots] = np.asarray(dones)[first:]
+        self.priorities[slots] = self.maxPriority
+        self.next = (self.next + count) % self.capacity
+        self.size = min(self.size + count, self.capacity)
+
+    def sample(self, batchSize:int, prioritized:bool = None) -> np.ndarray:
+        """ Buffer positions of 'batchSize' transitions, drawn with replacement """
+        prioritized = self.prioritized if prioritized is None else prioritized
+        if not prioritized:
+            return self.rng.integers(0, self.size, batchSize)
+        cumulative = np.cumsum(self.priorities[:self.size])
+        positions = np.searchsorted(cumulative, self.rng.random(batchSize) * cumulative[-1], side="right")
+        return np.minimum(positions, self.size - 1)
+
+    def batch(self, positions:np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ (states, actions, next states, rewards, dones) at 'positions', the order of ArrayQMemory.batchUpdateIndexes """
+        return (self.states[positions], self.actions[positions], self.nextStates[positions], self.rewards[positions], self.dones[positions])
+
+    def updatePriorities(self, positions:np.ndarray, errors:np.ndarray):
+        priorities = (np.abs(errors) + MIN_PRIORITY) ** self.alpha
+        self.priorities[positions] = priorities
+        self.maxPriority = max(self.maxPriority, float(priorities.max(initial=0)))
+
+    def replay(self, qMemory:ArrayQMemory, numReplays:int = None, batchSize:int = None) -> int:
+        """ Apply 'numReplays' sampled mini-batches to 'qMemory', returns the number of transitions replayed """
+        numReplays = self.numReplays if numReplays is None else numReplays
+        batchSize = self.batchSize if batchSize is None else batchSize
+        if not self.size:
+            return 0
+        for _ in range(numReplays):
+            positions = self.sample(batchSize)
+            errors = qMemory.batchUpdateIndexes(*self.batch(positions))
+            if self.prioritized:
+                self.updatePriorities(positions, errors)
+        return numReplays * batchSize
+
+    def recording(self, policy:Policy) -> "ReplayRecorder":
+        return ReplayRecorder(policy, self)
+
+
+class ReplayRecorder(RecordingPolicy):
+    """ Plays and learns with 'policy' (which must use an ArrayQMemory), adding every transition to a ReplayBuffer """
+    def __init__(self, policy:Policy, buffer:ReplayBuffer):
+        super().__init__(policy)
+        self.buffer = buffer
+
+    def observe(self, states:List[State], actions:List[Action], nextStates:List[State], rewards, dones):
+        qMemory = self.policy.qMemory
+        self.buffer.addBatch([qMemory.stateIndex(state) for state in states], [qMemory.actionIndex(action) for action in actions],
+                             rewards, [qMemory.stateIndex(state) for state in nextStates], dones)
@@ -11,7 +11,9 @@ class Action:
 
 @dataclass
 class State:
-    pass
+    def key(self):
+        """ What QMemory stores for this state: equal keys are the same state. States can return a compact form of themselves """
+        return self
 
 
 class Environment:
@@ -51,6 +53,7 @@ class Environment:
 
 class QMemory:
     class ActionRewards:
+        __slots__ = ("actions", "maxAction")
         maxAction:Action
         def __init__(self):
             self.actions = {}
@@ -63,11 +66,18 @@ class QMemory:
             return 0 if self.maxAction is None else self.actions[self.maxAction]
 
         def setExpectedReward(self, action:Action, reward):
-            self.actions[action] = reward
-            if not self.maxAction or reward > self.actions[self.maxAction]:
+            actions = self.actions
+            maxAction = self.maxAction
+            oldMax = None if maxAction is None else actions[maxAction]
+            actions[action] = reward
+            if oldMax is None or reward > oldMax:
                 self.maxAction = action
+            elif action == maxAction and reward < oldMax:
+                # the best value went down, another action may be the best now
+                self.maxAction = max(actions, key=actions.get)
 
-    sar: Dict[State, ActionRewards]
+    # keyed by State.key()
+    sar: Dict[object, ActionRewards]
 
     def __init__(self, learningRate = 0.9, discountRate = 0.5):
         self.learningRate = learningRate
@@ -75,34 +85,76 @@ class QMemory:
         self.sar = {}
 
     def getBestAction(self, state:State) -> Action:
-        return self.getActionRewards(state).maxAction
+        ars = self.lookup(state)
+        return None if ars is None else ars.maxAction
 
     def getActionRewards(self, state:State) -> ActionRewards:
-        if state in self.sar:
-            return self.sar[state]
-
-        ars = self.ActionRewards()
-        self.sar[state] = ars
+        """ The ActionRewards of 'state', to update them: added when the state is new """
+        return self.entry(state.key())
 
+    def entry(self, key) -> ActionRewards:
+        ars = self.sar.get(key)
+        if ars is None:
+            ars = self.sar[key] = self.ActionRewards()
         return ars
 
-    def getMaxReward(self, state:State):
-        return self.getActionRewards(state).getMaxReward()
+    def lookup(self, state:State) -> ActionRewards:
+        """ The ActionRewards of 'state' to read them, None when the state is unknown: reading doesn't add states """
+        return self.sar.get(state.key())
 
-    def update(self, oldState:State, action:Action, newState:State, reward):
+    def getMaxReward(self, state:State):
+        ars = self.lookup(state)
+        return 0 if ars is None else ars.getMaxReward()
+
+    def getExpectedReward(self, state:State, action:Action):
+        ars = self.lookup(state)
+        return 0 if ars is None else ars.getExpectedReward(action)
+
+    def peekExpectedReward(self, key, action:Action):
+        """ Expected reward of 'action' in the state with key 'key', None when the state is not in the table.
+            Unlike lookup() it is not counted as a use of the state by subclasses that track them
+            """
+        ars = self.sar.get(key)
+        return None if ars is None else ars.getExpectedReward(action)
+
+    def addDeltas(self, keys:List[object], actions:List[Action], deltas):
+        """ Add deltas[i] to the expected reward of actions[i] in the state with key keys[i] """
+        for (key, action, delta) in zip(keys, actions, deltas):
+            ars = self.entry(key)
+            ars.setExpectedReward(action, ars.getExpectedReward(action) + delta)
+
+    def setExpectedRewards(self, keys:List[object], actions:List[Action], rewards):
+        """ Set the expected reward of actions[i] in the state with key keys[i] to rewards[i] """
+        for (key, action, reward) in zip(keys, actions, rewards):
+            self.entry(key).setExpectedReward(action, reward)
+
+    def numStates(self) -> int:
+        return len(self.sar)
+
+    def stats(self) -> Dict[str, float]:
+        """ Counters reported by Trainer after each batch """
+        return {"entries": self.numStates()}
+
+    def update(self, oldState:State, action:Action, newState:State, reward, done = False):
+        """ done: newState is an end state, its expected rewards are not used """
         oldSA = self.getActionRewards(oldState)
         currentValue = oldSA.getExpectedReward(action)
-        newSA = self.getActionRewards(newState)
-        maxExpectedNew = newSA.getMaxReward()
+        maxExpectedNew = 0 if done else self.getMaxReward(newState)
         newExpectedReward = currentValue + self.learningRate * (reward + self.discountRate * maxExpectedNew - currentValue)
         oldSA.setExpectedReward(action, newExpectedReward)
 
+    def batchUpdate(self, states:List[State], actions:List[Action], nextStates:List[State], rewards, dones):
+        """ update() for many transitions, in order """
+        for transition in zip(states, actions, nextStates, rewards, dones):
+            self.update(*transition)
+
 
 class Policy:
     qMemory:QMemory
 
-    def __init__(self, learningRate = 0.9, discountRate = 0.5):
-        self.qMemory = QMemory(learningRate, discountRate)
+    def __init__(self, learningRate = 0.9, discountRate = 0.5, qMemoryClass = QMemory):
+        """ qMemoryClass is the Q-table backend, QMemory or a subclass like arrayrl.ArrayQMemory """
+        self.qMemory = qMemoryClass(learningRate, discountRate)
 
     def pickAction(self, env:Environment, exploitRate = 1) -> Action:
         if random.random() <= exploitRate:
@@ -117,11 +169,39 @@ class Policy:
         actions = list(env.getAllPossibleActions())
         return random.choice(actions) if actions else None
 
-    def update(self, oldState:State, action:Action, newState:State, reward):
-        self.qMemory.update(oldState, action, newState, reward)
+    def update(self, oldState:State, action:Action, newState:State, reward, done = False):
+        self.qMemory.update(oldState, action, newState, reward, done)
+
+    def batchUpdate(self, states:List[State], actions:List[Action], nextStates:List[State], rewards, dones):
+        self.qMemory.batchUpdate(states, actions, nextStates, rewards, dones)
 
     def getMaxReward(self, state):
         return self.qMemory.getMaxReward(state)
 
     def numKnownStates(self):
-        return len(self.qMemory.sar)
+        return self.qMemory.numStates()
+
+
+class RecordingPolicy:
+    """ Plays and learns with 'policy', passing every transition it learned from to observe().
+        Use it in place of the policy in an Episode
+        """
+    policy:Policy
+
+    def __init__(self, policy:Policy):
+        self.policy = policy
+
+    def pickAction(self, env:Environment, exploitRate = 1) -> Action:
+        return self.policy.pickAction(env, exploitRate)
+
+    def update(self, oldState:State, action:Action, newState:State, reward, done = False):
+        self.policy.update(oldState, action, newState, reward, done)
+        self.observe([oldState], [action], [newState], [reward], [done])
+
+    def batchUpdate(self, states:List[State], actions:List[Action], nextStates:List[State], rewards, dones):
+        self.policy.batchUpdate(states, actions, nextStates, rewards, dones)
+        self.observe(states, actions, nextStates, rewards, dones)
+
+    def observe(self, states:List[State], actions:List[Action], nextStates:List[State], rewards, dones):
+        """ Called after the policy learned from the transitions """
+        pass
@@ -0,0 +1,53 @@
+import unittest
+
+from rl import QMemory
+from arrayrl import ArrayQMemory
+from simplerl import GRID_ACTIONS, GridState, Position
+
+(UP, DOWN) = GRID_ACTIONS[:2]
+
+
+class ActionRewardsTest(unittest.TestCase):
+    def testBestActionGoesDown(self):
+        ars = QMemory.ActionRewards()
+        ars.setExpectedReward(UP, 5)
+        ars.setExpectedReward(DOWN, 3)
+        ars.setExpectedReward(UP, 1)
+        self.assertEqual(ars.maxAction, DOWN)
+        self.assertEqual(ars.getMaxReward(), 3)
+
+    def testBestActionGoesUp(self):
+        ars = QMemory.ActionRewards()
+        ars.setExpectedReward(UP, 5)
+        ars.setExpectedReward(DOWN, 3)
+        ars.setExpectedReward(UP, 7)
+        self.assertEqual(ars.maxAction, UP)
+        self.assertEqual(ars.getMaxReward(), 7)
+
+    def testOtherActionGoesDown(self):
+        ars = QMemory.ActionRewards()
+        ars.setExpectedReward(UP, 5)
+        ars.setExpectedReward(DOWN, 3)
+        ars.setExpectedReward(DOWN, -2)
+        self.assertEqual(ars.maxAction, UP)
+        self.assertEqual(ars.getMaxReward(), 5)
+
+
+class BatchUpdateTest(unittest.TestCase):
+    def testMaxAfterDecreaseMatchesUpdates(self):
+        """ batchUpdate gives the same best actions as update(), when the best value of a state goes down """
+        (start, next) = (GridState(Position(0, 0)), GridState(Position(0, 1)))
+        transitions = [(start, UP, next, 10, True), (start, DOWN, next, 4, True), (start, UP, next, -50, True)]
+        for qMemoryClass in (QMemory, ArrayQMemory):
+            one = qMemoryClass(0.9, 1)
+            for transition in transitions:
+                one.update(*transition)
+            batch = qMemoryClass(0.9, 1)
+            batch.batchUpdate(*zip(*transitions))
+            for qMemory in (one, batch):
+                self.assertEqual(qMemory.getBestAction(start), DOWN, qMemoryClass.__name__)
+                self.assertAlmostEqual(qMemory.getMaxReward(start), 3.6, places=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,724 @@
+""" Benchmarks for the reinforcement learning side: Q-table backends on the maze and chess tasks.
+
+    python rlbench.py                       # every suite, human readable
+    python rlbench.py --suite qtable        # Q-table memory and training throughput only
+    python rlbench.py --json results.json   # also write the results as JSON ('-' for stdout)
+    python rlbench.py --suite loop --json new.json --baseline old.json --threshold 0.1
+                                            # fail (exit code 1) when a rate is more than 10% below old.json
+    """
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from rl import QMemory, Policy
+from trainer import Episode, Trainer
+from simplerl import Grid, GridEnvironment, Position
+from chess import Color
+from chessrl import BoardState, ChessEnvironment, PositionCache
+from chessbench import trainBoard
+from arrayrl import ArrayQMemory
+
+BACKENDS = {"dict": QMemory, "array": ArrayQMemory}
+
+
+def randomCells(width:int, height:int, wallRate = 0.2, seed = 0) -> bytes:
+    """ The cells of randomMaze, row by row, for Grid.fromCells """
+    rng = random.Random(seed)
+    cells = bytearray(Grid.WALL if rng.random() < wallRate else Grid.EMPTY for _ in range(width * height))
+    cells[0] = cells[-1] = Grid.EMPTY
+    return bytes(cells)
+
+
+def randomMaze(width:int, height:int, wallRate = 0.2, seed = 0):
+    """ A maze with random walls, always open at the start (0, 0) and the end (width - 1, height - 1) """
+    rng = random.Random(seed)
+    data = [[Grid.WALL if rng.random() < wallRate else Grid.EMPTY for _ in range(width)] for _ in range(height)]
+    data[0][0] = Grid.EMPTY
+    data[height - 1][width - 1] = Grid.EMPTY
+    return data
+
+
+def mazeTask(width = 64, height = 64):
+    grid = Grid(randomMaze(width, height))
+    return (lambda: GridEnvironment(grid, Position(0, 0), Position(width - 1, height - 1)), lambda env: None)
+
+
+def blackReplies(seed = 0):
+    """ onStepEnd for chess episodes: Black plays a random legal move """
+    rng = random.Random(seed)
+    def onStepEnd(env):
+        if not env.isEndState():
+            actions = env.getState().getAllPossibleActionsFor(Color.Black)
+            if actions:
+                env.execute(rng.choice(actions))
+    return onStepEnd
+
+
+def chessTask():
+    start = BoardState(trainBoard())
+    return (lambda: ChessEnvironment(start), blackReplies())
+
+
+TASKS = {"maze": mazeTask, "chess": chessTask}
+
+
+def trainEpisodes(policy:Policy, envProvider, onStepEnd, numEpisodes:int, maxSteps:int, exploitRate = 0.5) -> int:
+    """ Train 'numEpisodes' episodes, returns the number of steps played """
+    steps = 0
+    for _ in range(numEpisodes):
+        episode = Episode(envProvider(), policy, exploitRate)
+        steps = steps + episode.step(maxSteps, onStepEnd=onStepEnd)
+    return steps
+
+
+def benchQTable(taskNames, numEpisodes = 300, maxSteps = 200, seed = 0):
+    """ Memory per state and training steps/s for each Q-table backend """
+    print(f"Q-table backends, {numEpisodes} training episodes of up to {maxSteps} steps")
+    results = []
+    for taskName in taskNames:
+        for (backendName, backend) in BACKENDS.items():
+            random.seed(seed)
+            (envProvider, onStepEnd) = TASKS[taskName]()
+            policy = Policy(discountRate=1, qMemoryClass=backend)
+            # only the memory kept by the Q-table, not by the chess position cache
+            positionCache = BoardState.cache
+            BoardState.cache = PositionCache(0)
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                trainEpisodes(policy, envProvider, onStepEnd, numEpisodes, maxSteps)
+                used = tracemalloc.get_traced_memory()[0] - before
+            finally:
+                tracemalloc.stop()
+                BoardState.cache = positionCache
+
+            # timed again without tracemalloc, which slows down allocations
+            random.seed(seed)
+            (envProvider, onStepEnd) = TASKS[taskName]()
+            policy = Policy(discountRate=1, qMemoryClass=backend)
+            start = time.perf_counter()
+            steps = trainEpisodes(policy, envProvider, onStepEnd, numEpisodes, maxSteps)
+            seconds = time.perf_counter() - start
+            numStates = policy.numKnownStates()
+            results.append({"task": taskName, "backend": backendName, "states": numStates, "steps": steps,
+                            "bytesPerState": used / numStates, "stepsPerSecond": steps / seconds})
+            print(f"  {taskName:6} {backendName:6}: {numStates:7d} states {used / numStates:8.0f} bytes/state "
+                  f"{steps / seconds:9.0f} steps/s")
+    return results
+
+
+def recordTransitions(taskName:str, numEpisodes:int, maxSteps:int, seed = 0):
+    """ (oldState, action, newState, reward) of random episodes of a task """
+    random.seed(seed)
+    (envProvider, onStepEnd) = TASKS[taskName]()
+    transitions = []
+    class Recorder(Policy):
+        def update(self, oldState, action, newState, reward, done = False):
+            transitions.append((oldState, action, newState, reward))
+    trainEpisodes(Recorder(), envProvider, onStepEnd, numEpisodes, maxSteps, exploitRate=0)
+    return transitions
+
+
+def updateOneByOne(qMemory, transitions, batchSize):
+    for (oldState, action, newState, reward) in transitions:
+        qMemory.update(oldState, action, newState, reward)
+
+
+def updateInBatches(qMemory, transitions, batchSize):
+    for start in range(0, len(transitions), batchSize):
+        (states, actions, nextStates, rewards) = zip(*transitions[start:start + batchSize])
+        qMemory.batchUpdate(states, actions, nextStates, rewards, [False] * len(states))
+
+
+def updateIndexesInBatches(qMemory, transitions, batchSize):
+    """ Offline replay of transitions already stored as indexes: only the vectorized part of batchUpdate is timed """
+    rows = [qMemory.stateIndex(transition[0]) for transition in transitions]
+    columns = [qMemory.actionIndex(transition[1]) for transition in transitions]
+    nextRows = [qMemory.stateIndex(transition[2]) for transition in transitions]
+    rewards = [transition[3] for transition in transitions]
+    dones = [False] * len(transitions)
+    start = time.perf_counter()
+    for first in range(0, len(transitions), batchSize):
+        last = first + batchSize
+        qMemory.batchUpdateIndexes(rows[first:last], columns[first:last], nextRows[first:last], rewards[first:last], dones[first:last])
+    return time.perf_counter() - start
+
+
+def benchUpdates(taskNames, numEpisodes = 100, maxSteps = 200, batchSize = 512):
+    """ Q-table update throughput of each backend on the same recorded transitions, one by one and in batches """
+    print(f"Q-table updates, transitions of {numEpisodes} random episodes, batches of {batchSize}")
+    runs = [(name, backend, updater) for (name, backend) in BACKENDS.items() for updater in (updateOneByOne, updateInBatches)]
+    runs.append(("array", ArrayQMemory, updateIndexesInBatches))
+    results = []
+    for taskName in taskNames:
+        transitions = recordTransitions(taskName, numEpisodes, maxSteps)
+        for (backendName, backend, updater) in runs:
+            qMemory = backend(0.9, 1)
+            start = time.perf_counter()
+            seconds = updater(qMemory, transitions, batchSize)
+            seconds = seconds or time.perf_counter() - start
+            results.append({"task": taskName, "backend": backendName, "mode": updater.__name__, "updates": len(transitions),
+                            "updatesPerSecond": len(transitions) / seconds})
+            print(f"  {taskName:6} {backendName:6} {updater.__name__:22}: {len(transitions) / seconds:10.0f} updates/s")
+    return results
+
+
+def benchParallel(taskNames, numBatches = 5, numEpisodes = 400, maxSteps = 200, processCounts = None):
+    """ Training steps/s of Trainer.batchTrain with 1, 2, 4... processes, up to the number of cores """
+    cores = os.cpu_count() or 1
+    processCounts = processCounts or sorted({1, 2} | {2 ** n for n in range(cores.bit_length()) if 2 ** n <= cores} | {cores})
+    print(f"Trainer.batchTrain, {numBatches} batches of {numEpisodes} episodes ({cores} cores)")
+    results = []
+    for taskName in taskNames:
+        (envProvider, onStepEnd) = TASKS[taskName]()
+        baseline = None
+        for processes in processCounts:
+            random.seed(0)
+            trainer = Trainer(envProvider, ArrayQMemory, onStepEnd=onStepEnd)
+            start = time.perf_counter()
+            trainer.batchTrain(numBatches, numEpisodes, 1, maxSteps, processes)
+            seconds = time.perf_counter() - start
+            # episodes get shorter as the policy learns, so steps are compared instead of episodes
+            stepsPerSecond = sum(trainer.nTrainSteps) / seconds
+            baseline = baseline or stepsPerSecond
+            results.append({"task": taskName, "processes": processes, "cores": cores, "episodesPerSecond": numBatches * numEpisodes / seconds,
+                            "stepsPerSecond": stepsPerSecond, "speedup": stepsPerSecond / baseline})
+            print(f"  {taskName:6} {processes:3d} processes: {stepsPerSecond:8.0f} steps/s ({stepsPerSecond / baseline:.2f}x)")
+    return results
+
+
+def benchVecEnv(size = 64, numEnvs = 1024, numSteps = 200, maxSteps = 200):
+    """ Maze training steps/s: Episode.step one agent at a time vs. GridVecEnv with Trainer.vecTrain """
+    from vecenv import GridVecEnv
+    print(f"Maze {size}x{size} training: Episode.step vs. GridVecEnv ({numEnvs} agents x {numSteps} steps)")
+    grid = Grid(randomMaze(size, size))
+    (start, end) = (Position(0, 0), Position(size - 1, size - 1))
+    trainer = Trainer(lambda: GridEnvironment(grid, start, end), ArrayQMemory)
+    random.seed(0)
+    startTime = time.perf_counter()
+    steps = sum(trainer.train(maxSteps, 0.5) for _ in range(20))
+    episodeStepsPerSecond = steps / (time.perf_counter() - startTime)
+
+    trainer = Trainer(lambda: GridEnvironment(grid, start, end), ArrayQMemory)
+    vecEnv = GridVecEnv(grid, start, end, numEnvs, maxSteps, seed=0)
+    startTime = time.perf_counter()
+    steps = trainer.vecTrain(vecEnv, numSteps, 0.5)
+    vecStepsPerSecond = steps / (time.perf_counter() - startTime)
+    print(f"  Episode.step: {episodeStepsPerSecond:10.0f} steps/s")
+    print(f"  GridVecEnv  : {vecStepsPerSecond:10.0f} steps/s ({vecEnv.finishedEpisodes} episodes finished, {vecEnv.wonEpisodes} won)")
+    return {"size": size, "agents": numEnvs, "episodeStepsPerSecond": episodeStepsPerSecond,
+            "vecStepsPerSecond": vecStepsPerSecond, "vecEpisodes": vecEnv.finishedEpisodes, "vecWins": vecEnv.wonEpisodes}
+
+
+def benchGrid(sizes = (100, 1000), numSteps = 100000):
+    """ Compiling large mazes: time, bytes kept per cell, and random walk steps/s in GridEnvironment """
+    print("Grid compile and GridEnvironment steps")
+    results = []
+    for size in sizes:
+        cells = randomCells(size, size)
+        tracemalloc.start()
+        try:
+            grid = Grid.fromCells(size, size, cells)
+            (used, peak) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # timed again without tracemalloc, which slows down allocations
+        start = time.perf_counter()
+        grid = Grid.fromCells(size, size, cells)
+        seconds = time.perf_counter() - start
+
+        rng = random.Random(0)
+        env = GridEnvironment(grid, Position(0, 0), Position(size - 1, size - 1))
+        start = time.perf_counter()
+        for _ in range(numSteps):
+            env.execute(rng.choice(env.getAllPossibleActions()))
+        stepsPerSecond = numSteps / (time.perf_counter() - start)
+        results.append({"size": size, "compileSeconds": seconds, "bytesPerCell": used / size ** 2,
+                        "peakBytesPerCell": peak / size ** 2, "stepsPerSecond": stepsPerSecond})
+        print(f"  {size}x{size}: compiled in {seconds:.3f}s, {used / size ** 2:.1f} bytes/cell "
+              f"(peak {peak / size ** 2:.1f}), {stepsPerSecond:.0f} steps/s")
+    return results
+
+
+def reachableMaze(size:int, seed = 0) -> Grid:
+    """ The first random maze (trying seeds from 'seed' on) where the end can be reached from the start """
+    while True:
+        grid = Grid.fromCells(size, size, randomCells(size, size, seed=seed))
+        (seen, frontier) = ({0}, [0])
+        while frontier:
+            cell = frontier.pop()
+            for action in range(4):
+                next = grid.nextCell(cell, action)
+                if next >= 0 and next not in seen:
+                    seen.add(next)
+                    frontier.append(next)
+        if size * size - 1 in seen:
+            return grid
+        seed = seed + 1
+
+
+def smallMazeTask(size = 16):
+    """ A maze where the end can be reached, small enough for Q-learning to solve it in a few thousand steps """
+    grid = reachableMaze(size)
+    return (lambda: GridEnvironment(grid, Position(0, 0), Position(size - 1, size - 1)), lambda env: None)
+
+
+def greedyWin(policy:Policy, env, onStepEnd, maxSteps:int) -> bool:
+    """ Play the best known action (a random one in unknown states) without learning, until the end or 'maxSteps' """
+    for _ in range(maxSteps):
+        if env.isEndState():
+            break
+        action = policy.qMemory.getBestAction(env.getState()) or random.choice(env.getAllPossibleActions())
+        env.execute(action)
+        onStepEnd(env)
+    return env.isWinState()
+
+
+def benchReplay(taskNames, episodesPerRound = 10, maxRounds = 100, maxSteps = 200, numChecks = 20, winRate = 0.9):
+    """ Environment steps until the greedy policy wins 'winRate' of 'numChecks' episodes: online updates only,
+        vs. also replaying uniform or prioritized mini-batches from a ReplayBuffer. Black plays random replies in chess
+        """
+    from replay import ReplayBuffer
+    print(f"Environment steps to converge, rounds of {episodesPerRound} episodes: online vs. replay")
+    tasks = {"maze": smallMazeTask, "chess": chessTask}
+    modes = {"online": None,
+             "uniform": lambda: ReplayBuffer(100000, seed=0),
+             "prioritized": lambda: ReplayBuffer(100000, prioritized=True, seed=0)}
+    results = []
+    for taskName in taskNames:
+        for (modeName, makeBuffer) in modes.items():
+            random.seed(0)
+            (envProvider, onStepEnd) = tasks[taskName]()
+            trainer = Trainer(envProvider, ArrayQMemory, onStepEnd=onStepEnd)
+            buffer = makeBuffer() if makeBuffer else None
+            (steps, replayed, converged) = (0, 0, False)
+            start = time.perf_counter()
+            for _ in range(maxRounds):
+                if buffer is None:
+                    steps = steps + sum(trainer.train(maxSteps, 0.5) for _ in range(episodesPerRound))
+                else:
+                    steps = steps + trainer.replayTrain(buffer, episodesPerRound, maxSteps, 0.5)
+                    replayed = replayed + buffer.numReplays * buffer.batchSize
+                wins = sum(greedyWin(trainer.policy, envProvider(), onStepEnd, maxSteps) for _ in range(numChecks))
+                if wins >= winRate * numChecks:
+                    converged = True
+                    break
+            seconds = time.perf_counter() - start
+            results.append({"task": taskName, "mode": modeName, "converged": converged, "envSteps": steps,
+                            "replayedTransitions": replayed, "seconds": seconds})
+            print(f"  {taskName:6} {modeName:12}: {'converged' if converged else 'not converged'} after {steps:7d} env steps "
+                  f"({replayed} replayed, {seconds:.2f}s)")
+    return results
+
+
+def convergenceSteps(trainer:Trainer, trainRound, envProvider, onStepEnd, maxRounds:int, maxSteps:int, numChecks = 20, winRate = 0.9):
+    """ (environment steps, converged) playing trainRound() until the greedy policy wins 'winRate' of 'numChecks' episodes """
+    steps = 0
+    for _ in range(maxRounds):
+        steps = steps + trainRound()
+        wins = sum(greedyWin(trainer.policy, envProvider(), onStepEnd, maxSteps) for _ in range(numChecks))
+        if wins >= winRate * numChecks:
+            return (steps, True)
+    return (steps, False)
+
+
+def benchPlanner(sizes = (16, 64, 256), dynaSizes = (16, 32), episodesPerRound = 10, maxRounds = 200, numPlanningSteps = 10):
+    """ Solving mazes with the known model: value iteration (ordered or synchronous sweeps) and prioritized sweeping.
+        Then environment steps to converge with Q-learning, Dyna-Q, and Q-learning warm-started by the planner
+        """
+    from planner import GridModel, DynaQ, valueIteration, prioritizedSweeping, solve
+    print("Planning mazes with their model")
+    results = {"planning": [], "learning": []}
+    for size in sizes:
+        grid = reachableMaze(size)
+        model = GridModel(grid, Position(size - 1, size - 1))
+        runs = {"value": lambda: valueIteration(model),
+                "value synchronous": lambda: valueIteration(model, ordered=False, maxSweeps=10 * size * size),
+                "sweeping": lambda: prioritizedSweeping(model)}
+        for (name, run) in runs.items():
+            start = time.perf_counter()
+            (values, work) = run()
+            seconds = time.perf_counter() - start
+            results["planning"].append({"size": size, "method": name, "cells": len(model.active), "seconds": seconds,
+                                        "work": work, "startValue": float(values[0])})
+            print(f"  {f'{size}x{size}':7} {name:17}: {seconds:8.3f}s {work:7d} {'updates' if name == 'sweeping' else 'sweeps'}, "
+                  f"start value {values[0]:.0f}")
+
+    print(f"Environment steps to converge, rounds of {episodesPerRound} episodes")
+    for size in dynaSizes:
+        grid = reachableMaze(size)
+        end = Position(size - 1, size - 1)
+        envProvider = lambda: GridEnvironment(grid, Position(0, 0), end)
+        for mode in ("online", "dyna", "warm start"):
+            random.seed(0)
+            trainer = Trainer(envProvider, ArrayQMemory)
+            dyna = DynaQ(numPlanningSteps, seed=0)
+            if mode == "warm start":
+                solve(trainer.policy, grid, end)
+            if mode == "dyna":
+                trainRound = lambda: trainer.dynaTrain(dyna, episodesPerRound, 4 * size * size, 0.5)
+            else:
+                trainRound = lambda: sum(trainer.train(4 * size * size, 0.5) for _ in range(episodesPerRound))
+            start = time.perf_counter()
+            (steps, converged) = convergenceSteps(trainer, trainRound, envProvider, lambda env: None, maxRounds, 4 * size * size)
+            seconds = time.perf_counter() - start
+            results["learning"].append({"size": size, "mode": mode, "converged": converged, "envSteps": steps, "seconds": seconds})
+            print(f"  {f'{size}x{size}':7} {mode:10}: {'converged' if converged else 'not converged'} after {steps:7d} env steps ({seconds:.2f}s)")
+    return results
+
+
+def benchCheckpoint(sizes = (100000, 1000000), numActions = 8, updateRate = 0.01, path = None):
+    """ Checkpoint of Q-tables with 16 byte state keys (like chess positions): full save, load, and the
+        append-only snapshot after 'updateRate' of the rows changed
+        """
+    import tempfile
+    import numpy as np
+    from checkpoint import Checkpoint, load
+    print("Q-table checkpoints: full save, load, incremental snapshot")
+    path = path or os.path.join(tempfile.gettempdir(), "rlbench.ckpt")
+    rng = np.random.default_rng(0)
+    results = []
+    for size in sizes:
+        keys = np.frombuffer(rng.bytes(16 * size), dtype="V16").tolist()
+        qMemory = ArrayQMemory.fromArrays(keys, list(range(numActions)), rng.random((size, numActions), dtype=np.float32))
+        checkpoint = Checkpoint(path)
+        if os.path.exists(path):
+            os.remove(path)
+        start = time.perf_counter()
+        checkpoint.snapshot(qMemory)
+        saveSeconds = time.perf_counter() - start
+        fullBytes = os.path.getsize(path)
+
+        rows = rng.choice(size, int(size * updateRate), replace=False)
+        qMemory.values[rows, 0] = 0
+        qMemory.updateRowMax(rows)
+        start = time.perf_counter()
+        checkpoint.snapshot(qMemory)
+        snapshotSeconds = time.perf_counter() - start
+        snapshotBytes = os.path.getsize(path) - fullBytes
+
+        del qMemory, keys
+        start = time.perf_counter()
+        (qMemory, _) = load(path)
+        loadSeconds = time.perf_counter() - start
+        del qMemory
+        os.remove(path)
+        results.append({"states": size, "fileBytes": fullBytes, "saveSeconds": saveSeconds, "loadSeconds": loadSeconds,
+                        "snapshotBytes": snapshotBytes, "snapshotSeconds": snapshotSeconds})
+        print(f"  {size:8d} states: {fullBytes / 1e6:7.1f} MB saved in {saveSeconds:.2f}s, loaded in {loadSeconds:.2f}s, "
+              f"snapshot of {updateRate:.0%} rows {snapshotBytes / 1e6:.2f} MB in {snapshotSeconds:.3f}s")
+    return results
+
+
+def benchBounded(taskNames, capacityRate = 0.5, numEpisodes = 500, maxSteps = 200, numChecks = 50):
+    """ Training with the unbounded QMemory, then with a BoundedQMemory holding 'capacityRate' of the states it
+        needed, for each eviction: states kept, memory, hit rate, evictions, steps/s and greedy win rate afterwards.
+        The maze task is a small maze that Q-learning solves
+        """
+    from functools import partial
+    from boundedrl import BoundedQMemory, EVICTIONS
+    print(f"Bounded Q-tables ({capacityRate:.0%} of the states), {numEpisodes} training episodes of up to {maxSteps} steps")
+    tasks = {"maze": smallMazeTask, "chess": chessTask}
+    results = []
+    for taskName in taskNames:
+        for (backendName, backend) in [("unbounded", QMemory)] + [(name, None) for name in EVICTIONS]:
+            if backend is None:
+                backend = partial(BoundedQMemory, capacity=capacity, eviction=backendName)
+            random.seed(0)
+            (envProvider, onStepEnd) = tasks[taskName]()
+            policy = Policy(discountRate=1, qMemoryClass=backend)
+            positionCache = BoardState.cache
+            BoardState.cache = PositionCache(0)
+            tracemalloc.start()
+            try:
+                start = time.perf_counter()
+                steps = trainEpisodes(policy, envProvider, onStepEnd, numEpisodes, maxSteps)
+                seconds = time.perf_counter() - start
+                used = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+                BoardState.cache = positionCache
+            capacity = capacity if backendName != "unbounded" else max(1, int(policy.numKnownStates() * capacityRate))
+            wins = sum(greedyWin(policy, envProvider(), onStepEnd, maxSteps) for _ in range(numChecks))
+            stats = policy.qMemory.stats()
+            results.append(dict(stats, task=taskName, backend=backendName, bytes=used, stepsPerSecond=steps / seconds,
+                                winRate=wins / numChecks))
+            hitRate = f"{stats['hitRate']:.2f}" if "hitRate" in stats else "   -"
+            print(f"  {taskName:6} {backendName:9}: {stats['entries']:6d} states {used / 1e6:6.2f} MB "
+                  f"hit rate {hitRate} {stats.get('evictions', 0):6d} evictions "
+                  f"{steps / seconds:7.0f} steps/s (traced), greedy wins {wins / numChecks:.0%}")
+    return results
+
+
+def benchEvaluation(numBatches = 20, numTrainEpisodes = 20, numTestEpisodes = 100, maxSteps = 200, processCounts = (1, 2)):
+    """ Trainer.batchTrain on the small maze with the test episodes played in the process, learning (as before)
+        and read-only, vs. read-only on a snapshot in a pool of processes, overlapping the next batches
+        """
+    cores = os.cpu_count() or 1
+    print(f"Trainer.batchTrain, {numBatches} batches of {numTrainEpisodes} training and {numTestEpisodes} test episodes ({cores} cores)")
+    (envProvider, _) = smallMazeTask()
+    results = []
+    for (testProcesses, testLearn) in ((0, True), (0, False)) + tuple((count, False) for count in processCounts):
+        random.seed(0)
+        trainer = Trainer(envProvider, ArrayQMemory)
+        start = time.perf_counter()
+        with contextlib.redirect_stderr(io.StringIO()):
+            trainer.batchTrain(numBatches, numTrainEpisodes, numTestEpisodes, maxSteps, testProcesses=testProcesses, testLearn=testLearn)
+        seconds = time.perf_counter() - start
+        # the first batch where every test episode was won
+        solved = next((b for (b, wins) in enumerate(trainer.rWins) if wins == numTestEpisodes), None)
+        mode = f"{testProcesses} test processes" if testProcesses else f"tests in process{', learning' if testLearn else ''}"
+        results.append({"testProcesses": testProcesses, "testLearn": testLearn, "cores": cores, "seconds": seconds,
+                        "firstSolvedBatch": solved, "wins": trainer.rWins})
+        print(f"  {mode:28}: {seconds:6.2f}s, every test won from batch {solved}")
+    return results
+
+
+def benchInstruments(taskNames, numBatches = 5, numTrainEpisodes = 40, numTestEpisodes = 20, maxSteps = 200, repeats = 3):
+    """ Trainer.batchTrain time with INSTRUMENTS off and on (best of 'repeats'), and where the time went with it on """
+    from instruments import INSTRUMENTS
+    print(f"Instrumentation overhead, {numBatches} batches of {numTrainEpisodes} + {numTestEpisodes} episodes")
+    results = []
+    for taskName in taskNames:
+        timings = {}
+        for enabled in (False, True):
+            best = None
+            for _ in range(repeats):
+                INSTRUMENTS.enable(enabled)
+                INSTRUMENTS.reset()
+                random.seed(0)
+                (envProvider, onStepEnd) = TASKS[taskName]()
+                trainer = Trainer(envProvider, ArrayQMemory, onStepEnd=onStepEnd)
+                start = time.perf_counter()
+                with contextlib.redirect_stderr(io.StringIO()):
+                    trainer.batchTrain(numBatches, numTrainEpisodes, numTestEpisodes, maxSteps)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            timings[enabled] = best
+        INSTRUMENTS.enable(False)
+        # share of the Episode.step phases, over every batch of the last run
+        phases = {}
+        for row in INSTRUMENTS.batches:
+            for phase in ("endCheck", "pickAction", "execute", "update", "onStepEnd"):
+                phases[phase] = phases.get(phase, 0) + row.get(f"{phase}Seconds", 0)
+        total = sum(phases.values()) or 1
+        results.append({"task": taskName, "offSeconds": timings[False], "onSeconds": timings[True],
+                        "overhead": timings[True] / timings[False] - 1, "phaseShares": {phase: value / total for (phase, value) in phases.items()}})
+        print(f"  {taskName:6}: off {timings[False]:.3f}s, on {timings[True]:.3f}s ({timings[True] / timings[False] - 1:+.0%}); "
+              + ", ".join(f"{phase} {value / total:.0%}" for (phase, value) in phases.items()))
+    return results
+
+
+def bestRate(run, repeats:int, minSeconds = 0.2) -> float:
+    """ Highest count/s of 'repeats' runs. run() returns (count, seconds), and is called again until each
+        run lasts 'minSeconds', so that short benchmarks are not decided by a single scheduling delay
+        """
+    best = 0.0
+    for _ in range(repeats):
+        (totalCount, totalSeconds) = (0, 0.0)
+        while totalSeconds < minSeconds:
+            # like timeit, without the garbage collector pauses that depend on what ran before
+            gc.collect()
+            gc.disable()
+            try:
+                (count, seconds) = run()
+            finally:
+                gc.enable()
+            (totalCount, totalSeconds) = (totalCount + count, totalSeconds + seconds)
+        best = max(best, totalCount / totalSeconds)
+    return best
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def benchLoop(taskNames, seed = 0, mazeSizes = (16, 32, 64), processCounts = (1, 2), numEpisodes = 100, maxSteps = 200, repeats = 5):
+    """ The training loop piece by piece, seeded: QMemory.update, Policy.pickAction and Episode.step on each task,
+        then Trainer.batchTrain on mazes of several sizes with several processes. Every result is a rate, higher is better
+        """
+    print(f"Training loop, seed {seed}, best of {repeats}")
+    results = []
+    def report(name, rate, unit, **identity):
+        results.append(dict(identity, name=name, unit=unit, perSecond=rate))
+        label = " ".join(str(value) for value in identity.values())
+        print(f"  {name:20} {label:18}: {rate:10.0f} {unit}/s")
+
+    for taskName in taskNames:
+        transitions = recordTransitions(taskName, numEpisodes, maxSteps, seed)
+        for (backendName, backend) in BACKENDS.items():
+            def runUpdates():
+                qMemory = backend(0.9, 1)
+                return (len(transitions), timed(updateOneByOne, qMemory, transitions, None))
+            report("QMemory.update", bestRate(runUpdates, repeats), "updates", task=taskName, backend=backendName)
+
+        (envProvider, onStepEnd) = TASKS[taskName]()
+        policy = Policy(discountRate=1, qMemoryClass=ArrayQMemory)
+        random.seed(seed)
+        trainEpisodes(policy, envProvider, onStepEnd, numEpisodes, maxSteps)
+        # an environment in each state seen, to pick actions from
+        envs = []
+        for (state, _, _, _) in transitions[:5000]:
+            env = envProvider()
+            env.state = state
+            envs.append(env)
+        def runPicks():
+            random.seed(seed)
+            return (len(envs), timed(lambda: [policy.pickAction(env, 0.5) for env in envs]))
+        report("Policy.pickAction", bestRate(runPicks, repeats), "picks", task=taskName)
+
+        def runEpisodes():
+            random.seed(seed)
+            # chess positions are explored again every run
+            BoardState.cache.clear()
+            (envProvider, onStepEnd) = TASKS[taskName]()
+            policy = Policy(discountRate=1, qMemoryClass=ArrayQMemory)
+            start = time.perf_counter()
+            steps = trainEpisodes(policy, envProvider, onStepEnd, numEpisodes, maxSteps)
+            return (steps, time.perf_counter() - start)
+        report("Episode.step", bestRate(runEpisodes, repeats), "steps", task=taskName)
+
+    for size in mazeSizes:
+        grid = reachableMaze(size, seed)
+        envProvider = lambda: GridEnvironment(grid, Position(0, 0), Position(size - 1, size - 1))
+        for processes in processCounts:
+            def runBatches():
+                random.seed(seed)
+                trainer = Trainer(envProvider, ArrayQMemory)
+                with contextlib.redirect_stderr(io.StringIO()):
+                    seconds = timed(trainer.batchTrain, 5, 40, 10, 4 * size, processes)
+                return (sum(trainer.nTrainSteps), seconds)
+            report("Trainer.batchTrain", bestRate(runBatches, repeats), "steps", size=size, processes=processes)
+    return results
+
+
+def calibrate(repeats = 5) -> float:
+    """ Rate of a fixed pure Python workload (dict updates in a loop), to tell a slower machine from slower code """
+    def run():
+        table = {}
+        start = time.perf_counter()
+        for i in range(100000):
+            key = i & 1023
+            table[key] = table.get(key, 0) + i
+        return (100000, time.perf_counter() - start)
+    return bestRate(run, repeats)
+
+
+# Fields that tell apart the results of a suite, besides the text ones (task, backend...)
+ID_FIELDS = ("size", "processes", "testProcesses", "states", "agents")
+
+
+def rates(results) -> dict:
+    """ {(suite, identity...): value} of every rate (a field named like *PerSecond or perSecond) in the results """
+    found = {}
+    for (suite, records) in results.items():
+        for record in records if isinstance(records, list) else [records] if isinstance(records, dict) else []:
+            identity = tuple((key, value) for (key, value) in record.items() if isinstance(value, str) or key in ID_FIELDS)
+            for (key, value) in record.items():
+                if key.endswith("PerSecond") or key == "perSecond":
+                    found[(suite, key) + identity] = value
+    return found
+
+
+def compare(baseline, results, threshold:float, normalize = False) -> int:
+    """ Print every rate against the baseline, returns the number of them more than 'threshold' below it.
+        The calibration rates only tell how fast the machines were, unless with normalize the rates are first
+        divided by the calibration rate of their run. It is a short measurement, its noise moves every rate
+        """
+    (old, new) = (rates(baseline), rates(results))
+    common = [key for key in new if key in old and old[key]]
+    machineSpeed = results["calibration"] / baseline["calibration"] if "calibration" in baseline else 1.0
+    speed = machineSpeed if normalize else 1.0
+    print(f"Against the baseline of {baseline.get('time', '?')}, threshold {threshold:.0%}, "
+          f"machine speed {machineSpeed:.2f}x the baseline{' (rates normalized)' if normalize else ''}")
+    regressions = 0
+    for key in common:
+        change = new[key] / old[key] / speed - 1
+        regression = change < -threshold
+        regressions = regressions + regression
+        label = " ".join(str(value) for (_, value) in key[2:]) + ("" if key[1] == "perSecond" else f" {key[1]}")
+        print(f"  {key[0]:10} {label:50}: {old[key]:12.1f} -> {new[key]:12.1f} {change:+7.1%}"
+              f"{'  REGRESSION' if regression else ''}")
+    print(f"  {len(common)} rates compared, {regressions} regressions")
+    return regressions
+
+
+SUITES = ("loop", "qtable", "updates", "parallel", "vecenv", "grid", "replay", "planner", "checkpoint", "bounded", "evaluation", "instruments")
+
+
+def main(args = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suite", choices=SUITES, action="append", help="suite to run, can be repeated (default: all)")
+    parser.add_argument("--tasks", default=",".join(TASKS), help="comma separated tasks (default: all)")
+    parser.add_argument("--json", metavar="FILE", help="write the results as JSON to FILE ('-' for stdout)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the loop suite (default: 0)")
+    parser.add_argument("--repeats", type=int, default=5, help="runs of each loop benchmark, the best one counts (default: 5)")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the rates with the JSON results in FILE")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="a rate this fraction below the baseline is a regression (default: 0.1)")
+    parser.add_argument("--normalize", action="store_true",
+                        help="compare the rates relative to the calibration run (default: as measured, the calibration is shown only)")
+    options = parser.parse_args(args)
+
+    taskNames = options.tasks.split(",")
+    suites = options.suite or SUITES
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cores": os.cpu_count(),
+        "seed": options.seed,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    regressions = 0
+    # Keep stdout for the JSON results when they are written there
+    with contextlib.redirect_stdout(sys.stderr if options.json == "-" else sys.stdout):
+        results["calibration"] = calibrate()
+        if "loop" in suites:
+            results["loop"] = benchLoop(taskNames, options.seed, repeats=options.repeats)
+        if "qtable" in suites:
+            results["qtable"] = benchQTable(taskNames)
+        if "updates" in suites:
+            results["updates"] = benchUpdates(taskNames)
+        if "parallel" in suites:
+            results["parallel"] = benchParallel(taskNames)
+        if "vecenv" in suites:
+            results["vecenv"] = benchVecEnv()
+        if "grid" in suites:
+            results["grid"] = benchGrid()
+        if "replay" in suites:
+            results["replay"] = benchReplay(taskNames)
+        if "planner" in suites:
+            results["planner"] = benchPlanner()
+        if "checkpoint" in suites:
+            results["checkpoint"] = benchCheckpoint()
+        if "bounded" in suites:
+            results["bounded"] = benchBounded(taskNames)
+        if "evaluation" in suites:
+            results["evaluation"] = benchEvaluation()
+        if "instruments" in suites:
+            results["instruments"] = benchInstruments(taskNames)
+        if options.baseline:
+            with open(options.baseline) as f:
+                regressions = compare(json.load(f), results, options.threshold, options.normalize)
+
+    if options.json == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    elif options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
-from copy import deepcopy
+from array import array
 from typing import List, Dict, Tuple
 from dataclasses import dataclass
+import numpy as np
 from rl import *
 
 
@@ -21,6 +22,9 @@ class Direction(Enum):
     def __repr__(self):
         return self.__str__()
 
+DIRECTIONS = list(Direction)
+ACTION_INDEXES = {dir: action for (action, dir) in enumerate(DIRECTIONS)}
+
 @dataclass
 class Position:
     """ A position in the grid. x is the column and y the row """
@@ -40,39 +44,89 @@ class Position:
     def __hash__(self):
         return hash((self.x, self.y))
 
+def shifted(delta:int, size:int) -> Tuple[slice, slice]:
+    """ (sources, targets): the slices of a row or column of 'size' cells moved 'delta' cells """
+    if delta >= 0:
+        return (slice(0, size - delta), slice(delta, size))
+    return (slice(-delta, size), slice(0, size + delta))
+
+
 class Grid:
-    """ The maze is represented by this grid, itself containing a two-dimensional array of ints """
+    """ The maze is represented by this grid. It is compiled once into flat arrays: the contents of
+        each cell, row by row (cell = y * width + x), and a table with the cell reached from each cell
+        in each direction, so moving is a single lookup
+        """
     EMPTY = 0
     WALL = 1
     START = 2
     END = 3
 
-    gridData:List[List[int]]
+    width:int
+    height:int
+    cells:bytearray
+    # transitions[cell * 4 + action] is the cell reached moving in direction DIRECTIONS[action], -1 when blocked
+    transitions:array
+
     def __init__(self, data):
-        self.gridData = deepcopy(data)
+        """ data is a list of rows of cell values. Missing cells at the end of shorter rows are walls """
+        height = len(data)
+        width = max((len(row) for row in data), default=0)
+        cells = bytearray([self.WALL]) * (width * height)
+        for (y, row) in enumerate(data):
+            cells[y * width:y * width + len(row)] = bytes(row)
+        self.compile(width, height, cells)
+
+    @classmethod
+    def fromCells(cls, width:int, height:int, cells:bytes) -> "Grid":
+        """ A grid from its cell values, row by row. Avoids the list of lists for large mazes """
+        grid = cls.__new__(cls)
+        grid.compile(width, height, bytearray(cells))
+        return grid
+
+    def compile(self, width:int, height:int, cells:bytearray):
+        self.width = width
+        self.height = height
+        self.cells = cells
+        self.transitions = array("i", [-1]) * (4 * width * height)
+        # filled through NumPy views, a whole direction at a time, without a Python object per cell
+        open = (np.frombuffer(cells, dtype=np.uint8) != self.WALL).reshape(height, width)
+        table = np.frombuffer(self.transitions, dtype=np.int32).reshape(height, width, len(DIRECTIONS))
+        (rows, columns) = (np.arange(height, dtype=np.int32) * width, np.arange(width, dtype=np.int32))
+        for (action, dir) in enumerate(DIRECTIONS):
+            (dx, dy) = dir.value
+            # the cells whose neighbour in this direction is inside the grid, and those neighbours
+            ((fromY, toY), (fromX, toX)) = (shifted(dy, height), shifted(dx, width))
+            nextCells = table[fromY, fromX, action]
+            np.add(rows[toY, None], columns[toX], out=nextCells)
+            nextCells[~(open[fromY, fromX] & open[toY, toX])] = -1
+        # the array can't be resized while NumPy views of it exist
+        del table, nextCells
+
+    def cell(self, pos:Position) -> int:
+        return pos.y * self.width + pos.x
+
+    def position(self, cell:int) -> Position:
+        return Position(cell % self.width, cell // self.width)
+
+    def nextCell(self, cell:int, action:int) -> int:
+        """ The cell reached from 'cell' moving in direction DIRECTIONS[action], -1 when blocked """
+        return self.transitions[cell * 4 + action]
 
     def isWall(self, pos:Position):
         """ is there a wall a this position? """
-        return self.gridData[pos.y][pos.x] is self.WALL
+        return self.cells[self.cell(pos)] == self.WALL
 
     def get(self, pos:Position):
         """ what is there at this position? """
-        return self.gridData[pos.y][pos.x]
+        return self.cells[self.cell(pos)]
 
     def validPos(self, pos:Position):
         """ is the position valid? we don't want to walk over walls or outside of the maze """
-        return 0 <= pos.y < len(self.gridData) and 0 <= pos.x < len(self.gridData[pos.y]) and not self.isWall(pos)
+        return 0 <= pos.y < self.height and 0 <= pos.x < self.width and not self.isWall(pos)
 
     def findFirst(self, key:int) -> Position:
-        y = 0
-        for row in self.gridData:
-            x = 0
-            for cell in row:
-                if cell == key:
-                    return Position(x, y)
-                x = x + 1
-            y = y + 1
-        return None
+        cell = self.cells.find(key)
+        return None if cell < 0 else self.position(cell)
 
 
 @dataclass
@@ -100,36 +154,38 @@ class GridState(State):
         return hash(self.pos)
 
 
+# One GridAction per direction, shared by every state
+GRID_ACTIONS = [GridAction(dir) for dir in DIRECTIONS]
+
+
 class GridEnvironment(Environment):
     state:GridState
     grid:Grid
 
-    def __init__(self, grid:Grid, startPosition:Position, endPosition:Position):
+    def __init__(self, grid:Grid, startPosition:Position = None, endPosition:Position = None):
+        """ Without start or end position, the START and END cells of the grid are used """
         self.grid = grid
-        self.startPosition = startPosition
-        self.endPosition = endPosition
+        self.startPosition = startPosition or grid.findFirst(Grid.START)
+        self.endPosition = endPosition or grid.findFirst(Grid.END)
         self.state = GridState(self.startPosition)
 
     def isWinState(self):
         return self.state.pos == self.endPosition
 
     def isValidMove(self, dir:Direction):
-        next = self.state.pos.move(dir)
-        return self.grid.validPos(next) and not self.grid.isWall(next)
+        return self.grid.nextCell(self.grid.cell(self.state.pos), ACTION_INDEXES[dir]) >= 0
 
     def getAllPossibleActions(self) -> List[Action]:
-        actions = []
-        for d in Direction:
-            if self.isValidMove(d):
-                actions.append(GridAction(d))
-        return actions
+        transitions = self.grid.transitions
+        first = self.grid.cell(self.state.pos) * 4
+        return [GRID_ACTIONS[action] for action in range(4) if transitions[first + action] >= 0]
 
     def getNewState(self, action:GridAction) -> GridState:
-        if not self.isValidMove(action.dir):
+        next = self.grid.nextCell(self.grid.cell(self.state.pos), ACTION_INDEXES[action.dir])
+        if next < 0:
             raise Exception(f"Invalid action {action.dir} from {self.state.pos}")
 
-        newPos = self.state.pos.move(action.dir)
-        return GridState(newPos)
+        return GridState(self.grid.position(next))
 
 DEFAULT_MAZE = [[0,0,0,1,0,0,1,0],
                 [0,1,1,1,0,0,0,0],
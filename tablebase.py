@@ -0,0 +1,257 @@
+""" Endgame tablebases for small boards: the exact result of every position with a given material.
+
+    Generate one with:
+        python tablebase.py 4 wP,wR,bP,bK train.tb
+
+    Every piece of the material is either in a square or captured, so the table also covers the positions
+    reached after captures. Values are from the point of view of the side to move, in plies:
+        0           draw (no legal moves without being in check, or no forced result)
+        +n          win, mate in n plies
+        -(n + 1)    loss, mated in n plies (-1: mated now)
+        INVALID     not a position (two pieces in the same square)
+    The file is a small header followed by one little endian int16 per position, and is memory-mapped
+    when loaded, so probing a position is an index computation and a single read
+    """
+from typing import List, Tuple
+import mmap
+import struct
+import sys
+import numpy as np
+
+from chess import Color, Piece, Board, Move, pieceCode
+from chessbatch import BoardBatch
+
+MAGIC = b"RLTB"
+VERSION = 1
+INVALID = -32768
+DRAW = 0
+HEADER = struct.Struct("<4sHBB")
+
+PIECE_LETTERS = {"P": Piece.Pawn, "B": Piece.Bishop, "N": Piece.Knight, "R": Piece.Rook, "Q": Piece.Queen, "K": Piece.King}
+COLOR_LETTERS = {"w": Color.White, "b": Color.Black}
+
+
+def parseMaterial(text:str) -> List[Tuple[Piece, Color]]:
+    """ 'wP,wR,bP,bK' to [(Piece.Pawn, Color.White), ...] """
+    return [(PIECE_LETTERS[item[1]], COLOR_LETTERS[item[0]]) for item in text.split(",")]
+
+
+def isWin(value:int) -> bool:
+    return value > 0
+
+def isLoss(value:int) -> bool:
+    return INVALID < value < 0
+
+def distanceToMate(value:int) -> int:
+    """ Plies to mate for a win or a loss, None for draws and invalid positions """
+    return value if value > 0 else (-value - 1 if isLoss(value) else None)
+
+
+class TablebaseIndex:
+    """ Maps positions with (a subset of) some material to table indexes and back.
+        index = ((slot0 * (S + 1) + slot1) * (S + 1) + ...) * 2 + colorBit
+        where slotN is the square of the N-th piece of the material, or S (the number of squares) when captured
+        """
+    def __init__(self, size:int, material:List[Tuple[Piece, Color]]):
+        self.size = size
+        self.material = material
+        self.codes = [pieceCode(piece, color) for (piece, color) in material]
+        self.numSquares = size * size
+        self.base = self.numSquares + 1
+        self.numPositions = self.base ** len(material) * 2
+
+    def index(self, board:Board, color:Color) -> int:
+        """ Index of 'board' with 'color' to move, -1 when it has pieces that are not in the material """
+        squaresOf = {}
+        for (sq, code) in enumerate(board.squares):
+            if code:
+                squaresOf.setdefault(code, []).append(sq)
+
+        index = 0
+        for code in self.codes:
+            squares = squaresOf.get(code)
+            index = index * self.base + (squares.pop(0) if squares else self.numSquares)
+        if any(squaresOf.values()):
+            return -1
+        return index * 2 + (color is Color.Black)
+
+    def slots(self, indexes:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ (slots, colorBits) for an array of indexes. slots[i, n] is the square of the n-th piece """
+        colorBits = indexes % 2
+        rest = indexes // 2
+        slots = np.empty((len(indexes), len(self.codes)), dtype=np.int64)
+        for n in reversed(range(len(self.codes))):
+            slots[:, n] = rest % self.base
+            rest = rest // self.base
+        return (slots, colorBits)
+
+    def indexes(self, slots:np.ndarray, colorBits:np.ndarray) -> np.ndarray:
+        indexes = np.zeros(len(slots), dtype=np.int64)
+        for n in range(len(self.codes)):
+            indexes = indexes * self.base + slots[:, n]
+        return indexes * 2 + colorBits
+
+    def squares(self, slots:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ (squares, valid): the board squares for each row of slots, and whether no two pieces share a square """
+        squares = np.zeros((len(slots), self.base), dtype=np.uint8)
+        counts = np.zeros((len(slots), self.base), dtype=np.int64)
+        rows = np.arange(len(slots))
+        for (n, code) in enumerate(self.codes):
+            squares[rows, slots[:, n]] = code
+            counts[rows, slots[:, n]] += 1
+        valid = (counts[:, :self.numSquares] <= 1).all(axis=1)
+        return (squares[:, :self.numSquares], valid)
+
+
+def generate(size:int, material:List[Tuple[Piece, Color]], chunkSize = 1 << 14) -> np.ndarray:
+    """ Solve every position of 'material' on a board of size 'size' by retrograde analysis.
+        Returns the int16 values, indexed like TablebaseIndex
+        """
+    tbIndex = TablebaseIndex(size, material)
+    numPositions = tbIndex.numPositions
+    values = np.zeros(numPositions, dtype=np.int16)
+    numMoves = np.zeros(numPositions, dtype=np.int64)
+    mated = np.zeros(numPositions, dtype=bool)
+    parents = []
+    children = []
+
+    # Forward pass: legal moves of every position, as edges parent -> child
+    for start in range(0, numPositions, chunkSize):
+        indexes = np.arange(start, min(start + chunkSize, numPositions), dtype=np.int64)
+        (slots, colorBits) = tbIndex.slots(indexes)
+        (squares, valid) = tbIndex.squares(slots)
+        values[indexes[~valid]] = INVALID
+        for color in Color:
+            selected = valid & (colorBits == (color is Color.Black))
+            if not selected.any():
+                continue
+            batch = BoardBatch(size, squares[selected])
+            (moves, checked, _, noMoves) = batch.status(color)
+            positions = indexes[selected]
+            numMoves[positions] = moves.sum(axis=(1, 2))
+            mated[positions] = checked & noMoves
+
+            (boards, origs, dests) = np.nonzero(moves)
+            childSlots = slots[selected][boards]
+            movers = childSlots == origs[:, None]
+            childSlots[childSlots == dests[:, None]] = tbIndex.numSquares
+            childSlots = np.where(movers, dests[:, None], childSlots)
+            parents.append(positions[boards])
+            children.append(tbIndex.indexes(childSlots, 1 - colorBits[selected][boards]))
+
+    parents = np.concatenate(parents) if parents else np.zeros(0, dtype=np.int64)
+    children = np.concatenate(children) if children else np.zeros(0, dtype=np.int64)
+
+    # Backward pass: predecessors of each position, grouped by child
+    order = np.argsort(children, kind="stable")
+    parentsByChild = parents[order]
+    offsets = np.zeros(numPositions + 1, dtype=np.int64)
+    np.cumsum(np.bincount(children, minlength=numPositions), out=offsets[1:])
+
+    def predecessors(positions:np.ndarray) -> np.ndarray:
+        starts = offsets[positions]
+        counts = offsets[positions + 1] - starts
+        if not counts.sum():
+            return np.zeros(0, dtype=np.int64)
+        firsts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return parentsByChild[firsts + np.arange(counts.sum())]
+
+    solved = values == INVALID
+    remaining = numMoves.copy()
+    frontier = np.nonzero(mated & ~solved)[0]
+    values[frontier] = -1
+    solved[frontier] = True
+    ply = 0
+    while len(frontier):
+        ply = ply + 1
+        frontierValues = values[frontier]
+        # a move into a lost position wins
+        winners = predecessors(frontier[frontierValues < 0])
+        winners = np.unique(winners[~solved[winners]])
+        values[winners] = ply
+        solved[winners] = True
+        # positions where every move leads to a won position for the other side are lost
+        towardsWins = predecessors(frontier[frontierValues > 0])
+        np.subtract.at(remaining, towardsWins, 1)
+        losers = np.unique(towardsWins[(remaining[towardsWins] == 0) & ~solved[towardsWins]])
+        values[losers] = -(ply + 1)
+        solved[losers] = True
+        frontier = np.concatenate([winners, losers])
+    return values
+
+
+def save(path:str, size:int, material:List[Tuple[Piece, Color]], values:np.ndarray):
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, size, len(material)))
+        f.write(bytes(value for (piece, color) in material for value in (piece.value, color.value)))
+        # keep the values aligned to 2 bytes
+        if (HEADER.size + 2 * len(material)) % 2:
+            f.write(b"\0")
+        f.write(values.astype("<i2").tobytes())
+
+
+class Tablebase:
+    """ A tablebase file, memory-mapped """
+    def __init__(self, path:str):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, size, numPieces) = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a tablebase file (version {VERSION})")
+        raw = self.mmap[HEADER.size:HEADER.size + 2 * numPieces]
+        material = [(Piece(raw[i]), Color(raw[i + 1])) for i in range(0, len(raw), 2)]
+        self.tbIndex = TablebaseIndex(size, material)
+        offset = HEADER.size + 2 * numPieces
+        offset = offset + offset % 2
+        data = memoryview(self.mmap)[offset:offset + 2 * self.tbIndex.numPositions]
+        if sys.byteorder == "little":
+            self.values = data.cast("h")
+        else:
+            self.values = np.frombuffer(data, dtype="<i2").astype(np.int16).tolist()
+
+    @property
+    def size(self) -> int:
+        return self.tbIndex.size
+
+    @property
+    def material(self) -> List[Tuple[Piece, Color]]:
+        return self.tbIndex.material
+
+    def probe(self, board:Board, color:Color) -> int:
+        """ Value of 'board' with 'color' to move (see the module documentation), None when the material doesn't match """
+        if board.size != self.size:
+            return None
+        index = self.tbIndex.index(board, color)
+        return None if index < 0 else self.values[index]
+
+    def bestMove(self, board:Board, color:Color) -> Move:
+        """ A move that keeps the best result for 'color': the fastest win, else a draw, else the slowest loss """
+        best = None
+        bestScore = None
+        for move in board.getAllMovesFor(color):
+            board.makeMove(move)
+            value = self.probe(board, color.other())
+            board.unmakeMove()
+            if value is None or value == INVALID:
+                continue
+            # the value of the child is from the point of view of the other side
+            score = (2, -distanceToMate(value)) if isLoss(value) else ((0, distanceToMate(value)) if isWin(value) else (1, 0))
+            if bestScore is None or score > bestScore:
+                (best, bestScore) = (move, score)
+        return best
+
+    def close(self):
+        if isinstance(self.values, memoryview):
+            self.values.release()
+        self.mmap.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print(__doc__)
+        sys.exit(1)
+    (size, material, path) = (int(sys.argv[1]), parseMaterial(sys.argv[2]), sys.argv[3])
+    values = generate(size, material)
+    save(path, size, material, values)
+    print(f"{path}: {len(values)} positions, {np.count_nonzero(values > 0)} wins, "
+          f"{np.count_nonzero((values < 0) & (values != INVALID))} losses, {np.count_nonzero(values == 0)} draws")
@@ -1,27 +1,42 @@
 from typing import Callable
+from collections import deque
+from contextlib import nullcontext
 from multiprocessing import Pool
+import pickle
+import time
 from tqdm import tqdm
 
 from rl import *
+from instruments import INSTRUMENTS
 
 NUM_TRAIN_EPISODES = 50
 NUM_TEST_EPISODES = 100
 NUM_BATCHES = 100
 MAX_STEPS = 50
 TEST_EXPLOIT_RATE = 0.75
+# Trainer statistics saved with each checkpoint, one value per batch
+PROGRESS = ("rWins", "eRates", "nStates", "nSteps", "stateMaxRewards", "nTrainSteps", "qStats")
 
 
 class Episode:
     env: Environment
     policy: Policy
 
-    def __init__(self, env:Environment, policy:Policy, exploitRate):
+    def __init__(self, env:Environment, policy:Policy, exploitRate, batchUpdates = False, learn = True):
+        """ With batchUpdates the transitions are kept and applied with a single Policy.batchUpdate at the end of step().
+            Without learn the policy is only played, not updated
+            """
         self.env = env
         self.policy = policy
         self.exploitRate = exploitRate
+        self.batchUpdates = batchUpdates
+        self.learn = learn
 
     def step(self, maxSteps = 100, onStepStart = lambda e:None, onStepEnd = lambda e:None):
+        if INSTRUMENTS.enabled:
+            return self.instrumentedStep(maxSteps, onStepStart, onStepEnd)
         steps = 0
+        transitions = []
         while steps < maxSteps and not self.env.isEndState():
             onStepStart(self.env)
             action = self.policy.pickAction(self.env, self.exploitRate)
@@ -30,68 +45,332 @@ class Episode:
             oldState = self.env.getState()
             reward = self.env.execute(action)
             newState = self.env.getState()
-            self.policy.update(oldState, action, newState, reward)
+            if self.learn:
+                if self.batchUpdates:
+                    transitions.append((oldState, action, newState, reward, self.env.isEndState()))
+                else:
+                    self.policy.update(oldState, action, newState, reward, self.env.isEndState())
             onStepEnd(self.env)
             steps = steps + 1
 
+        if transitions:
+            self.policy.batchUpdate(*zip(*transitions))
         return steps
 
+    def instrumentedStep(self, maxSteps, onStepStart, onStepEnd):
+        """ step(), adding the time of each phase and the counters to INSTRUMENTS """
+        (phases, counters, clock) = (INSTRUMENTS.phases, INSTRUMENTS.counters, time.perf_counter)
+        steps = 0
+        transitions = []
+        while True:
+            start = clock()
+            ended = steps >= maxSteps or self.env.isEndState()
+            phases["endCheck"] += clock() - start
+            if ended:
+                break
+            onStepStart(self.env)
+            start = clock()
+            action = self.policy.pickAction(self.env, self.exploitRate)
+            phases["pickAction"] += clock() - start
+            if not action:
+                break
+            oldState = self.env.getState()
+            start = clock()
+            reward = self.env.execute(action)
+            phases["execute"] += clock() - start
+            newState = self.env.getState()
+            if self.learn:
+                start = clock()
+                done = self.env.isEndState()
+                phases["endCheck"] += clock() - start
+                if self.batchUpdates:
+                    transitions.append((oldState, action, newState, reward, done))
+                else:
+                    start = clock()
+                    self.policy.update(oldState, action, newState, reward, done)
+                    phases["update"] += clock() - start
+                    counters["updates"] += 1
+            start = clock()
+            onStepEnd(self.env)
+            phases["onStepEnd"] += clock() - start
+            steps = steps + 1
+
+        if transitions:
+            start = clock()
+            self.policy.batchUpdate(*zip(*transitions))
+            phases["update"] += clock() - start
+            counters["updates"] += len(transitions)
+        counters["episodes"] += 1
+        counters["steps"] += steps
+        return steps
+
+
+class UpdateRecorder(RecordingPolicy):
+    """ Plays and learns with a copy of a policy, remembering which (state, action) were updated, so that
+        what was learned can be applied to the original policy
+        """
+    def __init__(self, policy:Policy):
+        super().__init__(policy)
+        self.updated = {}
+
+    def observe(self, states:List[State], actions:List[Action], nextStates:List[State], rewards, dones):
+        for (state, action) in zip(states, actions):
+            self.updated[(state.key(), action)] = None
+
+    def values(self):
+        """ (keys, actions, expected rewards) of every updated (state, action) still in the Q-table. The states
+            a BoundedQMemory evicted after updating them are left out: what they learned is lost, reporting
+            them as 0 would erase the value of the original policy too
+            """
+        qMemory = self.policy.qMemory
+        values = [(key, action, qMemory.peekExpectedReward(key, action)) for (key, action) in self.updated]
+        values = [value for value in values if value[2] is not None]
+        return tuple(zip(*values)) if values else ((), (), ())
+
+
+# Set in each worker process of Trainer.batchTrain
+workerEnvProvider = None
+workerOnStepEnd = None
+
+def initWorker(envProvider:Callable[[], Environment], onStepEnd:Callable[[Environment], None]):
+    global workerEnvProvider, workerOnStepEnd
+    workerEnvProvider = envProvider
+    workerOnStepEnd = onStepEnd
+
+def trainInWorker(snapshot:bytes, numEpisodes:int, maxSteps:int, exploitRate, batchUpdates:bool, seed:int):
+    """ Train 'numEpisodes' episodes on a copy of the pickled policy 'snapshot', returns (UpdateRecorder.values, number of steps) """
+    random.seed(seed)
+    recorder = UpdateRecorder(pickle.loads(snapshot))
+    steps = 0
+    for _ in range(numEpisodes):
+        steps = steps + Episode(workerEnvProvider(), recorder, exploitRate, batchUpdates).step(maxSteps, onStepEnd=workerOnStepEnd)
+    return (recorder.values(), steps)
+
+def evaluateInWorker(snapshot:bytes, numEpisodes:int, maxSteps:int, exploitRate, seed:int):
+    """ Play 'numEpisodes' episodes without learning with the pickled policy 'snapshot',
+        returns (wins, steps, sum of the max rewards of the last states)
+        """
+    random.seed(seed)
+    policy = pickle.loads(snapshot)
+    (wins, totalSteps, stateMaxReward) = (0, 0, 0)
+    for _ in range(numEpisodes):
+        env = workerEnvProvider()
+        totalSteps = totalSteps + Episode(env, policy, exploitRate, learn=False).step(maxSteps, onStepEnd=workerOnStepEnd)
+        stateMaxReward = stateMaxReward + policy.getMaxReward(env.getState())
+        wins = wins + env.isWinState()
+    return (wins, totalSteps, stateMaxReward)
+
 
 class Trainer:
     policy:Policy
 
-    def __init__(self, envProvider:Callable[[], Environment]):
-        """ envProvider is a function that returns an Environment for training and testing """
+    def __init__(self, envProvider:Callable[[], Environment], qMemoryClass = QMemory, batchUpdates = False, onStepEnd = lambda e:None):
+        """ envProvider is a function that returns an Environment for training and testing.
+            qMemoryClass is the Q-table backend used by the policy, batchUpdates is passed to each Episode
+            and onStepEnd to each Episode.step (e.g. the moves of the opponent)
+            """
         self.envProvider = envProvider
+        self.qMemoryClass = qMemoryClass
+        self.onStepEnd = onStepEnd
+        self.batchUpdates = batchUpdates
         self.rWins = []
         self.eRates = []
         self.nStates = []
         self.nSteps = []
         self.stateMaxRewards = []
-        self.policy = Policy(discountRate=1)
+        self.nTrainSteps = []
+        # QMemory.stats() after each batch
+        self.qStats = []
+        self.policy = Policy(discountRate=1, qMemoryClass=qMemoryClass)
+
+    def progress(self) -> Dict[str, list]:
+        return {name: getattr(self, name) for name in PROGRESS}
+
+    def resume(self, checkpoint) -> int:
+        """ Continue from the last snapshot of 'checkpoint' (a checkpoint.Checkpoint): its Q-table and statistics.
+            Returns the number of batches already trained, the firstBatch of batchTrain
+            """
+        (self.policy.qMemory, progress) = checkpoint.load(self.qMemoryClass)
+        for (name, values) in progress.items():
+            setattr(self, name, values)
+        return len(self.nTrainSteps)
 
     def trainExploitRate(self, batchNumber, numBatches):
         return 0.5 + (batchNumber / numBatches)/2
 
     def train(self, maxSteps, exploitRate):
         env = self.envProvider()
-        episode = Episode(env, self.policy, exploitRate)
-        return episode.step(maxSteps)
+        episode = Episode(env, self.policy, exploitRate, self.batchUpdates)
+        return episode.step(maxSteps, onStepEnd=self.onStepEnd)
+
+    def vecTrain(self, vecEnv, numSteps, exploitRate):
+        """ Advance every agent of 'vecEnv' (a vecenv.GridVecEnv) 'numSteps' steps, with one batch update per step.
+            The policy must use an ArrayQMemory. Returns the number of steps played
+            """
+        qMemory = self.policy.qMemory
+        if vecEnv.rows is None:
+            vecEnv.register(qMemory)
+        for _ in range(numSteps):
+            cells = vecEnv.cells
+            actions = vecEnv.pickActions(qMemory, exploitRate)
+            (nextCells, rewards, dones, _) = vecEnv.step(actions)
+            vecEnv.addRows(qMemory, cells)
+            qMemory.batchUpdateIndexes(vecEnv.rows[cells], vecEnv.columns[actions], vecEnv.rows[nextCells], rewards, dones)
+        return numSteps * len(vecEnv)
+
+    def replayTrain(self, replay, numEpisodes, maxSteps, exploitRate):
+        """ Train 'numEpisodes' episodes adding their transitions to 'replay' (a replay.ReplayBuffer), then replay
+            mini-batches sampled from it. The policy must use an ArrayQMemory. Returns the number of steps played
+            """
+        recorder = replay.recording(self.policy)
+        steps = 0
+        for _ in range(numEpisodes):
+            steps = steps + Episode(self.envProvider(), recorder, exploitRate, self.batchUpdates).step(maxSteps, onStepEnd=self.onStepEnd)
+        replay.replay(self.policy.qMemory)
+        return steps
+
+    def dynaTrain(self, dyna, numEpisodes, maxSteps, exploitRate):
+        """ Train 'numEpisodes' episodes learning a model of the environment with 'dyna' (a planner.DynaQ), which
+            adds its simulated updates after each real one. Returns the number of real steps played
+            """
+        recorder = dyna.recording(self.policy)
+        steps = 0
+        for _ in range(numEpisodes):
+            steps = steps + Episode(self.envProvider(), recorder, exploitRate, self.batchUpdates).step(maxSteps, onStepEnd=self.onStepEnd)
+        return steps
 
-    def test(self, maxSteps, exploitRate):
+    def test(self, maxSteps, exploitRate, learn = True):
         env = self.envProvider()
-        episode = Episode(env, self.policy, exploitRate)
-        steps = episode.step(maxSteps)
+        episode = Episode(env, self.policy, exploitRate, self.batchUpdates, learn)
+        steps = episode.step(maxSteps, onStepEnd=self.onStepEnd)
         return (env.isWinState(), steps, self.policy.getMaxReward(env.getState()))
 
-    def batchTrain(self, numBatches:int = NUM_BATCHES, numTrainEpisodes = NUM_TRAIN_EPISODES, numTestEpisodes = NUM_TEST_EPISODES, maxSteps = MAX_STEPS, maxProcesses:int = 1):
+    def parallelTrain(self, pool:Pool, numProcesses:int, numEpisodes:int, maxSteps, exploitRate):
+        """ Each worker trains its share of the episodes on a snapshot of the policy, then the changes the
+            workers made to each expected reward (the value they reached minus the value in the policy, which
+            doesn't change meanwhile) are averaged and added to the policy. (Adding them up would overshoot:
+            workers that all learned the same value would each add the full change.)
+            Returns the number of steps played
+            """
+        # pickled once for all the workers, instead of once per task
+        snapshot = pickle.dumps(self.policy, pickle.HIGHEST_PROTOCOL)
+        tasks = []
+        for worker in range(numProcesses):
+            workerEpisodes = numEpisodes // numProcesses + (worker < numEpisodes % numProcesses)
+            if workerEpisodes:
+                args = (snapshot, workerEpisodes, maxSteps, exploitRate, self.batchUpdates, random.getrandbits(32))
+                tasks.append(pool.apply_async(trainInWorker, args))
+        steps = 0
+        changes = {}
+        qMemory = self.policy.qMemory
+        for task in tasks:
+            ((keys, actions, values), taskSteps) = task.get()
+            steps = steps + taskSteps
+            for (key, action, value) in zip(keys, actions, values):
+                (total, count) = changes.get((key, action), (0, 0))
+                changes[(key, action)] = (total + value - (qMemory.peekExpectedReward(key, action) or 0), count + 1)
+        if changes:
+            (pairs, totals) = zip(*changes.items())
+            (keys, actions) = zip(*pairs)
+            qMemory.addDeltas(keys, actions, [total / count for (total, count) in totals])
+        return steps
+
+    def evaluate(self, pool:Pool, numProcesses:int, numEpisodes:int, maxSteps, exploitRate) -> list:
+        """ Start 'numEpisodes' read-only test episodes in the workers, on a snapshot of the policy as it is now.
+            Returns the pending results, see addEvaluations
+            """
+        # pickled now: the pool would pickle the policy later, while the next batch is updating it
+        snapshot = pickle.dumps(self.policy, pickle.HIGHEST_PROTOCOL)
+        tasks = []
+        for worker in range(numProcesses):
+            workerEpisodes = numEpisodes // numProcesses + (worker < numEpisodes % numProcesses)
+            if workerEpisodes:
+                args = (snapshot, workerEpisodes, maxSteps, exploitRate, random.getrandbits(32))
+                tasks.append(pool.apply_async(evaluateInWorker, args))
+        return tasks
+
+    def addEvaluations(self, pending:deque, numEpisodes:int, wait:bool):
+        """ Add the results of the evaluations in 'pending', in the order they were started, up to the first
+            one not finished yet (or all of them when waiting)
+            """
+        while pending and (wait or all(task.ready() for task in pending[0])):
+            results = [task.get() for task in pending.popleft()]
+            (wins, totalSteps, stateMaxReward) = (sum(values) for values in zip(*results))
+            self.addTestResults(wins, totalSteps, stateMaxReward, numEpisodes)
+
+    def addTestResults(self, wins, totalSteps, stateMaxReward, numEpisodes):
+        self.stateMaxRewards.append(stateMaxReward / numEpisodes)
+        self.rWins.append(wins)
+        self.nSteps.append(totalSteps / numEpisodes)
+
+    def batchTrain(self, numBatches:int = NUM_BATCHES, numTrainEpisodes = NUM_TRAIN_EPISODES, numTestEpisodes = NUM_TEST_EPISODES, maxSteps = MAX_STEPS, maxProcesses:int = 1, vecEnv = None, replay = None, dyna = None,
+                   checkpoint = None, firstBatch = 0, testProcesses = 0, testLearn = False):
+        """ With maxProcesses > 1 the training episodes run in a pool of processes created once for all the batches.
+            The environments come from envProvider called in the workers (processes are forked, it doesn't need to be picklable).
+            With a vecEnv (vecenv.GridVecEnv) each batch trains with vecTrain instead, every agent playing maxSteps steps;
+            numTrainEpisodes is not used then.
+            With a replay buffer (replay.ReplayBuffer) each batch trains with replayTrain, with a planner.DynaQ with dynaTrain.
+            With a checkpoint (checkpoint.Checkpoint) the Q-table and statistics are snapshotted after each batch.
+            To resume: batchTrain(numBatches, checkpoint=checkpoint, firstBatch=self.resume(checkpoint))
+            The test episodes don't learn, unless testLearn is set (in the process only). With testProcesses > 0 they
+            play a snapshot of the policy taken after each batch, in a pool of that many processes, while the next batches train. Their results are added to
+            rWins, nSteps and stateMaxRewards as they arrive, all of them before batchTrain returns and before
+            each checkpoint snapshot.
+            With INSTRUMENTS enabled (see instruments.py) each batch adds a row with its phases and counters
+            """
         self.numBatches = numBatches
 
-        for b in tqdm(range(numBatches)):
-            exploitRate = self.trainExploitRate(b, numBatches)
-            if maxProcesses > 1:
-                with Pool(processes=maxProcesses) as pool:
-                    for _ in range(numTrainEpisodes):
-                        pool.apply_async(self.train, maxSteps, exploitRate)
-                    pool.close()
-                    pool.join()
-            else:
-                for _ in range(numTrainEpisodes):
-                    self.train(maxSteps, exploitRate)
-
-            wins = 0
-            totalSteps = 0
-            stateMaxReward = 0
-            for _ in range(numTestEpisodes):
-                (isWin, steps, maxReward) = self.test(maxSteps, TEST_EXPLOIT_RATE)
-                stateMaxReward = stateMaxReward + maxReward
-                totalSteps = totalSteps + steps
-                if isWin:
-                    wins = wins + 1
-
-            totalStates = self.policy.numKnownStates()
-            self.stateMaxRewards.append(stateMaxReward / numTestEpisodes)
-            self.rWins.append(wins)
-            self.eRates.append(exploitRate)
-            self.nStates.append(totalStates)
-            self.nSteps.append(totalSteps / numTestEpisodes)
+        parallel = maxProcesses > 1
+        pending = deque()
+        with Pool(maxProcesses, initWorker, (self.envProvider, self.onStepEnd)) if parallel else nullcontext() as pool, \
+             Pool(testProcesses, initWorker, (self.envProvider, self.onStepEnd)) if testProcesses else nullcontext() as testPool:
+            for b in tqdm(range(firstBatch, numBatches)):
+                with INSTRUMENTS.profiling(b):
+                    batchStart = time.perf_counter()
+                    statesBefore = self.policy.numKnownStates()
+                    exploitRate = self.trainExploitRate(b, numBatches)
+                    if vecEnv is not None:
+                        trainSteps = self.vecTrain(vecEnv, maxSteps, exploitRate)
+                    elif replay is not None:
+                        trainSteps = self.replayTrain(replay, numTrainEpisodes, maxSteps, exploitRate)
+                    elif dyna is not None:
+                        trainSteps = self.dynaTrain(dyna, numTrainEpisodes, maxSteps, exploitRate)
+                    elif parallel:
+                        trainSteps = self.parallelTrain(pool, maxProcesses, numTrainEpisodes, maxSteps, exploitRate)
+                    else:
+                        trainSteps = sum(self.train(maxSteps, exploitRate) for _ in range(numTrainEpisodes))
+                    self.nTrainSteps.append(trainSteps)
+                    testStart = time.perf_counter()
+
+                    if testPool is not None:
+                        pending.append(self.evaluate(testPool, testProcesses, numTestEpisodes, maxSteps, TEST_EXPLOIT_RATE))
+                        self.addEvaluations(pending, numTestEpisodes, wait=False)
+                    else:
+                        wins = 0
+                        totalSteps = 0
+                        stateMaxReward = 0
+                        for _ in range(numTestEpisodes):
+                            (isWin, steps, maxReward) = self.test(maxSteps, TEST_EXPLOIT_RATE, testLearn)
+                            stateMaxReward = stateMaxReward + maxReward
+                            totalSteps = totalSteps + steps
+                            if isWin:
+                                wins = wins + 1
+                        self.addTestResults(wins, totalSteps, stateMaxReward, numTestEpisodes)
+
+                    checkpointStart = time.perf_counter()
+                    totalStates = self.policy.numKnownStates()
+                    self.eRates.append(exploitRate)
+                    self.nStates.append(totalStates)
+                    self.qStats.append(self.policy.qMemory.stats())
+                    if checkpoint is not None:
+                        # the statistics of every batch saved must be complete, resume doesn't train them again
+                        self.addEvaluations(pending, numTestEpisodes, wait=True)
+                        checkpoint.snapshot(self.policy.qMemory, self.progress())
+                    if INSTRUMENTS.enabled:
+                        end = time.perf_counter()
+                        INSTRUMENTS.phases["train"] += testStart - batchStart
+                        INSTRUMENTS.phases["test"] += checkpointStart - testStart
+                        INSTRUMENTS.phases["checkpoint"] += end - checkpointStart
+                        INSTRUMENTS.counters["trainSteps"] += trainSteps
+                        INSTRUMENTS.endBatch(b, end - batchStart, totalStates - statesBefore)
+            self.addEvaluations(pending, numTestEpisodes, wait=True)
@@ -0,0 +1,96 @@
+""" Many maze agents stepped together with NumPy arrays.
+
+    Cells are numbered row by row (cell = y * width + x) and actions follow the order of simplerl.Direction
+    """
+from typing import Tuple
+import numpy as np
+
+from simplerl import DIRECTIONS, Grid, GridAction, GridState, Position
+from arrayrl import ArrayQMemory, UNKNOWN
+
+WIN_REWARD = 100
+STEP_REWARD = -1
+
+
+def transitionTable(grid:Grid) -> np.ndarray:
+    """ Grid.transitions as a (cells x actions) array, without copying it """
+    return np.frombuffer(grid.transitions, dtype=np.int32).reshape(-1, len(DIRECTIONS))
+
+
+class GridVecEnv:
+    """ N agents in the same maze, all starting at 'start'. An agent that reaches 'end', or has played 'maxSteps'
+        steps, goes back to the start on the next step
+        """
+    cells: np.ndarray
+    steps: np.ndarray
+
+    def __init__(self, grid:Grid, start:Position, end:Position, numEnvs:int, maxSteps:int = None, seed = None):
+        (self.width, self.height, self.table) = (grid.width, grid.height, transitionTable(grid))
+        self.startCell = start.y * self.width + start.x
+        self.endCell = end.y * self.width + end.x
+        self.maxSteps = maxSteps
+        self.rng = np.random.default_rng(seed)
+        self.cells = np.full(numEnvs, self.startCell, dtype=np.int64)
+        self.steps = np.zeros(numEnvs, dtype=np.int64)
+        self.finishedEpisodes = 0
+        self.wonEpisodes = 0
+        # Q-table rows of each cell (UNKNOWN until it is added) and columns of each action, see register()
+        self.rows = None
+        self.columns = None
+
+    def __len__(self):
+        return len(self.cells)
+
+    def masks(self) -> np.ndarray:
+        """ masks[i, action] is True when 'action' can be played by agent i """
+        return self.table[self.cells] >= 0
+
+    def step(self, actions:np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ Play actions[i] for every agent i. Blocked actions leave the agent where it is.
+            Returns (next cells, rewards, done flags, valid action masks of the cells the agents are in now):
+            the next cells are the ones reached, before finished agents are sent back to the start
+            """
+        nextCells = self.table[self.cells, actions]
+        nextCells = np.where(nextCells >= 0, nextCells, self.cells)
+        dones = nextCells == self.endCell
+        rewards = np.where(dones, WIN_REWARD, STEP_REWARD)
+
+        self.steps += 1
+        finished = dones if self.maxSteps is None else dones | (self.steps >= self.maxSteps)
+        self.cells = np.where(finished, self.startCell, nextCells)
+        self.steps[finished] = 0
+        self.finishedEpisodes = self.finishedEpisodes + int(finished.sum())
+        self.wonEpisodes = self.wonEpisodes + int(dones.sum())
+        return (nextCells, rewards, dones, self.masks())
+
+    def reset(self):
+        self.cells[:] = self.startCell
+        self.steps[:] = 0
+
+    def register(self, qMemory:ArrayQMemory):
+        """ Add every action to 'qMemory'. The cells are added by addRows when agents update them, like the
+            states of GridEnvironment episodes, with the same keys: the Q-table can be used with GridEnvironment too
+            """
+        self.rows = np.full(self.width * self.height, UNKNOWN, dtype=np.int64)
+        self.columns = np.array([qMemory.actionIndex(GridAction(direction)) for direction in DIRECTIONS], dtype=np.int64)
+        self.actionOfColumn = np.full(qMemory.values.shape[1], -1, dtype=np.int64)
+        self.actionOfColumn[self.columns] = np.arange(len(DIRECTIONS))
+
+    def addRows(self, qMemory:ArrayQMemory, cells:np.ndarray):
+        """ Add the 'cells' that aren't in 'qMemory' yet """
+        for cell in np.unique(cells[self.rows[cells] == UNKNOWN]).tolist():
+            self.rows[cell] = qMemory.stateIndex(GridState(Position(cell % self.width, cell // self.width)))
+
+    def pickActions(self, qMemory:ArrayQMemory, exploitRate) -> np.ndarray:
+        """ Like Policy.pickAction for every agent: the best known action with probability 'exploitRate',
+            else (or when there is none) a random valid action
+            """
+        masks = self.masks()
+        randomActions = np.where(masks, self.rng.random(masks.shape), -1.0).argmax(axis=1)
+        rows = self.rows[self.cells]
+        best = np.where(rows == UNKNOWN, -1, qMemory.rowBest[rows])
+        # the best action can be a column added after register() by another kind of action
+        known = (best >= 0) & (best < len(self.actionOfColumn))
+        bestActions = np.where(known, self.actionOfColumn[np.where(known, best, 0)], -1)
+        exploit = (self.rng.random(len(self.cells)) <= exploitRate) & (bestActions >= 0)
+        return np.where(exploit, bestActions, randomActions)